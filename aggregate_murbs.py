@@ -1,10 +1,26 @@
+import io
+import os
+import heapq
+import signal
 import psycopg2
+import argparse
+import numpy as np
 import psycopg2.extras
+from datetime import datetime
 from statistics import mean
+from multiprocessing import Pool
 from collections import Counter
 from dotenv import dotenv_values
 from psycopg2.extras import execute_values
 
+from parse_shp import update_table_coordinates, copy_coordinates_to_temp_table, coordinate_rows, apply_temp_coordinates
+from utils.compact_schema import storage_table_name
+from utils.geohash import CELL_COLUMNS
+from utils.murb_groups import group_units_within_tolerance
+from utils.most_common import group_most_common, sql_value_counts, sql_most_common
+from utils.indexes import create_stage_indexes
+from utils.materialized_views import refresh_materialized_views
+
 # Read in the database configuration from a .env file
 DB_CONFIG = dotenv_values(".env")
 
@@ -13,24 +29,49 @@ SQL_COPY_TEMPLATE = """(%(id)s, %(lat)s, %(lng)s, %(year)s, %(muni)s, %(muni_cod
     %(apt_num_1)s, %(apt_num_2)s, %(mat18)s, %(cubf)s, %(file_num)s, %(nghbr_unit)s, %(owner_date)s, 
     %(owner_type)s, %(owner_status)s, %(lot_lin_dim)s, %(lot_area)s, %(max_floors)s, %(const_yr)s, 
     %(const_yr_real)s, %(floor_area)s, %(phys_link)s, %(const_type)s, %(num_dwelling)s, %(num_rental)s, 
-    %(num_non_res)s, %(apprais_date)s, %(lot_value)s, %(building_value)s, %(value)s, %(prev_value)s)"""
+    %(num_non_res)s, %(apprais_date)s, %(lot_value)s, %(building_value)s, %(value)s, %(prev_value)s, %(murb_id)s)"""
 
-SQL_COPY_DUPLICATES_TO_OTHER_TABLE = f"""INSERT INTO {DB_CONFIG['MURB_DISAG_TABLE_NAME']}
-    (id, lat, lng, year, muni, muni_code, arrond, address, num_adr_inf, num_adr_inf_2, num_adr_sup, num_adr_sup_2, 
+# Rows fetched at a time by the streaming aggregation
+FETCH_SIZE = 100_000
+
+# How each field of an aggregated MURB is derived from its units, see aggregate_murbs()
+MOST_COMMON_FIELDS = ('year', 'nghbr_unit', 'owner_date', 'owner_type', 'owner_status', 'const_yr', 'const_yr_real', 
+    'apprais_date')
+AVERAGED_FIELDS = ('lot_lin_dim', 'lot_area', 'floor_area', 'lot_value', 'building_value', 'value', 'prev_value')
+SUMMED_FIELDS = ('num_rental', 'num_non_res')
+LAST_UNIT_FIELDS = ('street_name', 'cubf', 'arrond', 'muni_code', *CELL_COLUMNS)
+
+# Columns of the disaggregated MURBs table
+DISAG_COLUMNS = """id, lat, lng, year, muni, muni_code, arrond, address, num_adr_inf, num_adr_inf_2, num_adr_sup, num_adr_sup_2, 
     street_name, apt_num, apt_num_1, apt_num_2, mat18, cubf, file_num, nghbr_unit, owner_date, owner_type, 
     owner_status, lot_lin_dim, lot_area, max_floors, const_yr, const_yr_real, floor_area, phys_link, const_type, 
-    num_dwelling, num_rental, num_non_res, apprais_date, lot_value, building_value, value, prev_value) VALUES %s ON CONFLICT DO NOTHING"""
+    num_dwelling, num_rental, num_non_res, apprais_date, lot_value, building_value, value, prev_value"""
 
-SQL_INSERT_AGGREGATED_MURB = f"""INSERT INTO {DB_CONFIG['ROLL_TABLE_NAME']}
-        (id, lat, lng, year, muni, muni_code, arrond, address, street_name, mat18, cubf, nghbr_unit, owner_date, owner_type, owner_status, 
+SQL_COPY_DUPLICATES_TO_OTHER_TABLE = f"""INSERT INTO {DB_CONFIG['MURB_DISAG_TABLE_NAME']}
+    ({DISAG_COLUMNS}, murb_id) VALUES %s ON CONFLICT DO NOTHING"""
+
+DISAG_COLUMN_NAMES = [column.strip() for column in DISAG_COLUMNS.split(',')]
+
+# ID of the aggregated MURB a disaggregated unit d is part of. Units copied before the murb_id column 
+# was added fall back on their own ID, which is the MURB's for the unit it was derived from.
+SQL_DISAG_MURB_ID = "coalesce(d.murb_id, left(d.id, 19) || '9999')"
+
+SQL_AGGREGATED_MURB_COLUMNS = f"""(id, lat, lng, {', '.join(CELL_COLUMNS)}, year, muni, muni_code, arrond, address, street_name, mat18, cubf, nghbr_unit, owner_date, owner_type, owner_status, 
         lot_lin_dim, lot_area, max_floors, const_yr, const_yr_real, floor_area, phys_link, const_type, num_dwelling, 
-        num_rental, num_non_res, apprais_date, lot_value, building_value, value, prev_value) 
-    VALUES
-        (%(id)s, %(lat)s, %(lng)s, %(year)s, %(muni)s, %(muni_code)s, %(arrond)s, %(address)s, %(street_name)s, %(mat18)s, %(cubf)s, %(nghbr_unit)s, 
+        num_rental, num_non_res, apprais_date, lot_value, building_value, value, prev_value)"""
+
+SQL_AGGREGATED_MURB_TEMPLATE = f"""(%(id)s, %(lat)s, %(lng)s, {', '.join(f'%({column})s' for column in CELL_COLUMNS)}, %(year)s, %(muni)s, %(muni_code)s, %(arrond)s, %(address)s, %(street_name)s, %(mat18)s, %(cubf)s, %(nghbr_unit)s, 
         %(owner_date)s, %(owner_type)s, %(owner_status)s, %(lot_lin_dim)s, %(lot_area)s, %(max_floors)s, 
         %(const_yr)s, %(const_yr_real)s, %(floor_area)s, %(phys_link)s, %(const_type)s, %(num_dwelling)s, 
         %(num_rental)s, %(num_non_res)s, %(apprais_date)s, %(lot_value)s, %(building_value)s, %(value)s, 
-        %(prev_value)s) ON CONFLICT DO NOTHING"""
+        %(prev_value)s)"""
+
+SQL_INSERT_AGGREGATED_MURB = f"""INSERT INTO {DB_CONFIG['ROLL_TABLE_NAME']}
+        {SQL_AGGREGATED_MURB_COLUMNS} 
+    VALUES
+        {SQL_AGGREGATED_MURB_TEMPLATE} ON CONFLICT DO NOTHING"""
+
+AGGREGATED_MURB_COLUMN_NAMES = [column.strip() for column in SQL_AGGREGATED_MURB_COLUMNS.strip('()').split(',')]
 
 # The parentheses around %s are important here
 SQL_DELETE_DUPLICATES = f"""DELETE FROM {DB_CONFIG['ROLL_TABLE_NAME']} WHERE id in (%s)"""
@@ -48,8 +89,9 @@ def aggregate_murbs():
     results = cursor.fetchall()
     print(f'{len(results)} duplicates found')
 
+    # In the order of their IDs, so ties between the most common values go to the lowest ID like in SQL
     SQL_GET_DUPLICATES = f"""select * from {DB_CONFIG['ROLL_TABLE_NAME']} 
-    WHERE lat = %s and lng = %s and address = %s and muni = %s;"""
+    WHERE lat = %s and lng = %s and address = %s and muni = %s ORDER BY id;"""
 
     for i, res in enumerate(results):
         
@@ -64,8 +106,10 @@ def aggregate_murbs():
             print(f'Error: no duplicates found for {res}')
             continue
         
-        # Copy the duplicates to the new table
-        execute_values(cursor, SQL_COPY_DUPLICATES_TO_OTHER_TABLE, duplicates, template=SQL_COPY_TEMPLATE)
+        # Copy the duplicates to the new table, along with the ID their aggregated MURB gets from the last one
+        murb_id = duplicates[-1]['id'][:-4] + '9999'
+        execute_values(cursor, SQL_COPY_DUPLICATES_TO_OTHER_TABLE, [{**dupe, 'murb_id': murb_id} for dupe in duplicates], 
+            template=SQL_COPY_TEMPLATE)
         conn.commit()
 
         print(f'Processing MURB {i+1} at {address}\n\t{len(duplicates)} duplicates')
@@ -169,6 +213,9 @@ def aggregate_murbs():
         agg_data['cubf'] = dupe['cubf']
         agg_data['arrond'] = dupe['arrond']
         agg_data['muni_code'] = dupe['muni_code']
+        # Same coordinates for all, so the same geohash cells
+        for column in CELL_COLUMNS:
+            agg_data[column] = dupe[column]
         agg_data['num_rental'] = num_rentals
         agg_data['num_non_res'] = num_non_res
 
@@ -201,51 +248,610 @@ def aggregate_murbs():
         execute_values(cursor, SQL_DELETE_DUPLICATES, dupe_ids)
         conn.commit()
 
+    record_watermarks(cursor)
+    conn.commit()
+    conn.close()
+
 
-def update_aggregated_murbs():
+def aggregate_murbs_set_based(muni_codes=None, log_prefix='', restore=False, tolerance=None):
     """
-    Function to update the aggregated MURBs if needed
+    Same aggregation as aggregate_murbs(), but with a few set-based statements in a single transaction
+    instead of a loop over the groups. The members of every group are staged in a temporary table,
+    then copied to the disaggregated table, aggregated into new rows and deleted from the roll.
+    Only the units of the given municipality codes are aggregated if given, after putting back
+    the units of their previously aggregated MURBs if restore is set.
+    With a tolerance in metres, units are grouped by normalized address and distance instead of exact equality.
+    Returns the number of aggregated MURBs and of units they were made of.
     """
     conn = psycopg2.connect(user=DB_CONFIG['DB_USER'], password=DB_CONFIG['DB_PASSWORD'], database=DB_CONFIG['DB_NAME'])
-    cursor = conn.cursor(cursor_factory = psycopg2.extras.RealDictCursor)
+    cursor = conn.cursor()
 
-    # # Get all the duplicates
-    cursor.execute(f"""SELECT address, lat, lng, muni, count(*) as num_duplicates, sum(num_dwelling) as sum_dwellings 
-    FROM {DB_CONFIG['MURB_DISAG_TABLE_NAME']} group by lat, lng, address, muni ORDER BY count(*) desc""")
+    if restore:
+        restore_disaggregated_units(cursor, muni_codes=muni_codes, log_prefix=log_prefix)
 
-    results = cursor.fetchall()
-    print(f'{len(results)} duplicates found')
+    t0 = datetime.now()
+    if tolerance is not None:
+        stage_murb_members_within_tolerance(cursor, tolerance, muni_codes=muni_codes, log_prefix=log_prefix)
+    else:
+        # Units without coordinates never matched the lat = %s lookup of the loop, so they are left alone here too
+        stage_murb_members(cursor, DB_CONFIG['ROLL_TABLE_NAME'], muni_codes=muni_codes)
+    cursor.execute("CREATE INDEX ON murb_members (id); ANALYZE murb_members;")
+    cursor.execute("SELECT count(DISTINCT group_id), count(*) FROM murb_members")
+    num_groups, num_units = cursor.fetchone()
+    print(f'{log_prefix}{num_groups} duplicates found, made of {num_units} units ({datetime.now() - t0})')
 
-    SQL_GET_SINGLE_DUPLICATE = f"""select id from {DB_CONFIG['MURB_DISAG_TABLE_NAME']} 
-        WHERE lat = %s and lng = %s and address = %s and muni = %s;"""
+    t0 = datetime.now()
+    num_copied = copy_murb_members_to_disag_table(cursor, DB_CONFIG['ROLL_TABLE_NAME'])
+    print(f'{log_prefix}Copied {num_copied} units to {DB_CONFIG["MURB_DISAG_TABLE_NAME"]} ({datetime.now() - t0})')
 
-    SQL_UPDATE_AGGREGATED_MURB = f"""UPDATE {DB_CONFIG['ROLL_TABLE_NAME']} SET lat = %s, lng = %s WHERE id = %s"""
+    t0 = datetime.now()
+    num_inserted = insert_aggregated_murbs(cursor, DB_CONFIG['ROLL_TABLE_NAME'])
+    print(f'{log_prefix}Inserted {num_inserted} aggregated MURBs ({datetime.now() - t0})')
 
-    for i, res in enumerate(results):
-        
-        # get duplicates using the key
-        lat, lng, address, muni = res['lat'], res['lng'], res['address'], res['muni']
-        
-        # Fetch duplicates
-        cursor.execute(SQL_GET_SINGLE_DUPLICATE, (lat, lng, address, muni))
-        duplicates = cursor.fetchall()
+    t0 = datetime.now()
+    # With the compact schema, delete from the table behind the view rather than row by row through its trigger
+    cursor.execute(f"""
+        DELETE FROM {storage_table_name(cursor)} r
+        USING murb_members m
+        WHERE r.id = m.id;""")
+    print(f'{log_prefix}Deleted {cursor.rowcount} disaggregated units from the roll ({datetime.now() - t0})')
 
-        for dupe in duplicates:
-            # Recreate the ID of the aggregated MURB        
-            id = dupe['id'][:-4] + '9999'
+    record_watermarks(cursor, muni_codes)
+    conn.commit()
+    conn.close()
+    return num_groups, num_units
+
+
+def aggregate_murbs_streaming(fetch_size=FETCH_SIZE, muni_codes=None, log_prefix='', restore=False):
+    """
+    Same aggregation as aggregate_murbs(), for when the rules don't fit in SQL, but without a query per MURB.
+    The residential units are streamed through a server-side cursor ordered by the grouping key,
+    so the units of a MURB are contiguous, and the summaries of every MURB in a chunk are computed
+    at once with NumPy. Copies, inserts and deletes are sent a chunk at a time, in a single transaction.
+    Only the units of the given municipality codes are aggregated if given, after putting back
+    the units of their previously aggregated MURBs if restore is set.
+    Returns the number of aggregated MURBs and of units they were made of.
+    """
+    conn = psycopg2.connect(user=DB_CONFIG['DB_USER'], password=DB_CONFIG['DB_PASSWORD'], database=DB_CONFIG['DB_NAME'])
+    if restore:
+        restore_disaggregated_units(conn.cursor(), muni_codes=muni_codes, log_prefix=log_prefix)
+    # The server-side cursor reads from the snapshot it was opened with, so our deletes don't disturb it
+    read_cursor = conn.cursor(name='murb_stream')
+    read_cursor.itersize = fetch_size
+    cursor = conn.cursor()
+
+    columns = DISAG_COLUMN_NAMES + list(CELL_COLUMNS)
+    # The ID breaks ties so the last unit of a MURB is the one with the highest ID, like in the set-based aggregation
+    read_cursor.execute(f"""SELECT {', '.join(columns)} FROM {DB_CONFIG['ROLL_TABLE_NAME']}
+        WHERE cubf = 1000 AND lat IS NOT NULL AND lng IS NOT NULL 
+        {'AND muni_code = ANY(%(muni_codes)s)' if muni_codes is not None else ''}
+        ORDER BY muni, address, lat, lng, id""", {'muni_codes': muni_codes})
+    key_indexes = [columns.index(column) for column in ('muni', 'address', 'lat', 'lng')]
+    delete_table = storage_table_name(cursor)
+
+    # The aggregated MURBs are sent with COPY, which can't skip conflicts, so they go through a temporary table.
+    # The averages are numeric there, and rounded when inserted in the integer columns of the roll.
+    temp_columns = [f'{column}::numeric AS {column}' if column in AVERAGED_FIELDS else column 
+        for column in AGGREGATED_MURB_COLUMN_NAMES]
+    cursor.execute(f"""
+        CREATE TEMP TABLE murb_aggregates ON COMMIT DROP AS
+        SELECT {', '.join(temp_columns)} FROM {DB_CONFIG['ROLL_TABLE_NAME']} WITH NO DATA;""")
+
+    t0 = datetime.now()
+    num_murbs = num_units = 0
+    pending = []
+    while True:
+        rows = read_cursor.fetchmany(fetch_size)
+        if rows:
+            # The last MURB of the chunk may go on in the next one
+            complete, pending = _split_last_group(pending + rows, key_indexes)
+        else:
+            complete, pending = pending, []
+
+        murb_units, murb_ids, aggregated_murbs = _aggregate_contiguous_murbs(complete, columns)
+        if aggregated_murbs:
+            unit_ids = [unit[0] for unit in murb_units]
+            # The units are still in the roll, so they are copied server side rather than sent back
+            cursor.execute(f"""
+                INSERT INTO {DB_CONFIG['MURB_DISAG_TABLE_NAME']} ({DISAG_COLUMNS}, murb_id)
+                SELECT {', '.join(f'r.{column}' for column in DISAG_COLUMN_NAMES)}, m.murb_id 
+                FROM {DB_CONFIG['ROLL_TABLE_NAME']} r
+                JOIN unnest(%s::text[], %s::text[]) AS m(id, murb_id) ON m.id = r.id
+                ON CONFLICT DO NOTHING""", (unit_ids, murb_ids))
+            _copy_rows(cursor, 'murb_aggregates', AGGREGATED_MURB_COLUMN_NAMES, 
+                ([murb[column] for column in AGGREGATED_MURB_COLUMN_NAMES] for murb in aggregated_murbs))
+            cursor.execute(f"""DELETE FROM {delete_table} WHERE id = ANY(%s)""", (unit_ids,))
+            num_murbs += len(aggregated_murbs)
+            num_units += len(murb_units)
+            print(f'{log_prefix}Aggregated {num_murbs} MURBs from {num_units} units ({datetime.now() - t0})')
+
+        if not rows:
+            break
+
+    read_cursor.close()
+    cursor.execute(f"""
+        INSERT INTO {DB_CONFIG['ROLL_TABLE_NAME']} ({', '.join(AGGREGATED_MURB_COLUMN_NAMES)})
+        SELECT * FROM murb_aggregates
+        ON CONFLICT DO NOTHING""")
+    record_watermarks(cursor, muni_codes)
+    conn.commit()
+    conn.close()
+    print(f'{log_prefix}{num_murbs} MURBs aggregated from {num_units} units')
+    return num_murbs, num_units
+
+
+def launch_jobs(num_workers, mode='sql', muni_codes=None, restore=False, tolerance=None):
+    """
+    Aggregate the MURBs in parallel, splitting the municipalities (all of them, or the given ones) between the workers.
+    The units of a MURB are always in the same municipality, so the workers never touch the same rows.
+    """
+    splits = split_munis_between_workers(num_workers, muni_codes)
+    jobs = [(mode, split, restore, tolerance) for split in splits if split]
+
+    # Municipalities without residential units are never given to a worker, but they were checked all the same,
+    # so they get their watermark here rather than being reported as changed by every --incremental run
+    conn = psycopg2.connect(user=DB_CONFIG['DB_USER'], password=DB_CONFIG['DB_PASSWORD'], database=DB_CONFIG['DB_NAME'])
+    cursor = conn.cursor()
+    record_watermarks(cursor, muni_codes, excluded_muni_codes=[muni_code for split in splits for muni_code in split])
+    conn.commit()
+    conn.close()
+
+    if not jobs:
+        print('No residential units to aggregate')
+        return
+
+    with Pool(processes=len(jobs)) as pool:
+        results = pool.map(aggregate_munis, jobs)
+
+    print(f'{sum(num_murbs for num_murbs, _ in results)} MURBs aggregated from '
+          f'{sum(num_units for _, num_units in results)} units, per worker: {[num_murbs for num_murbs, _ in results]}')
+
+
+def split_munis_between_workers(num_workers, muni_codes=None):
+    """
+    Partition the municipalities such that each worker has about the same number of residential units,
+    giving the largest remaining municipality to the worker with the fewest units, like the XMLs in parse_xmls.py
+    """
+    conn = psycopg2.connect(user=DB_CONFIG['DB_USER'], password=DB_CONFIG['DB_PASSWORD'], database=DB_CONFIG['DB_NAME'])
+    cursor = conn.cursor()
+    cursor.execute(f"""SELECT muni_code, count(*) FROM {DB_CONFIG['ROLL_TABLE_NAME']} WHERE cubf = 1000 
+        {'AND muni_code = ANY(%(muni_codes)s)' if muni_codes is not None else ''}
+        GROUP BY muni_code ORDER BY count(*) DESC""", {'muni_codes': muni_codes})
+    units_per_muni = cursor.fetchall()
+    conn.close()
+
+    splits = [[] for _ in range(num_workers)]
+    worker_heap = [[0, worker_id] for worker_id in range(num_workers)]
+    heapq.heapify(worker_heap)
+
+    lowest_worker = heapq.heappop(worker_heap)
+    for muni_code, num_units in units_per_muni:
+        splits[lowest_worker[1]].append(muni_code)
+        lowest_worker[0] += num_units
+        lowest_worker = heapq.heappushpop(worker_heap, lowest_worker)
 
-            # Ensure we actually have a building in the Roll DB with that ID
-            cursor.execute(f"""SELECT EXISTS (SELECT 1 FROM {DB_CONFIG['ROLL_TABLE_NAME']} WHERE id=%s)""", (id,))
+    return splits
 
-            if cursor.fetchone()['exists']:
-                break
 
-        if i % 1000 == 0:
-            print(f'Updating unit {i}')
+def aggregate_munis(job):
+    """
+    Worker aggregating the MURBs of its municipalities in its own transaction
+    """
+    mode, muni_codes, restore, tolerance = job
+    pid = os.getpid()
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    t0 = datetime.now()
+    print(f'{pid}:\tAggregating the MURBs of {len(muni_codes)} municipalities')
+    if mode == 'stream':
+        results = aggregate_murbs_streaming(muni_codes=muni_codes, log_prefix=f'{pid}:\t', restore=restore)
+    else:
+        results = aggregate_murbs_set_based(muni_codes=muni_codes, log_prefix=f'{pid}:\t', restore=restore, tolerance=tolerance)
+    print(f'{pid}:\tFinished {len(muni_codes)} municipalities in {datetime.now() - t0}')
+    return results
+
+
+def stage_murb_members(cursor, table_name, muni_codes=None):
+    """
+    Stage the members of every group of residential units of table_name with the same coordinates, address 
+    and municipality in the murb_members temporary table, with the group of each
+    """
+    muni_filter = 'AND muni_code = ANY(%(muni_codes)s)' if muni_codes is not None else ''
+    cursor.execute(f"""
+        CREATE TEMP TABLE murb_members ON COMMIT DROP AS
+        SELECT id, group_id
+        FROM (
+            SELECT 
+                id, 
+                dense_rank() OVER (ORDER BY lat, lng, address, muni) AS group_id,
+                count(*) OVER (PARTITION BY lat, lng, address, muni) AS group_size
+            FROM {table_name}
+            WHERE cubf = 1000 AND lat IS NOT NULL AND lng IS NOT NULL {muni_filter}
+        ) u
+        WHERE group_size > 1;""", {'muni_codes': muni_codes})
+
+
+def copy_murb_members_to_disag_table(cursor, table_name):
+    """
+    Copy the units of table_name staged in murb_members to the disaggregated table, 
+    along with the ID of their aggregated MURB
+    """
+    cursor.execute(f"""
+        INSERT INTO {DB_CONFIG['MURB_DISAG_TABLE_NAME']} ({DISAG_COLUMNS}, murb_id)
+        SELECT {', '.join(f'r.{column}' for column in DISAG_COLUMN_NAMES)}, 
+            left(max(r.id) OVER (PARTITION BY m.group_id), 19) || '9999'
+        FROM {table_name} r
+        JOIN murb_members m ON m.id = r.id
+        ON CONFLICT DO NOTHING;""")
+    return cursor.rowcount
+
+
+def insert_aggregated_murbs(cursor, table_name):
+    """
+    Insert an aggregated MURB in the roll for every group of units of table_name staged in murb_members
+    """
+    # The fields taken from a single unit in the loop come from the one with the highest ID,
+    # which also gives the aggregated MURB its ID, and its coordinates to match its cells within a tolerance
+    def last(column):
+        return f'(array_agg(r.{column} ORDER BY r.id DESC))[1]'
+
+    def most_common(column):
+        return sql_most_common(column, alias='r')
+
+    def average(column):
+        # Zeros and nulls are left out of the averages, like in _average_or_none()
+        return f'round(avg(NULLIF(r.{column}, 0)), 2)'
+
+    # Largest apt_num_1 that is an integer, or 0
+    max_apt_num = r"coalesce(max(CASE WHEN r.apt_num_1 ~ '^\s*\d{1,9}\s*$' THEN trim(r.apt_num_1)::integer END), 0)"
+
+    cursor.execute(f"""
+        INSERT INTO {DB_CONFIG['ROLL_TABLE_NAME']}
+            (id, lat, lng, {', '.join(CELL_COLUMNS)}, year, muni, muni_code, arrond, address, street_name, mat18, cubf, 
+            nghbr_unit, owner_date, owner_type, owner_status, lot_lin_dim, lot_area, max_floors, const_yr, const_yr_real, floor_area, phys_link, 
+            const_type, num_dwelling, num_rental, num_non_res, apprais_date, lot_value, building_value, value, prev_value)
+        SELECT
+            left(max(r.id), 19) || '9999',
+            {last('lat')},
+            {last('lng')},
+            {', '.join(last(column) for column in CELL_COLUMNS)},
+            {most_common('year')},
+            min(r.muni),
+            {last('muni_code')},
+            {last('arrond')},
+            min(r.address),
+            {last('street_name')},
+            left({last('mat18')}, 14) || '9999',
+            {last('cubf')},
+            {most_common('nghbr_unit')},
+            {most_common('owner_date')},
+            {most_common('owner_type')},
+            {most_common('owner_status')},
+            {average('lot_lin_dim')},
+            {average('lot_area')},
+            {SQL_INFER_NUMBER_OF_FLOORS.format(max_apt_num=max_apt_num, lat=last('lat'), lng=last('lng'))},
+            {most_common('const_yr')},
+            {most_common('const_yr_real')},
+            {average('floor_area')},
+            '1',
+            '5',
+            sum(r.num_dwelling),
+            coalesce(sum(r.num_rental), 0),
+            coalesce(sum(r.num_non_res), 0),
+            {most_common('apprais_date')},
+            {average('lot_value')},
+            {average('building_value')},
+            {average('value')},
+            {average('prev_value')}
+        FROM (
+            SELECT r.*, m.group_id, {', '.join(sql_value_counts(column, 'm.group_id', alias='r') for column in MOST_COMMON_FIELDS)}
+            FROM {table_name} r
+            JOIN murb_members m ON m.id = r.id
+        ) r
+        GROUP BY r.group_id
+        ON CONFLICT DO NOTHING;""")
+    return cursor.rowcount
+
 
-        # Update the existing aggregated MURB with the new values
-        cursor.execute(SQL_UPDATE_AGGREGATED_MURB, (lat, lng, id))
+def stage_murb_members_within_tolerance(cursor, tolerance, muni_codes=None, log_prefix=''):
+    """
+    Stage the members of every group of residential units of the same municipality and normalized address 
+    within tolerance metres of each other in the murb_members temporary table, see utils/murb_groups.py
+    """
+    read_cursor = cursor.connection.cursor(name='murb_tolerance')
+    read_cursor.itersize = FETCH_SIZE
+    read_cursor.execute(f"""
+        SELECT id, muni_code, address, lat::float8, lng::float8
+        FROM {DB_CONFIG['ROLL_TABLE_NAME']}
+        WHERE cubf = 1000 AND lat IS NOT NULL AND lng IS NOT NULL 
+        {'AND muni_code = ANY(%(muni_codes)s)' if muni_codes is not None else ''}""", {'muni_codes': muni_codes})
+    ids, muni_code_values, addresses, lats, lngs = [], [], [], [], []
+    while rows := read_cursor.fetchmany(FETCH_SIZE):
+        for id, muni_code, address, lat, lng in rows:
+            ids.append(id)
+            muni_code_values.append(muni_code)
+            addresses.append(address)
+            lats.append(lat)
+            lngs.append(lng)
+    read_cursor.close()
+
+    t0 = datetime.now()
+    group_ids = group_units_within_tolerance(muni_code_values, addresses, lats, lngs, tolerance)
+    print(f'{log_prefix}Grouped {len(ids)} residential units within {tolerance}m ({datetime.now() - t0})')
+
+    cursor.execute("CREATE TEMP TABLE murb_members (id TEXT, group_id BIGINT) ON COMMIT DROP")
+    _copy_rows(cursor, 'murb_members', ('id', 'group_id'), 
+        ((id, group_id) for id, group_id in zip(ids, group_ids.tolist()) if group_id >= 0))
+
+
+def restore_disaggregated_units(cursor, muni_codes=None, ids=None, log_prefix=''):
+    """
+    Put the units of previously aggregated MURBs back in the roll, in place of their aggregated MURB.
+    All of them by default, or only those of the given municipalities, and/or of the MURBs with the given 
+    aggregated MURB or unit IDs. Units loaded again since they were aggregated are kept as loaded.
+    Their municipalities lose their watermark, so --incremental aggregates them again.
+    Returns the number of units restored and of aggregated MURBs removed.
+    """
+    filters = []
+    if muni_codes is not None:
+        filters.append('d.muni_code = ANY(%(muni_codes)s)')
+    if ids is not None:
+        filters.append(f'({SQL_DISAG_MURB_ID} = ANY(%(ids)s) OR d.id = ANY(%(ids)s))')
+
+    t0 = datetime.now()
+    # Every unit of a selected MURB, even when only one of its units was selected by ID
+    cursor.execute(f"""
+        CREATE TEMP TABLE restored_units ON COMMIT DROP AS
+        SELECT d.id, {SQL_DISAG_MURB_ID} AS murb_id, d.muni_code
+        FROM {DB_CONFIG['MURB_DISAG_TABLE_NAME']} d
+        WHERE {SQL_DISAG_MURB_ID} IN (
+            SELECT {SQL_DISAG_MURB_ID} FROM {DB_CONFIG['MURB_DISAG_TABLE_NAME']} d 
+            {'WHERE ' + ' AND '.join(filters) if filters else ''}
+        );""", {'muni_codes': muni_codes, 'ids': ids})
+    cursor.execute("CREATE INDEX ON restored_units (id); ANALYZE restored_units;")
+
+    cursor.execute(f"""
+        INSERT INTO {DB_CONFIG['ROLL_TABLE_NAME']} ({DISAG_COLUMNS})
+        SELECT {', '.join(f'd.{column}' for column in DISAG_COLUMN_NAMES)}
+        FROM {DB_CONFIG['MURB_DISAG_TABLE_NAME']} d
+        JOIN restored_units u ON u.id = d.id
+        ON CONFLICT DO NOTHING
+        RETURNING id, lat::float8, lng::float8""")
+    num_restored = cursor.rowcount
+
+    # The disaggregated table doesn't keep the geohash cells, they are computed again from the coordinates
+    # of the restored units, through the same path as the shapefile coordinates
+    restored_coords = [row for row in cursor.fetchall() if row[1] is not None and row[2] is not None]
+    if restored_coords:
+        ids, lat, lng = zip(*restored_coords)
+        copy_coordinates_to_temp_table(cursor, coordinate_rows(np.array(ids), np.array(lat), np.array(lng)), 
+                                       log_prefix=log_prefix)
+        apply_temp_coordinates(cursor, DB_CONFIG['ROLL_TABLE_NAME'])
+        cursor.execute("DROP TABLE shp_coords")
+
+    cursor.execute(f"""
+        DELETE FROM {storage_table_name(cursor)}
+        WHERE id IN (SELECT murb_id FROM restored_units)""")
+    num_removed = cursor.rowcount
+
+    cursor.execute(f"""
+        DELETE FROM {DB_CONFIG['MURB_DISAG_TABLE_NAME']} d 
+        USING restored_units u 
+        WHERE d.id = u.id""")
+    cursor.execute(f"""
+        DELETE FROM {DB_CONFIG['MURB_WATERMARK_TABLE_NAME']} 
+        WHERE muni_code IN (SELECT muni_code FROM restored_units)""")
+    cursor.execute("DROP TABLE restored_units")
+    print(f'{log_prefix}Restored {num_restored} units in place of {num_removed} aggregated MURBs ({datetime.now() - t0})')
+    return num_restored, num_removed
+
+
+def record_watermarks(cursor, muni_codes=None, excluded_muni_codes=None):
+    """
+    Remember the load the municipalities (all of them, or the given ones, but not the excluded ones)
+    were aggregated at, from the muni stats written by parse_xmls.py
+    """
+    filters = []
+    if muni_codes is not None:
+        filters.append('muni_code = ANY(%(muni_codes)s)')
+    if excluded_muni_codes is not None:
+        filters.append('muni_code <> ALL(%(excluded_muni_codes)s)')
+
+    cursor.execute(f"""
+        INSERT INTO {DB_CONFIG['MURB_WATERMARK_TABLE_NAME']} (muni_code, load_id, aggregated_at)
+        SELECT muni_code, max(load_id), now()
+        FROM {DB_CONFIG['MUNI_STATS_TABLE_NAME']}
+        {'WHERE ' + ' AND '.join(filters) if filters else ''}
+        GROUP BY muni_code
+        ON CONFLICT (muni_code) DO UPDATE SET load_id = EXCLUDED.load_id, aggregated_at = EXCLUDED.aggregated_at""", 
+        {'muni_codes': muni_codes, 'excluded_muni_codes': excluded_muni_codes})
+
+
+def get_changed_munis():
+    """
+    Municipalities loaded by parse_xmls.py since they were last aggregated
+    """
+    conn = psycopg2.connect(user=DB_CONFIG['DB_USER'], password=DB_CONFIG['DB_PASSWORD'], database=DB_CONFIG['DB_NAME'])
+    cursor = conn.cursor()
+    cursor.execute(f"""
+        SELECT s.muni_code
+        FROM (
+            SELECT muni_code, max(load_id) AS load_id 
+            FROM {DB_CONFIG['MUNI_STATS_TABLE_NAME']} 
+            GROUP BY muni_code
+        ) s
+        LEFT JOIN {DB_CONFIG['MURB_WATERMARK_TABLE_NAME']} w ON w.muni_code = s.muni_code
+        WHERE w.muni_code IS NULL OR w.load_id IS DISTINCT FROM s.load_id
+        ORDER BY s.muni_code""")
+    muni_codes = [muni_code for muni_code, in cursor.fetchall()]
+    conn.close()
+    return muni_codes
+
+
+def _copy_rows(cursor, table_name, columns, rows):
+    """
+    COPY the rows into the table, in the text format
+    """
+    buffer = io.StringIO()
+    for row in rows:
+        buffer.write('\t'.join(_copy_value(value) for value in row))
+        buffer.write('\n')
+    buffer.seek(0)
+    cursor.copy_expert(f"COPY {table_name} ({', '.join(columns)}) FROM STDIN", buffer)
+
+
+def _copy_value(value):
+    if value is None:
+        return '\\N'
+    if isinstance(value, str):
+        return value.replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+    return str(value)
+
+
+def _split_last_group(rows, key_indexes):
+    """
+    Split the rows before the last group, and the rows of the last group
+    """
+    def key(row):
+        return tuple(row[i] for i in key_indexes)
+
+    last_key = key(rows[-1])
+    start = len(rows) - 1
+    while start > 0 and key(rows[start - 1]) == last_key:
+        start -= 1
+    return rows[:start], rows[start:]
+
+
+def _aggregate_contiguous_murbs(rows, columns):
+    """
+    Find the runs of rows with the same (muni, address, lat, lng) and summarize each run of more than
+    one unit into an aggregated MURB, the same way as aggregate_murbs(). Returns the units of the
+    MURBs, the ID of the aggregated MURB of each unit, and the aggregated MURBs, as dicts for 
+    SQL_AGGREGATED_MURB_TEMPLATE.
+    """
+    if not rows:
+        return [], [], []
+
+    data = {column: np.array(values, dtype=object) for column, values in zip(columns, zip(*rows))}
+
+    is_start = np.zeros(len(rows), dtype=bool)
+    is_start[0] = True
+    for column in ('muni', 'address', 'lat', 'lng'):
+        is_start[1:] |= data[column][1:] != data[column][:-1]
+    starts = np.flatnonzero(is_start)
+    sizes = np.diff(np.append(starts, len(rows)))
+
+    # Keep only the units of actual MURBs
+    is_murb_unit = np.repeat(sizes > 1, sizes)
+    if not is_murb_unit.any():
+        return [], [], []
+    murb_units = [row for row, keep in zip(rows, is_murb_unit) if keep]
+    data = {column: values[is_murb_unit] for column, values in data.items()}
+    sizes = sizes[sizes > 1]
+    starts = np.concatenate(([0], np.cumsum(sizes)[:-1]))
+    lasts = starts + sizes - 1
+    group_ids = np.repeat(np.arange(len(sizes)), sizes)
+
+    summaries = {}
+    for field in MOST_COMMON_FIELDS:
+        summaries[field] = group_most_common(data[field], group_ids, len(sizes))
+    for field in AVERAGED_FIELDS:
+        summaries[field] = _group_average(data[field], starts)
+    for field in SUMMED_FIELDS:
+        summaries[field] = np.add.reduceat(np.array([int(value) if value else 0 for value in data[field]]), starts).tolist()
+
+    # Like sum() in SQL, null only if all the units are
+    has_dwellings = np.array([value is not None for value in data['num_dwelling']])
+    dwellings = np.add.reduceat(np.where(has_dwellings, data['num_dwelling'], 0).astype(np.int64), starts)
+    summaries['num_dwelling'] = [int(num) if any_dwellings else None 
+        for num, any_dwellings in zip(dwellings, np.logical_or.reduceat(has_dwellings, starts))]
+
+    apt_nums = np.array([_apt_number(value) for value in data['apt_num_1']], dtype=np.int64)
+    max_apt_nums = np.maximum(np.maximum.reduceat(apt_nums, starts), 0)
+    lat = data['lat'][starts]
+    lng = data['lng'][starts]
+    summaries['max_floors'] = infer_number_of_floors_vectorized(max_apt_nums, lat.astype(np.float64), 
+        lng.astype(np.float64)).tolist()
+
+    aggregated_murbs = []
+    for i, (first, last) in enumerate(zip(starts, lasts)):
+        agg_data = {field: values[i] for field, values in summaries.items()}
+        agg_data.update({field: data[field][last] for field in LAST_UNIT_FIELDS})
+        agg_data.update({
+            'id': data['id'][last][:-4] + '9999',
+            'mat18': data['mat18'][last][:-4] + '9999',
+            'lat': lat[i],
+            'lng': lng[i],
+            'address': data['address'][first],
+            'muni': data['muni'][first],
+            'phys_link': '1',
+            'const_type': '5',
+        })
+        aggregated_murbs.append(agg_data)
+    murb_ids = np.repeat([murb['id'] for murb in aggregated_murbs], sizes).tolist()
+
+    return murb_units, murb_ids, aggregated_murbs
+
+
+def _group_average(values, starts):
+    """
+    Average of each group of contiguous values, leaving out zeros and nulls like _average_or_none()
+    """
+    present = np.array([bool(value) for value in values])
+    totals = np.add.reduceat(np.where(present, values, 0).astype(np.float64), starts)
+    counts = np.add.reduceat(present.astype(np.int64), starts)
+    averages = np.round(totals / np.maximum(counts, 1), 2)
+    return [float(average) if count else None for average, count in zip(averages, counts)]
+
+
+def _apt_number(apt_num):
+    try:
+        return int(apt_num)
+    except (TypeError, ValueError):
+        return 0
+
+
+def update_aggregated_murbs(coord_index=None):
+    """
+    Function to update the aggregated MURBs if needed.
+    If a coordinate index is given, the disaggregated units are first re-coordinated from it.
+    The aggregated MURB of each disaggregated unit has the unit's ID ending in 9999, so they are matched with a
+    join on the derived ID, and all the aggregated MURBs get the coordinates (and geohash cells) of their units
+    with a single UPDATE. A MURB whose units now have different coordinates gets those of the unit with the highest ID.
+    """
+    conn = psycopg2.connect(user=DB_CONFIG['DB_USER'], password=DB_CONFIG['DB_PASSWORD'], database=DB_CONFIG['DB_NAME'])
+    cursor = conn.cursor()
+
+    if coord_index is not None:
+        num_updated = update_table_coordinates(cursor, coord_index, DB_CONFIG['MURB_DISAG_TABLE_NAME'])
         conn.commit()
+        print(f'Updated coordinates of {num_updated} disaggregated units')
+
+    cursor.execute(f"""
+        SELECT count(r.id), count(*) - count(r.id), count(DISTINCT r.id)
+        FROM {DB_CONFIG['MURB_DISAG_TABLE_NAME']} d
+        LEFT JOIN {DB_CONFIG['ROLL_TABLE_NAME']} r ON r.id = {SQL_DISAG_MURB_ID}""")
+    num_matched, num_unmatched, num_murbs = cursor.fetchone()
+    print(f'{num_matched} disaggregated units matched {num_murbs} aggregated MURBs, '
+          f'{num_unmatched} don\'t match the ID of any aggregated MURB')
+
+    cursor.execute(f"""
+        SELECT DISTINCT ON (murb_id) {SQL_DISAG_MURB_ID} AS murb_id, d.lat::float8, d.lng::float8
+        FROM {DB_CONFIG['MURB_DISAG_TABLE_NAME']} d
+        JOIN {DB_CONFIG['ROLL_TABLE_NAME']} r ON r.id = {SQL_DISAG_MURB_ID}
+        ORDER BY murb_id, d.id DESC""")
+    rows = cursor.fetchall()
+    if not rows:
+        conn.close()
+        return
+
+    # Same path as the shapefile coordinates, so the geohash cells follow the new coordinates
+    murb_ids, lat, lng = zip(*rows)
+    copy_coordinates_to_temp_table(cursor, coordinate_rows(np.array(murb_ids), np.array(lat), np.array(lng)))
+    num_updated = apply_temp_coordinates(cursor, DB_CONFIG['ROLL_TABLE_NAME'])
+    conn.commit()
+    conn.close()
+    print(f'Updated coordinates of {num_updated} aggregated MURBs')
 
 
 def _average_or_none(arr):
@@ -254,6 +860,16 @@ def _average_or_none(arr):
     return None
 
 
+# infer_number_of_floors() as an SQL expression, for the set-based aggregation.
+# Integer division like //, since max_apt_num is never negative.
+SQL_INFER_NUMBER_OF_FLOORS = """CASE
+                WHEN {max_apt_num} >= 10000 THEN
+                    CASE WHEN {lat} = 46.7174122671 AND {lng} = -71.2773427875 THEN 3 ELSE 10 END
+                WHEN {max_apt_num} >= 1000 THEN {max_apt_num} / 100
+                ELSE {max_apt_num} / 10
+            END"""
+
+
 def infer_number_of_floors(max_apt_num, lat, lng):
     num_floors = 1
     # There are only 3 buildings with apt_num > 10,000
@@ -274,6 +890,18 @@ def infer_number_of_floors(max_apt_num, lat, lng):
     return num_floors
 
 
+def infer_number_of_floors_vectorized(max_apt_nums, lat, lng):
+    """
+    infer_number_of_floors() over arrays
+    """
+    is_ecluse = (lat == 46.7174122671) & (lng == -71.2773427875)
+    return np.select(
+        [max_apt_nums >= 10_000, max_apt_nums >= 1000],
+        [np.where(is_ecluse, 3, 10), max_apt_nums // 100],
+        max_apt_nums // 10,
+    )
+
+
 def create_disaggrregated_MURBs_table_if_not_exists():
     """
     Create a new table to hold the disaggregated MURB units, in case we every want to query them again.
@@ -324,13 +952,85 @@ def create_disaggrregated_MURBs_table_if_not_exists():
             lot_value INTEGER,
             building_value INTEGER,
             value INTEGER,
-            prev_value INTEGER
+            prev_value INTEGER,
+            murb_id TEXT
         );""")
+    # Added after the table, for databases created before
+    cursor.execute(f"""ALTER TABLE {DB_CONFIG['MURB_DISAG_TABLE_NAME']} ADD COLUMN IF NOT EXISTS murb_id TEXT;""")
+    cursor.execute(f"""CREATE INDEX IF NOT EXISTS {DB_CONFIG['MURB_DISAG_TABLE_NAME']}_murb_id_idx 
+        ON {DB_CONFIG['MURB_DISAG_TABLE_NAME']} (murb_id);""")
+    cursor.execute(f"""CREATE INDEX IF NOT EXISTS {DB_CONFIG['MURB_DISAG_TABLE_NAME']}_muni_code_idx 
+        ON {DB_CONFIG['MURB_DISAG_TABLE_NAME']} (muni_code);""")
     conn.commit()
     conn.close()
     
 
+def create_watermark_table_if_not_exists():
+    """
+    Create the table remembering which load of each municipality was last aggregated, for --incremental
+    """
+    conn = psycopg2.connect(user=DB_CONFIG['DB_USER'], password=DB_CONFIG['DB_PASSWORD'], database=DB_CONFIG['DB_NAME'])
+    cursor = conn.cursor()
+    cursor.execute(f"""
+        CREATE TABLE IF NOT EXISTS {DB_CONFIG['MURB_WATERMARK_TABLE_NAME']} (
+            muni_code TEXT PRIMARY KEY,
+            load_id TEXT,
+            aggregated_at TIMESTAMP NOT NULL
+        );""")
+    conn.commit()
+    conn.close()
+
+
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Aggregate the individually listed units of multi-unit residential buildings into single buildings."
+    )
+    parser.add_argument('-m', '--mode', choices=('sql', 'stream', 'loop'), default='sql', 
+                        help="sql aggregates every MURB with a few set-based statements in one transaction (default). "
+                             "stream reads the residential units in order and aggregates them in Python, a chunk at a time. "
+                             "loop processes the MURBs one by one, committing after each.")
+    parser.add_argument('-n', '--num-workers', type=int, default=1, 
+                        help="Number of parallel workers, each aggregating a share of the municipalities. Defaults to 1. "
+                             "Not used in loop mode.")
+    parser.add_argument('-i', '--incremental', action='store_true', 
+                        help="Only aggregate the municipalities loaded by parse_xmls.py since they were last aggregated, "
+                             "putting back the units of their previously aggregated MURBs first. Not available in loop mode.")
+    parser.add_argument('-t', '--tolerance', type=float, 
+                        help="Group the units of the same municipality whose normalized addresses match and that are "
+                             "within this many metres of each other, instead of requiring the exact same address and "
+                             "coordinates. Only available in sql mode.")
+    args = parser.parse_args()
+
+    if args.incremental and args.mode == 'loop':
+        print('Error: --incremental is not available in loop mode')
+        exit(-1)
+    if args.tolerance is not None and args.mode != 'sql':
+        print('Error: --tolerance is only available in sql mode')
+        exit(-1)
 
+    t0 = datetime.now()
     create_disaggrregated_MURBs_table_if_not_exists()
-    aggregate_murbs()
\ No newline at end of file
+    create_watermark_table_if_not_exists()
+    # The loop looks up every MURB, and the other modes filter by municipality when they split the work.
+    # A single full aggregation scans all the residential units anyway, and would only have to maintain them.
+    if args.mode == 'loop' or args.incremental or args.num_workers > 1:
+        create_stage_indexes('aggregate_murbs')
+
+    muni_codes = None
+    if args.incremental:
+        muni_codes = get_changed_munis()
+        print(f'{len(muni_codes)} municipalities changed since they were last aggregated')
+        if not muni_codes:
+            exit()
+
+    if args.num_workers > 1 and args.mode != 'loop':
+        launch_jobs(args.num_workers, mode=args.mode, muni_codes=muni_codes, restore=args.incremental, 
+                    tolerance=args.tolerance)
+    elif args.mode == 'sql':
+        aggregate_murbs_set_based(muni_codes=muni_codes, restore=args.incremental, tolerance=args.tolerance)
+    elif args.mode == 'stream':
+        aggregate_murbs_streaming(muni_codes=muni_codes, restore=args.incremental)
+    else:
+        aggregate_murbs()
+    refresh_materialized_views()
+    print(f'Finished aggregating MURBs in {datetime.now() - t0}')
\ No newline at end of file
@@ -0,0 +1,44 @@
+import psycopg2
+import argparse
+from datetime import datetime
+from dotenv import dotenv_values
+
+from aggregate_murbs import (restore_disaggregated_units, create_disaggrregated_MURBs_table_if_not_exists,
+    create_watermark_table_if_not_exists)
+from utils.materialized_views import refresh_materialized_views
+
+# Read in the database configuration from a .env file
+DB_CONFIG = dotenv_values(".env")
+
+
+def disaggregate_murbs(muni_codes=None, ids=None):
+    """
+    Undo aggregate_murbs.py: move the units of the aggregated MURBs back from the disaggregated table to the roll
+    and delete the aggregated MURBs, in a single transaction. All of them by default, or only those of the given
+    municipalities, and/or the MURBs with the given aggregated MURB (...9999) or unit IDs.
+    """
+    conn = psycopg2.connect(user=DB_CONFIG['DB_USER'], password=DB_CONFIG['DB_PASSWORD'], database=DB_CONFIG['DB_NAME'])
+    cursor = conn.cursor()
+    num_restored, num_removed = restore_disaggregated_units(cursor, muni_codes=muni_codes, ids=ids)
+    conn.commit()
+    conn.close()
+    return num_restored, num_removed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Put the units of aggregated MURBs back in the roll, in place of their aggregated entries."
+    )
+    parser.add_argument('-m', '--muni-codes', nargs='+',
+                        help="Only disaggregate the MURBs of these municipality codes, e.g. 66023")
+    parser.add_argument('-i', '--ids', nargs='+',
+                        help="Only disaggregate the MURBs with these aggregated MURB IDs (ending in 9999), "
+                             "or made of the units with these IDs")
+    args = parser.parse_args()
+
+    t0 = datetime.now()
+    create_disaggrregated_MURBs_table_if_not_exists()
+    create_watermark_table_if_not_exists()
+    disaggregate_murbs(muni_codes=args.muni_codes, ids=args.ids)
+    refresh_materialized_views()
+    print(f'Finished disaggregating MURBs in {datetime.now() - t0}')
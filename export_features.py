@@ -0,0 +1,195 @@
+import os
+import json
+import signal
+import psycopg2
+import argparse
+from pathlib import Path
+from datetime import datetime
+from collections import deque
+from dotenv import dotenv_values
+from multiprocessing import Pool
+from psycopg2.extensions import ISOLATION_LEVEL_REPEATABLE_READ
+
+from utils.flatgeobuf import FlatGeobufWriter, encode_point_features
+
+# Read in the database configuration from a .env file
+DB_CONFIG = dotenv_values(".env")
+
+FORMATS = ('geojson', 'flatgeobuf')
+
+# Properties of the features by default, the columns of the full export of the README
+DEFAULT_COLUMNS = ('id', 'muni_code', 'address', 'arrond', 'muni', 'cubf', 'const_yr', 'const_yr_real', 'num_dwelling',
+                   'lot_lin_dim', 'lot_area', 'floor_area', 'max_floors', 'phys_link', 'const_type', 'num_rental',
+                   'num_non_res', 'owner_type', 'owner_status')
+
+# Columns of the roll referring to a lookup table, exported as the label they stand for
+LOOKUP_TABLES = {
+    'phys_link': 'PHYS_LINK_TABLE_NAME',
+    'const_type': 'CONST_TYPE_TABLE_NAME',
+    'owner_status': 'OWNER_STATUS_TABLE_NAME',
+}
+
+# FlatGeobuf column types of the Postgres type OIDs, anything else is a string
+FLATGEOBUF_TYPES = {
+    16: 'Bool',
+    21: 'Short',
+    23: 'Int',
+    20: 'Long',
+    700: 'Float',
+    701: 'Double',
+    1700: 'Double',
+    1082: 'DateTime',
+}
+
+# Postgres type OIDs cast to something both formats take, numerics to doubles and dates to ISO strings
+CASTS = {1700: 'float8', 1082: 'text'}
+
+# Rows fetched from the server-side cursor and serialized at once by a worker
+BATCH_SIZE = 10000
+
+# Set in each worker by init_worker()
+FILE_FORMAT = None
+COLUMN_NAMES = None
+COLUMN_TYPES = None
+
+
+def export_features(output_file: Path, file_format='geojson', columns=DEFAULT_COLUMNS, muni_codes=None, num_workers=1):
+    """
+    Export the units with coordinates as point features, to newline-delimited GeoJSON or to FlatGeobuf.
+    Rows are streamed from a server-side cursor a batch at a time and serialized by the workers in order,
+    with a few batches in flight at most, so memory use doesn't depend on the size of the roll.
+    """
+    t0 = datetime.now()
+    conn = psycopg2.connect(user=DB_CONFIG['DB_USER'], password=DB_CONFIG['DB_PASSWORD'], database=DB_CONFIG['DB_NAME'])
+    # The number of features and their envelope in the FlatGeobuf header come from the same snapshot as the features
+    conn.set_session(isolation_level=ISOLATION_LEVEL_REPEATABLE_READ, readonly=True)
+    cursor = conn.cursor()
+    query, count_query, column_types = feature_queries(cursor, columns, muni_codes=muni_codes,
+                                                       spatial_order=file_format == 'flatgeobuf')
+    params = {'muni_codes': muni_codes}
+
+    if file_format == 'flatgeobuf':
+        cursor.execute(count_query, params)
+        num_features, *envelope = cursor.fetchone()
+        writer = FlatGeobufWriter(output_file, DB_CONFIG['ROLL_TABLE_NAME'],
+                                  [(name, FLATGEOBUF_TYPES.get(type_code, 'String')) for name, type_code in column_types],
+                                  num_features, envelope=envelope if num_features else None)
+    else:
+        writer = GeoJSONSeqWriter(output_file)
+
+    feature_cursor = conn.cursor('features')
+    feature_cursor.execute(query, params)
+    num_written = 0
+    with writer, Pool(processes=num_workers, initializer=init_worker,
+                      initargs=(file_format, column_types)) as pool:
+        pending = deque()
+        for rows in iter(lambda: feature_cursor.fetchmany(BATCH_SIZE), []):
+            pending.append(pool.apply_async(serialize_batch, (rows,)))
+            num_written += len(rows)
+            # Fetching waits for the oldest batch to be written once every worker has a couple queued
+            if len(pending) >= 2 * num_workers:
+                writer.write_batch(*pending.popleft().get())
+        while pending:
+            writer.write_batch(*pending.popleft().get())
+    conn.close()
+    print(f'Exported {num_written} features to {output_file} in {datetime.now() - t0}')
+    return num_written
+
+
+def feature_queries(cursor, columns, muni_codes=None, spatial_order=False):
+    """
+    The query of the features, (lng, lat, *columns) rows with the lookup columns resolved to their labels,
+    only those of the %(muni_codes)s parameter if muni_codes is given, and the query of their number and envelope.
+    Also returns the (name, type OID) of each exported column.
+    """
+    cursor.execute(f"SELECT * FROM {DB_CONFIG['ROLL_TABLE_NAME']} LIMIT 0")
+    roll_columns = [column.name for column in cursor.description]
+    unknown_columns = [column for column in columns if column not in roll_columns]
+    if unknown_columns:
+        raise ValueError(f"Not columns of {DB_CONFIG['ROLL_TABLE_NAME']}: {', '.join(unknown_columns)}")
+
+    expressions = {column: f'{column}.value' if column in LOOKUP_TABLES else f'r.{column}' for column in columns}
+    joins = ''.join(f"\n        LEFT JOIN {DB_CONFIG[LOOKUP_TABLES[column]]} {column} ON r.{column} = {column}.id"
+                    for column in columns if column in LOOKUP_TABLES)
+    from_where = f"""FROM {DB_CONFIG['ROLL_TABLE_NAME']} r{joins}
+        WHERE r.lat IS NOT NULL AND r.lng IS NOT NULL
+            {'AND r.muni_code = ANY(%(muni_codes)s)' if muni_codes is not None else ''}"""
+
+    cursor.execute(f"""SELECT {', '.join(f'{expression} AS {column}' for column, expression in expressions.items())}
+        {from_where} LIMIT 0""", {'muni_codes': muni_codes})
+    type_codes = [column.type_code for column in cursor.description]
+    column_types = list(zip(columns, type_codes))
+
+    selected = ', '.join(f'{expression}::{CASTS[type_code]} AS {column}' if type_code in CASTS else f'{expression} AS {column}'
+                         for (column, expression), type_code in zip(expressions.items(), type_codes))
+    # Nearby units next to each other, so the FlatGeobuf index packs them in the same nodes
+    order_by = '\n        ORDER BY r.geohash_7' if spatial_order else ''
+    query = f"SELECT r.lng::float8, r.lat::float8, {selected}\n        {from_where}{order_by}"
+    count_query = f"""SELECT count(*), min(r.lng)::float8, min(r.lat)::float8, max(r.lng)::float8, max(r.lat)::float8
+        {from_where}"""
+    return query, count_query, column_types
+
+
+def init_worker(file_format, column_types):
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    global FILE_FORMAT, COLUMN_NAMES, COLUMN_TYPES
+    FILE_FORMAT = file_format
+    COLUMN_NAMES = [name for name, _ in column_types]
+    COLUMN_TYPES = [FLATGEOBUF_TYPES.get(type_code, 'String') for _, type_code in column_types]
+
+
+def serialize_batch(rows):
+    """
+    Worker serializing a batch of (lng, lat, *columns) rows, returns the arguments of the writer's write_batch()
+    """
+    if FILE_FORMAT == 'flatgeobuf':
+        return encode_point_features(COLUMN_TYPES, rows)
+
+    lines = [json.dumps({
+        'type': 'Feature',
+        'geometry': {'type': 'Point', 'coordinates': [lng, lat]},
+        'properties': dict(zip(COLUMN_NAMES, values)),
+    }, ensure_ascii=False, separators=(',', ':')) for lng, lat, *values in rows]
+    return ''.join(line + '\n' for line in lines).encode(), None
+
+
+class GeoJSONSeqWriter:
+    """
+    Newline-delimited GeoJSON, one feature per line
+    """
+
+    def __init__(self, path: Path):
+        self.file = open(path, 'wb')
+
+    def write_batch(self, data, leaves=None):
+        self.file.write(data)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.file.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Export the units with coordinates as point features, to newline-delimited GeoJSON or FlatGeobuf."
+    )
+    parser.add_argument('output_file', type=Path,
+                        help="Path of the exported file, FlatGeobuf if it ends in .fgb and GeoJSON otherwise "
+                             "unless --format is given")
+    parser.add_argument('-f', '--format', choices=FORMATS,
+                        help="geojson: one GeoJSON feature per line, flatgeobuf: FlatGeobuf with a spatial index")
+    parser.add_argument('-c', '--columns', nargs='+', default=DEFAULT_COLUMNS,
+                        help="Columns of the roll exported as the properties of the features. "
+                             "Defaults to those of the full CSV export.")
+    parser.add_argument('-m', '--muni-codes', nargs='+',
+                        help="Only export the units of these municipality codes, e.g. 66023")
+    parser.add_argument('-n', '--num-workers', type=int, default=os.cpu_count()-1,
+                        help="Number of parallel workers serializing the features. "
+                             "Defaults to one less than the number of CPUs on the machine.")
+    args = parser.parse_args()
+
+    file_format = args.format or ('flatgeobuf' if args.output_file.suffix == '.fgb' else 'geojson')
+    export_features(args.output_file, file_format=file_format, columns=args.columns, muni_codes=args.muni_codes,
+                    num_workers=max(args.num_workers, 1))
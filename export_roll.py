@@ -0,0 +1,310 @@
+import io
+import os
+import csv
+import gzip
+import heapq
+import shutil
+import signal
+import psycopg2
+import argparse
+import threading
+import numpy as np
+from pathlib import Path
+from datetime import datetime
+from typing import NamedTuple, Optional
+from dotenv import dotenv_values
+from multiprocessing import Pool
+
+from utils.indexes import create_stage_indexes
+
+# Read in the database configuration from a .env file
+DB_CONFIG = dotenv_values(".env")
+
+
+class ExportPreset(NamedTuple):
+    # Columns of the SELECT, over the roll r and the lookup tables pl, ct and os
+    columns: str
+    where: Optional[str] = None
+    # Numeric output column the rows are ordered by, within each shard and when merging the shards.
+    # Without one, the shards follow each other in municipality code order.
+    order_by: Optional[str] = None
+    descending: bool = False
+
+
+EXPORT_COLUMNS = """r.id, lat, lng, muni_code as "geographic code", address, arrond as "borough", muni as "city",
+    cubf as "CUBF", const_yr as "vintage", const_yr_real as "vintage (real or est.)", num_dwelling as "num dwellings",
+    {floor_columns}, pl.value as "physical connection", ct.value as "const typology",
+    num_rental as "num rental units", num_non_res as "num non-res units", owner_type as "owner type",
+    os.value as "onwer status\""""
+
+# The two exports of the README
+PRESETS = {
+    'murbs': ExportPreset(
+        EXPORT_COLUMNS.format(floor_columns="""max_floors as "num floors", lot_lin_dim as "lot lin dim",
+    lot_area as "lot area", floor_area as "floor area\""""),
+        where='cubf = 1000 AND num_dwelling >= 3',
+        order_by='num dwellings',
+        descending=True,
+    ),
+    'full': ExportPreset(
+        EXPORT_COLUMNS.format(floor_columns="""lot_lin_dim as "lot lin dim", lot_area as "lot area",
+    floor_area as "floor area", max_floors as "num floors\""""),
+    ),
+}
+
+FORMATS = ('csv', 'parquet')
+
+# Arrow types of the Postgres type OIDs of the roll's columns, anything else is read as a string
+PARQUET_TYPES = {
+    21: 'int16',
+    23: 'int32',
+    20: 'int64',
+    700: 'float32',
+    701: 'float64',
+    1700: 'float64',
+    1082: 'date32',
+    16: 'bool_',
+}
+
+
+def export_roll(preset, output_dir: Path, file_format='csv', num_workers=1, num_shards=None, merge=False):
+    """
+    Export the roll with one of the PRESETS as compressed shards, each covering a range of municipality codes
+    with about the same number of units, COPYed in parallel over one connection per worker.
+    Returns the paths of the shards, or of the merged file if merge is set.
+    """
+    t0 = datetime.now()
+    create_stage_indexes('export')
+    output_dir.mkdir(parents=True, exist_ok=True)
+
+    muni_ranges = split_munis_into_ranges(preset, num_shards or num_workers)
+    extension = 'csv.gz' if file_format == 'csv' else 'parquet'
+    jobs = [(preset, file_format, first_muni, last_muni, output_dir / f'{preset}_{i:03d}.{extension}')
+            for i, (first_muni, last_muni) in enumerate(muni_ranges)]
+    if not jobs:
+        print(f'Nothing to export for {preset}')
+        return []
+
+    with Pool(processes=min(num_workers, len(jobs))) as pool:
+        num_rows = pool.starmap(export_shard, jobs)
+    paths = [job[-1] for job in jobs]
+    print(f'Exported {sum(num_rows)} rows to {len(paths)} shards in {datetime.now() - t0}')
+
+    if merge:
+        t1 = datetime.now()
+        merged_path = output_dir / f'{preset}.{extension}'
+        spec = PRESETS[preset]
+        if file_format == 'csv':
+            merge_csv_shards(paths, merged_path, order_by=spec.order_by, descending=spec.descending)
+        else:
+            merge_parquet_shards(paths, merged_path, order_by=spec.order_by, descending=spec.descending)
+        for path in paths:
+            path.unlink()
+        print(f'Merged the shards into {merged_path} in {datetime.now() - t1}')
+        paths = [merged_path]
+    return paths
+
+
+def split_munis_into_ranges(preset, num_shards):
+    """
+    Split the municipality codes, in order, into at most num_shards contiguous ranges
+    with about the same number of exported units each
+    """
+    where = PRESETS[preset].where
+    conn = psycopg2.connect(user=DB_CONFIG['DB_USER'], password=DB_CONFIG['DB_PASSWORD'], database=DB_CONFIG['DB_NAME'])
+    cursor = conn.cursor()
+    cursor.execute(f"""SELECT muni_code, count(*) FROM {DB_CONFIG['ROLL_TABLE_NAME']}
+        {f'WHERE {where}' if where else ''} GROUP BY muni_code ORDER BY muni_code""")
+    units_per_muni = cursor.fetchall()
+    conn.close()
+
+    # Each municipality goes to the shard its midpoint falls in, so the cuts are as close as possible to even
+    total_units = sum(num_units for _, num_units in units_per_muni)
+    ranges = {}
+    num_units_before = 0
+    for muni_code, num_units in units_per_muni:
+        shard = int((num_units_before + num_units / 2) * num_shards / total_units)
+        first_muni, _ = ranges.get(shard, (muni_code, None))
+        ranges[shard] = (first_muni, muni_code)
+        num_units_before += num_units
+    ranges = list(ranges.values())
+    return ranges
+
+
+def shard_query(cursor, preset, first_muni, last_muni):
+    """
+    The SELECT of one shard of the preset, with the municipality range bound in
+    """
+    spec = PRESETS[preset]
+    where = 'muni_code BETWEEN %(first_muni)s AND %(last_muni)s'
+    if spec.where:
+        where += f' AND {spec.where}'
+    order_by = f' ORDER BY "{spec.order_by}"{" DESC" if spec.descending else ""}' if spec.order_by else ''
+    query = f"""SELECT {spec.columns}
+        FROM {DB_CONFIG['ROLL_TABLE_NAME']} r
+        LEFT JOIN {DB_CONFIG['PHYS_LINK_TABLE_NAME']} pl ON r.phys_link = pl.id
+        LEFT JOIN {DB_CONFIG['CONST_TYPE_TABLE_NAME']} ct ON r.const_type = ct.id
+        LEFT JOIN {DB_CONFIG['OWNER_STATUS_TABLE_NAME']} os ON r.owner_status = os.id
+        WHERE {where}{order_by}"""
+    # COPY doesn't take parameters, so they are bound client side
+    return cursor.mogrify(query, {'first_muni': first_muni, 'last_muni': last_muni}).decode()
+
+
+def export_shard(preset, file_format, first_muni, last_muni, path: Path):
+    """
+    Worker COPYing the units of a range of municipalities to a shard over its own connection
+    """
+    pid = os.getpid()
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    conn = psycopg2.connect(user=DB_CONFIG['DB_USER'], password=DB_CONFIG['DB_PASSWORD'], database=DB_CONFIG['DB_NAME'])
+    cursor = conn.cursor()
+    t0 = datetime.now()
+    query = shard_query(cursor, preset, first_muni, last_muni)
+    if file_format == 'csv':
+        with gzip.open(path, 'wb', compresslevel=6) as f:
+            cursor.copy_expert(f"COPY ({query}) TO STDOUT WITH CSV HEADER", f)
+    else:
+        write_parquet_shard(cursor, query, path)
+    num_rows = cursor.rowcount
+    conn.close()
+    print(f'{pid}:\tExported {num_rows} units of {first_muni} to {last_muni} to {path.name} in {datetime.now() - t0}')
+    return num_rows
+
+
+def write_parquet_shard(cursor, query, path: Path):
+    """
+    Stream the CSV COPY of the query into a zstd compressed Parquet file, a batch at a time,
+    with the column types of the query rather than those guessed from the CSV
+    """
+    # Only needed for Parquet exports
+    import pyarrow as pa
+    import pyarrow.csv as pa_csv
+    import pyarrow.parquet as pq
+
+    cursor.execute(f"SELECT * FROM ({query}) q LIMIT 0")
+    column_types = {column.name: getattr(pa, PARQUET_TYPES.get(column.type_code, 'string'))()
+                    for column in cursor.description}
+
+    # COPY writes into one end of a pipe from a thread while Arrow parses the other end
+    read_fd, write_fd = os.pipe()
+    copy_errors = []
+
+    def copy_to_pipe():
+        try:
+            with open(write_fd, 'wb') as f:
+                cursor.copy_expert(f"COPY ({query}) TO STDOUT WITH CSV HEADER", f)
+        except Exception as e:
+            copy_errors.append(e)
+
+    copy_thread = threading.Thread(target=copy_to_pipe)
+    copy_thread.start()
+    try:
+        with open(read_fd, 'rb') as f:
+            # COPY writes NULLs unquoted and empty strings quoted
+            convert_options = pa_csv.ConvertOptions(column_types=column_types, strings_can_be_null=True,
+                                                    quoted_strings_can_be_null=False)
+            reader = pa_csv.open_csv(f, convert_options=convert_options)
+            with pq.ParquetWriter(path, reader.schema, compression='zstd') as writer:
+                for batch in reader:
+                    writer.write_batch(batch)
+    finally:
+        copy_thread.join()
+    if copy_errors:
+        raise copy_errors[0]
+
+
+def merge_csv_shards(paths, merged_path: Path, order_by=None, descending=False):
+    """
+    Merge the gzipped CSV shards into one, keeping only the header of the first. If the shards are ordered,
+    their rows are merged on the order_by column, one row per shard in memory, otherwise they are concatenated.
+    """
+    with gzip.open(merged_path, 'wb', compresslevel=6) as merged:
+        if order_by is None:
+            for i, path in enumerate(paths):
+                with gzip.open(path, 'rb') as shard:
+                    header = shard.readline()
+                    if i == 0:
+                        merged.write(header)
+                    shutil.copyfileobj(shard, merged, 1024 * 1024)
+            return
+
+        shards = [io.TextIOWrapper(gzip.open(path, 'rb'), encoding='utf-8', newline='') for path in paths]
+        try:
+            header = shards[0].readline()
+            for shard in shards[1:]:
+                shard.readline()
+            key_index = next(csv.reader([header])).index(order_by)
+            merged.write(header.encode())
+            # The records are copied as COPY wrote them, only parsed for their sort key. The merge is stable,
+            # so records with the same key keep the order of the shards.
+            records = heapq.merge(*(_csv_records(shard, key_index) for shard in shards),
+                                  key=lambda record: record[0], reverse=descending)
+            for _, record in records:
+                merged.write(record.encode())
+        finally:
+            for shard in shards:
+                shard.close()
+
+
+def _csv_records(shard, key_index):
+    """
+    The (sort key, record) of each record of a CSV shard, NULLs first in descending order and last otherwise
+    like in Postgres. Records with quoted line breaks span several lines.
+    """
+    for line in shard:
+        # Quotes inside quoted fields are doubled, so an odd number of them means the record goes on
+        while line.count('"') % 2:
+            line += next(shard)
+        value = next(csv.reader([line]))[key_index]
+        yield (value == '', float(value) if value else 0.0), line
+
+
+def merge_parquet_shards(paths, merged_path: Path, order_by=None, descending=False):
+    """
+    Merge the Parquet shards into one file. Without an order, their row groups are copied one at a time.
+    Ordered shards are read whole and sorted on the order_by column, which only the MURBs need.
+    """
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.parquet as pq
+
+    with pq.ParquetWriter(merged_path, pq.read_schema(paths[0]), compression='zstd') as writer:
+        if order_by is None:
+            for path in paths:
+                shard = pq.ParquetFile(path)
+                for i in range(shard.num_row_groups):
+                    writer.write_table(shard.read_row_group(i))
+            return
+
+        table = pa.concat_tables(pq.read_table(path) for path in paths)
+        keys = table.column(order_by)
+        is_null = pc.is_null(keys).to_numpy(zero_copy_only=False)
+        values = pc.fill_null(keys.cast(pa.float64()), 0.0).to_numpy()
+        # NULLs first in descending order and last otherwise, like in Postgres. The sort is stable,
+        # so rows with the same key keep the order of the shards.
+        order = np.lexsort((-values, ~is_null) if descending else (values, is_null))
+        writer.write_table(table.take(order))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Export the roll with one of the preset queries to compressed CSV or Parquet shards, in parallel."
+    )
+    parser.add_argument('preset', choices=list(PRESETS),
+                        help="murbs: the residential units with 3 dwellings or more, full: all the evaluation units")
+    parser.add_argument('-o', '--output-dir', type=Path, default=Path('.'),
+                        help="Directory the shards are written to. Defaults to the current directory.")
+    parser.add_argument('-f', '--format', choices=FORMATS, default='csv',
+                        help="csv: gzipped CSV with a header, parquet: zstd compressed Parquet (needs pyarrow)")
+    parser.add_argument('-n', '--num-workers', type=int, default=os.cpu_count()-1,
+                        help="Number of parallel workers. Defaults to one less than the number of CPUs on the machine.")
+    parser.add_argument('-s', '--num-shards', type=int,
+                        help="Number of municipality ranges the export is split into. Defaults to the number of workers.")
+    parser.add_argument('--merge', action='store_true',
+                        help="Merge the shards into a single file once they are all written.")
+    args = parser.parse_args()
+
+    num_workers = max(args.num_workers, 1)
+    export_roll(args.preset, args.output_dir, file_format=args.format, num_workers=num_workers,
+                num_shards=args.num_shards, merge=args.merge)
@@ -0,0 +1,173 @@
+import os
+import json
+import signal
+import psycopg2
+import argparse
+from datetime import datetime
+from dotenv import dotenv_values
+from multiprocessing import Pool
+
+from utils.compact_schema import storage_table_name
+from utils.indexes import STAGE_INDEXES, CLUSTERED_INDEXES, create_index_statement, index_name, stage_index_names
+from utils.materialized_views import create_materialized_views
+
+# Read in the database configuration from a .env file
+DB_CONFIG = dotenv_values(".env")
+
+# Scans of a range of the roll, timed before and after clustering it
+RANGE_SCAN_QUERIES = {
+    'municipality': """SELECT count(*), sum(value) FROM {table} WHERE muni_code = %(muni_code)s""",
+    'geohash_5 cell': """SELECT count(*), sum(value) FROM {table} WHERE geohash_7 BETWEEN %(cell_min)s AND %(cell_max)s""",
+    'bounding box': """SELECT count(*), sum(value) FROM {table} 
+        WHERE lat BETWEEN %(lat_min)s AND %(lat_max)s AND lng BETWEEN %(lng_min)s AND %(lng_max)s""",
+}
+
+# Half the side of the bounding box, in degrees, about 1km x 1.5km
+BOUNDING_BOX_HALF_SIDE = 0.005
+
+
+def finalize(stages=None, num_workers=1, cluster=False):
+    """
+    Build the indexes the given stages need (all of them by default) in parallel,
+    then ANALYZE the tables and create (or refresh) the materialized views, timing each step.
+    If cluster is set, the roll is first rewritten in (muni_code, geohash_7) order, and gets BRIN indexes.
+    """
+    t0 = datetime.now()
+    if cluster:
+        benchmark_params, timings_before = cluster_roll()
+    names = stage_index_names(stages or STAGE_INDEXES)
+    if cluster:
+        names += CLUSTERED_INDEXES
+    # Plain CREATE INDEX only blocks writes, so several can be built on the same table at once
+    with Pool(processes=min(num_workers, len(names))) as pool:
+        pool.map(build_index, names)
+    print(f'Built {len(names)} indexes in {datetime.now() - t0}')
+
+    conn = psycopg2.connect(user=DB_CONFIG['DB_USER'], password=DB_CONFIG['DB_PASSWORD'], database=DB_CONFIG['DB_NAME'])
+    conn.autocommit = True
+    cursor = conn.cursor()
+    tables = [storage_table_name(cursor)]
+    cursor.execute("SELECT to_regclass(%s) IS NOT NULL", (DB_CONFIG['MURB_DISAG_TABLE_NAME'],))
+    if cursor.fetchone()[0]:
+        tables.append(DB_CONFIG['MURB_DISAG_TABLE_NAME'])
+    for table_name in tables:
+        t1 = datetime.now()
+        cursor.execute(f"ANALYZE {table_name}")
+        print(f'Analyzed {table_name} in {datetime.now() - t1}')
+    if cluster and benchmark_params is not None:
+        timings_after = benchmark_range_scans(cursor, benchmark_params)
+        print(f'\n{"":<30}{"before (ms)":>14}{"after (ms)":>14}{"before (pages)":>16}{"after (pages)":>16}')
+        for name in RANGE_SCAN_QUERIES:
+            (ms_before, pages_before), (ms_after, pages_after) = timings_before[name], timings_after[name]
+            print(f'{name:<30}{ms_before:>14.1f}{ms_after:>14.1f}{pages_before:>16}{pages_after:>16}')
+    conn.close()
+    create_materialized_views()
+    print(f'Finalized in {datetime.now() - t0}')
+
+
+def cluster_roll():
+    """
+    Rewrite the roll ordered by (muni_code, geohash_7), so the units of a municipality or of a small area
+    are on a few contiguous pages. Its range scans are timed first, and the parameters returned to time them after.
+    """
+    conn = psycopg2.connect(user=DB_CONFIG['DB_USER'], password=DB_CONFIG['DB_PASSWORD'], database=DB_CONFIG['DB_NAME'])
+    conn.autocommit = True
+    cursor = conn.cursor()
+    table_name = storage_table_name(cursor)
+
+    params = get_benchmark_params(cursor)
+    timings = benchmark_range_scans(cursor, params) if params is not None else None
+
+    # CLUSTER needs a btree in the wanted order, dropped after since the BRIN indexes cover the same ranges
+    t0 = datetime.now()
+    cursor.execute(create_index_statement(cursor, 'cluster_order'))
+    cursor.execute(f"CLUSTER {table_name} USING {index_name('cluster_order')}")
+    cursor.execute(f"DROP INDEX {index_name('cluster_order')}")
+    cursor.execute(f"ANALYZE {table_name}")
+    print(f'Clustered {table_name} in {datetime.now() - t0}')
+    conn.close()
+    return params, timings
+
+
+def get_benchmark_params(cursor):
+    """
+    The median municipality by number of units, and the most populated geohash_5 cell and a box at its centre.
+    None if the roll has no units with coordinates, there is nothing to benchmark then.
+    """
+    cursor.execute(f"""
+        SELECT muni_code FROM (
+            SELECT muni_code, row_number() OVER (ORDER BY count(*)) AS rank, count(*) OVER () AS num_munis
+            FROM {DB_CONFIG['ROLL_TABLE_NAME']} GROUP BY muni_code
+        ) m
+        WHERE rank = (num_munis + 1) / 2""")
+    median_muni = cursor.fetchone()
+    cursor.execute(f"""
+        SELECT geohash_5, avg(lat)::float8, avg(lng)::float8 FROM {DB_CONFIG['ROLL_TABLE_NAME']} 
+        WHERE geohash_5 IS NOT NULL GROUP BY geohash_5 ORDER BY count(*) DESC LIMIT 1""")
+    densest_cell = cursor.fetchone()
+    if median_muni is None or densest_cell is None:
+        print('Skipping the range scan benchmark, the roll has no units with coordinates')
+        return None
+
+    muni_code, = median_muni
+    cell, lat, lng = densest_cell
+    # geohash_7 cells are geohash_5 cells followed by 10 more bits
+    return {
+        'muni_code': muni_code,
+        'cell_min': cell << 10,
+        'cell_max': (cell << 10) | 1023,
+        'lat_min': lat - BOUNDING_BOX_HALF_SIDE,
+        'lat_max': lat + BOUNDING_BOX_HALF_SIDE,
+        'lng_min': lng - BOUNDING_BOX_HALF_SIDE,
+        'lng_max': lng + BOUNDING_BOX_HALF_SIDE,
+    }
+
+
+def benchmark_range_scans(cursor, params):
+    """
+    Time of each range scan, and number of pages it touched, after a first run to warm the cache
+    """
+    timings = {}
+    for name, query in RANGE_SCAN_QUERIES.items():
+        query = query.format(table=DB_CONFIG['ROLL_TABLE_NAME'])
+        cursor.execute(query, params)
+        cursor.fetchall()
+        cursor.execute(f"EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) {query}", params)
+        plan = cursor.fetchone()[0]
+        if isinstance(plan, str):
+            plan = json.loads(plan)
+        num_pages = plan[0]['Plan']['Shared Hit Blocks'] + plan[0]['Plan']['Shared Read Blocks']
+        timings[name] = (plan[0]['Execution Time'], num_pages)
+    return timings
+
+
+def build_index(name):
+    """
+    Worker building one index over its own connection
+    """
+    pid = os.getpid()
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    conn = psycopg2.connect(user=DB_CONFIG['DB_USER'], password=DB_CONFIG['DB_PASSWORD'], database=DB_CONFIG['DB_NAME'])
+    cursor = conn.cursor()
+    t0 = datetime.now()
+    cursor.execute(create_index_statement(cursor, name))
+    conn.commit()
+    conn.close()
+    print(f'{pid}:\tBuilt {index_name(name)} in {datetime.now() - t0}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Build the indexes of the roll needed by the later stages of the pipeline, and ANALYZE it."
+    )
+    parser.add_argument('-s', '--stages', nargs='+', choices=list(STAGE_INDEXES),
+                        help="Only build the indexes of these stages. Defaults to all of them.")
+    parser.add_argument('-n', '--num-workers', type=int, default=os.cpu_count()-1,
+                        help="Number of indexes built at once. Defaults to one less than the number of CPUs on the machine.")
+    parser.add_argument('--cluster', action='store_true',
+                        help="First rewrite the roll ordered by municipality and geohash cell, add BRIN indexes on those, "
+                             "and compare the time of a few range scans before and after. Locks the roll while rewriting it.")
+    args = parser.parse_args()
+
+    finalize(stages=args.stages, num_workers=max(args.num_workers, 1), cluster=args.cluster)
@@ -1,14 +1,239 @@
+import io
+import os
+import signal
 import argparse
+import numpy as np
 import psycopg2
 import shapefile
 from pathlib import Path
 from datetime import datetime
 from dotenv import dotenv_values
+from multiprocessing import Pool
+
+from utils.coord_index import CoordinateIndex
+from utils.compact_schema import create_compact_schema_if_not_exists, is_compact, storage_table_name
+from utils.shp_points import read_point_shapefile, count_records
+from utils.geohash import CELL_COLUMNS, geohash_all_precisions
+from utils.indexes import create_stage_indexes
+from utils.materialized_views import refresh_materialized_views
 
 # Read in the database configuration from a .env file
 DB_CONFIG = dotenv_values(".env")
 
-def parse_shapefile(shp_file):
+# Number of coordinates buffered in memory before being sent with COPY
+COPY_CHUNK_SIZE = 100_000
+
+
+def parse_shapefile(shp_file, index_dir=None, num_workers=1):
+    """
+    Load the coordinates of every unit in the shapefile into the roll table.
+    The coordinates are streamed with COPY into a temporary table, and applied
+    with a single joined UPDATE, instead of one UPDATE statement per unit.
+    With multiple workers, the records are split in contiguous ranges that
+    each worker decodes and applies over its own connection.
+    """
+    if num_workers > 1:
+        return launch_jobs(shp_file, num_workers, index_dir=index_dir)
+
+    conn = psycopg2.connect(user=DB_CONFIG['DB_USER'], password=DB_CONFIG['DB_PASSWORD'], database=DB_CONFIG['DB_NAME'])
+    cursor = conn.cursor()
+
+    coord_index = get_coord_index(shp_file, index_dir)
+    num_updated = update_coordinates_from_index(cursor, coord_index, DB_CONFIG['ROLL_TABLE_NAME'])
+
+    conn.commit()
+    conn.close()
+    print(f'Updated coordinates of {num_updated} units')
+
+
+def launch_jobs(shp_file, num_workers, index_dir=None):
+
+    # Build the persisted index first if needed, so the workers only have to map it
+    if index_dir:
+        coord_index = get_coord_index(shp_file, index_dir)
+        num_units = len(coord_index)
+    else:
+        num_units = count_records(shp_file)
+        print(f'Shapefile contains {num_units} units')
+
+    ranges = split_records_between_workers(num_units, num_workers)
+    jobs = [(shp_file, index_dir, start, stop) for start, stop in ranges]
+
+    with Pool(processes=num_workers) as pool:
+        results = pool.map(parse_shapefile_range, jobs)
+
+    num_copied = sum(copied for copied, _ in results)
+    num_updated = sum(updated for _, updated in results)
+    print(f'Copied {num_copied} coordinates, per worker: {[copied for copied, _ in results]}')
+    print(f'Updated coordinates of {num_updated} units')
+
+
+def split_records_between_workers(num_units, num_workers):
+    """
+    Split [0, num_units) into contiguous record ranges of about the same size
+    """
+    bounds = np.linspace(0, num_units, num_workers + 1).astype(int).tolist()
+    return [(start, stop) for start, stop in zip(bounds[:-1], bounds[1:]) if stop > start]
+
+
+def parse_shapefile_range(job):
+    """
+    Worker decoding a range of shapefile records (or of the persisted index)
+    and applying their coordinates to the roll over its own connection.
+    """
+    shp_file, index_dir, start, stop = job
+    pid = os.getpid()
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    t0 = datetime.now()
+    if index_dir:
+        # The index is memory-mapped, slicing it doesn't copy anything
+        coord_index = CoordinateIndex.load(index_dir)
+        ids, lat, lng = coord_index.ids[start:stop], coord_index.lat[start:stop], coord_index.lng[start:stop]
+    else:
+        ids, lng, lat = read_point_shapefile(shp_file, start=start, stop=stop)
+    print(f'{pid}:\tDecoded records {start} to {stop} in {datetime.now() - t0}')
+
+    conn = psycopg2.connect(user=DB_CONFIG['DB_USER'], password=DB_CONFIG['DB_PASSWORD'], database=DB_CONFIG['DB_NAME'])
+    cursor = conn.cursor()
+
+    num_copied = copy_coordinates_to_temp_table(cursor, coordinate_rows(ids, lat, lng), log_prefix=f'{pid}:')
+    num_updated = apply_temp_coordinates(cursor, DB_CONFIG['ROLL_TABLE_NAME'])
+    conn.commit()
+    conn.close()
+
+    print(f'{pid}:\tUpdated {num_updated} units from records {start} to {stop} in {datetime.now() - t0}')
+    return num_copied, num_updated
+
+
+def get_coord_index(shp_file, index_dir=None):
+    """
+    Get the ID -> coordinates index of the shapefile. If an index directory is given,
+    the index is persisted there and memory-mapped, so later runs don't re-read the shapefile.
+    """
+    # We don't need to transform the coordinates, the point  
+    # has lat/lng in NAD83 which is compatbile with WSG84.
+    # In QGIS, changing the CRS from NAD83 to WDG84 performs the EPSG-1188 
+    # transformation, which we see here https://epsg.io/1188 is a noop.
+    # More reading:
+    # https://gis.stackexchange.com/questions/304231/converting-nad83-epsg4269-to-wgs84-epsg4326-using-pyproj
+    # https://help.arcgis.com/en/arcgisdesktop/10.0/help/index.html#/Datums/003r00000008000000/
+    # https://help.arcgis.com/en/arcgisdesktop/10.0/help/index.html#/North_American_datums/003r00000009000000/
+    if index_dir:
+        coord_index = CoordinateIndex.load_or_build(shp_file, index_dir)
+    else:
+        coord_index = CoordinateIndex.from_shapefile(shp_file)
+    print(f'Shapefile contains {len(coord_index)} units')
+    return coord_index
+
+
+def update_coordinates_from_index(cursor, coord_index, table_name, ids=None):
+    """
+    Stream coordinates from the index into a temporary table and update the
+    matching IDs of the given table in one statement. Returns the number of rows updated.
+    If ids are given, only those are looked up and sent, otherwise the whole index is.
+    The caller is responsible for committing.
+    """
+    if ids is None:
+        # The ID field is globally unique for evaluation units
+        ids, lat, lng = coord_index.ids, coord_index.lat, coord_index.lng
+    else:
+        found, lat, lng = coord_index.lookup(ids)
+        ids = np.asarray(ids, dtype=coord_index.ids.dtype)[found]
+        lat, lng = lat[found], lng[found]
+
+    copy_coordinates_to_temp_table(cursor, coordinate_rows(ids, lat, lng))
+    return apply_temp_coordinates(cursor, table_name, with_cells=(table_name == DB_CONFIG['ROLL_TABLE_NAME']))
+
+
+def coordinate_rows(ids, lat, lng):
+    """
+    The (id, lat, lng, *geohash cells) rows sent to shp_coords, with the cells computed for the whole batch at once
+    """
+    cells = geohash_all_precisions(lat, lng)
+    columns = [ids.astype(str).tolist(), lat.tolist(), lng.tolist()]
+    columns += [cells[column].tolist() for column in CELL_COLUMNS]
+    return zip(*columns)
+
+
+def copy_coordinates_to_temp_table(cursor, coordinates, log_prefix=''):
+    """
+    Create the shp_coords temporary table and COPY the (id, lat, lng, *cells) tuples into it, 
+    in chunks so we never hold the whole shapefile in memory.
+    """
+    cell_columns = ''.join(f',\n            {column} BIGINT NOT NULL' for column in CELL_COLUMNS)
+    cursor.execute(f"""
+        CREATE TEMPORARY TABLE IF NOT EXISTS shp_coords (
+            id TEXT NOT NULL,
+            lat DOUBLE PRECISION NOT NULL,
+            lng DOUBLE PRECISION NOT NULL{cell_columns}
+        ) ON COMMIT DROP;""")
+
+    buffer = io.StringIO()
+    num_buffered = 0
+    num_copied = 0
+
+    for id, lat, lng, *cells in coordinates:
+        # repr() keeps the full float precision
+        buffer.write(f'{id}\t{lat!r}\t{lng!r}')
+        for cell in cells:
+            buffer.write(f'\t{cell}')
+        buffer.write('\n')
+        num_buffered += 1
+
+        if num_buffered == COPY_CHUNK_SIZE:
+            num_copied += _flush_copy_buffer(cursor, buffer)
+            print(f'{log_prefix}\tCopied {num_copied} coordinates')
+            buffer = io.StringIO()
+            num_buffered = 0
+
+    num_copied += _flush_copy_buffer(cursor, buffer)
+    print(f'{log_prefix}\tCopied {num_copied} coordinates')
+
+    # Give the planner real row counts for the join
+    cursor.execute("ANALYZE shp_coords;")
+    return num_copied
+
+
+def _flush_copy_buffer(cursor, buffer):
+    buffer.seek(0)
+    cursor.copy_expert(f"COPY shp_coords (id, lat, lng, {', '.join(CELL_COLUMNS)}) FROM STDIN", buffer)
+    return cursor.rowcount
+
+
+def apply_temp_coordinates(cursor, table_name, with_cells=True):
+    """
+    Update the coordinates of all rows of the table having an ID in shp_coords,
+    and their geohash cells unless the table doesn't have them (e.g. the MURB table).
+    The geography point of --geography moves along with the coordinates, if the table has one.
+    """
+    cell_updates = ''.join(f',\n            {column} = c.{column}' for column in CELL_COLUMNS) if with_cells else ''
+    # Bypass the compatibility view's row by row trigger with the compact schema
+    table_name = storage_table_name(cursor, table_name)
+    if has_geography_column(cursor, table_name):
+        cell_updates += ',\n            geog = ST_SetSRID(ST_MakePoint(c.lng, c.lat), 4326)::geography'
+    cursor.execute(f"""
+        UPDATE {table_name} t
+        SET
+            lat = c.lat,
+            lng = c.lng{cell_updates}
+        FROM shp_coords c
+        WHERE t.id = c.id
+    """)
+    return cursor.rowcount
+
+
+def has_geography_column(cursor, table_name):
+    cursor.execute("""SELECT EXISTS (SELECT 1 FROM pg_attribute WHERE attrelid = to_regclass(%s)
+        AND attname = 'geog' AND NOT attisdropped)""", (table_name,))
+    return cursor.fetchone()[0]
+
+
+def parse_shapefile_row_by_row(shp_file):
+    """
+    Original coordinate loading, issuing one UPDATE per shapefile unit.
+    Much slower than parse_shapefile(), kept for comparison.
+    """
     conn = psycopg2.connect(user=DB_CONFIG['DB_USER'], password=DB_CONFIG['DB_PASSWORD'], database=DB_CONFIG['DB_NAME'])
     cursor = conn.cursor()
 
@@ -21,14 +246,7 @@ def parse_shapefile(shp_file):
             # The ID field is globally unique for evaluation units
             id = shp.record(i)[0]
             lng, lat = shp.shape(i).points[0]
-            # We don't need to transform the coordinates, the point  
-            # has lat/lng in NAD83 which is compatbile with WSG84.
-            # In QGIS, changing the CRS from NAD83 to WDG84 performs the EPSG-1188 
-            # transformation, which we see here https://epsg.io/1188 is a noop.
-            # More reading:
-            # https://gis.stackexchange.com/questions/304231/converting-nad83-epsg4269-to-wgs84-epsg4326-using-pyproj
-            # https://help.arcgis.com/en/arcgisdesktop/10.0/help/index.html#/Datums/003r00000008000000/
-            # https://help.arcgis.com/en/arcgisdesktop/10.0/help/index.html#/North_American_datums/003r00000009000000/
+            # See get_coord_index() as to why we don't transform the coordinates
 
             cursor.execute(f"""
                 UPDATE {DB_CONFIG['ROLL_TABLE_NAME']} 
@@ -55,53 +273,98 @@ def cleanup_entries_without_coords():
     conn.commit()
 
 
-def add_lat_lng_to_specific_ids(shp_file):
+def add_lat_lng_to_specific_ids(shp_file, index_dir=None):
+    """
+    Update the coordinates of the disaggregated MURB units from the shapefile.
+    Only the IDs present in the MURB table are looked up in the coordinate index and sent.
+    """
     conn = psycopg2.connect(user=DB_CONFIG['DB_USER'], password=DB_CONFIG['DB_PASSWORD'], database=DB_CONFIG['DB_NAME'])
     cursor = conn.cursor()
 
-    with shapefile.Reader(shp_file) as shp:
-        
-        num_units = len(shp)
-        print(f'Shapefile contains {num_units} units')
+    coord_index = get_coord_index(shp_file, index_dir)
+    num_updated = update_table_coordinates(cursor, coord_index, DB_CONFIG['MURB_DISAG_TABLE_NAME'])
 
-        # Get a list of the IDs we want to update
-        cursor.execute(f"""SELECT id from {DB_CONFIG['MURB_DISAG_TABLE_NAME']}""")
-        ids_to_update = [o[0] for o in cursor.fetchall()]
-        ids_to_update = set(ids_to_update)
+    conn.commit()
+    conn.close()
+    print(f'Updated coordinates of {num_updated} units')
 
-        for i in range(num_units):
 
-            id = shp.record(i)[0]
-            
-            # If the ID is not in our list, skip it
-            if id not in ids_to_update:
-                continue
+def update_table_coordinates(cursor, coord_index, table_name):
+    """
+    Update the coordinates of all the rows of a (small) table from the coordinate index
+    """
+    cursor.execute(f"""SELECT id FROM {table_name}""")
+    ids = [row[0] for row in cursor.fetchall()]
+    return update_coordinates_from_index(cursor, coord_index, table_name, ids=ids)
 
-            lng, lat = shp.shape(i).points[0]
-            cursor.execute(f"""
-                UPDATE {DB_CONFIG['MURB_DISAG_TABLE_NAME']}
-                SET
-                    lat = %s,
-                    lng = %s
-                    WHERE id = %s
-            """, (lat, lng, id)
-            )
 
-            if i % 10_000 == 0:
-                print(f'\tAt value {i}')
-                conn.commit()
+def create_lat_lng_columns_if_not_exists(geography=False):
+    """
+    Add the lat/lng columns to the roll table, and optionally a PostGIS geography 
+    point column (which requires the PostGIS extension to be installed on the server)
+    """
+    conn = psycopg2.connect(user=DB_CONFIG['DB_USER'], password=DB_CONFIG['DB_PASSWORD'], database=DB_CONFIG['DB_NAME'])
+    cursor = conn.cursor()
+    # The compact table is created with its coordinates, they don't need adding
+    table_name = storage_table_name(cursor)
+    add_coordinate_columns_if_not_exists(cursor, table_name)
+
+    if geography:
+        cursor.execute("CREATE EXTENSION IF NOT EXISTS postgis;")
+        cursor.execute(f"""
+            ALTER TABLE {table_name}
+            ADD COLUMN IF NOT EXISTS geog geography(Point, 4326);
+        """)
+        if is_compact(cursor):
+            # Recreate the view so it exposes the new column
+            create_compact_schema_if_not_exists(cursor)
+    conn.commit()
+    conn.close()
+
+
+def add_coordinate_columns_if_not_exists(cursor, table_name):
+    """
+    Add the lat/lng and geohash cell columns to a table created without them, e.g. a roll created
+    before the coordinates were attached while parsing, or given lat/lng before the cells existed
+    """
+    cursor.execute(f"""
+        ALTER TABLE {table_name}
+        ADD COLUMN IF NOT EXISTS lat NUMERIC(20, 10),
+        ADD COLUMN IF NOT EXISTS lng NUMERIC(20, 10),
+        {', '.join(f'ADD COLUMN IF NOT EXISTS {column} BIGINT' for column in CELL_COLUMNS)};
+    """)
 
-        conn.commit()
 
+def create_cell_indexes():
+    """
+    Index the geohash cell columns, once they are filled in
+    """
+    create_stage_indexes('spatial')
 
-def create_lat_lng_columns_if_not_exists():
+
+def fill_geography_column():
+    """
+    Set the geography point of every unit from its lat/lng in one statement, then build
+    the GiST index. The index is built after the bulk fill, which is much faster than
+    maintaining it row by row. Only units without a point or whose point no longer matches 
+    their lat/lng are filled, so this can be rerun after adding units or moving them, e.g. 
+    the aggregated MURBs.
+    """
     conn = psycopg2.connect(user=DB_CONFIG['DB_USER'], password=DB_CONFIG['DB_PASSWORD'], database=DB_CONFIG['DB_NAME'])
     cursor = conn.cursor()
+    table_name = storage_table_name(cursor)
     cursor.execute(f"""
-        ALTER TABLE {DB_CONFIG['ROLL_TABLE_NAME']}
-        ADD COLUMN IF NOT EXISTS lat NUMERIC(20, 10),
-        ADD COLUMN IF NOT EXISTS lng NUMERIC(20, 10);
+        UPDATE {table_name}
+        SET geog = ST_SetSRID(ST_MakePoint(lng, lat), 4326)::geography
+        WHERE geog IS DISTINCT FROM ST_SetSRID(ST_MakePoint(lng, lat), 4326)::geography;
+    """)
+    print(f'Set the geography point of {cursor.rowcount} units')
+
+    cursor.execute(f"""
+        CREATE INDEX IF NOT EXISTS {DB_CONFIG['ROLL_TABLE_NAME']}_geog_idx 
+        ON {table_name} USING GIST (geog);
     """)
+    cursor.execute(f"ANALYZE {table_name} (geog);")
     conn.commit()
     conn.close()
     
@@ -111,6 +374,14 @@ if __name__ == '__main__':
         description="Parse the shape file associated with the property roll and add lat/lng coordinates to evaluation units."
     )
     parser.add_argument('input_file', type=Path, help="Path to the rol_unite_p.shp file")
+    parser.add_argument('-n', '--num-workers', type=int, default=os.cpu_count()-1, 
+                        help="Number of parallel workers. Defaults to one less than the number of CPUs on the machine.")
+    parser.add_argument('-i', '--coord-index', type=Path, 
+                        help="Directory of the persisted coordinate index. Built from the shapefile if missing or outdated.")
+    parser.add_argument('-g', '--geography', action='store_true', 
+                        help="Also fill a PostGIS geography column with a GiST index for spatial queries (requires PostGIS)")
+    parser.add_argument('--row-by-row', action='store_true', 
+                        help="Update the coordinates with one statement per unit instead of a bulk COPY (slow)")
     args = parser.parse_args()
 
     input_file = args.input_file
@@ -121,8 +392,15 @@ if __name__ == '__main__':
         exit(-1)
 
     t0 = datetime.now()
-    create_lat_lng_columns_if_not_exists()
-    parse_shapefile(input_file)
+    create_lat_lng_columns_if_not_exists(geography=args.geography)
+    if args.row_by_row:
+        parse_shapefile_row_by_row(input_file)
+    else:
+        parse_shapefile(input_file, index_dir=args.coord_index, num_workers=args.num_workers)
     cleanup_entries_without_coords()
+    create_cell_indexes()
+    if args.geography:
+        fill_geography_column()
+    refresh_materialized_views()
 
     print(f'Finished in {datetime.now() - t0}')
\ No newline at end of file
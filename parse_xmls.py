@@ -1,51 +1,195 @@
 import os
+import gzip
+import itertools
+import numpy as np
 import heapq
 import signal
+import struct
+import traceback
+import zipfile
 import psycopg2
 import argparse
 from pathlib import Path
+from typing import NamedTuple, Optional
 from datetime import datetime
 from bs4 import BeautifulSoup
 from dotenv import dotenv_values
-from multiprocessing import Pool, Array
+from multiprocessing import Pool
 from xml.dom.pulldom import parse
 from psycopg2.extras import execute_values
 
 from utils.qc_roll_mapping import *
+from utils.muni_stats import MuniStats, QUANTILES, SUMMED_FIELDS
+from utils.coord_index import CoordinateIndex
+from utils.compact_schema import create_compact_schema_if_not_exists, storage_table_name
+from utils.geohash import CELL_COLUMNS, geohash_all_precisions
+from utils.materialized_views import refresh_materialized_views
+from parse_shp import create_cell_indexes, add_coordinate_columns_if_not_exists
+from aggregate_murbs import (stage_murb_members, copy_murb_members_to_disag_table, insert_aggregated_murbs, 
+    record_watermarks, create_disaggrregated_MURBs_table_if_not_exists, create_watermark_table_if_not_exists)
 
 # Read in the database configuration from a .env file
 DB_CONFIG = dotenv_values(".env")
 
+# Optional ID -> coordinates index, set in each worker by init_worker()
+COORD_INDEX = None
+# Whether units missing from the coordinate index are dropped instead of written to the side table
+DROP_MISSING_COORDS = False
+# ID of the current run, recorded per municipality in the muni stats, set in each worker by init_worker()
+LOAD_ID = None
+# Whether the individually listed MURB units are aggregated while parsing, instead of by aggregate_murbs.py after
+AGGREGATE_MURBS = False
+# Temporary table holding the residential units of the current file until they are grouped
+MURB_CANDIDATES_TABLE_NAME = 'murb_candidates'
 
-def launch_jobs(input_folder: Path, num_workers: int, test: bool = False):
+
+class XmlSource(NamedTuple):
+    """
+    A single roll XML, either a plain file on disk, a gzip/zstd compressed file, 
+    or a member of a zip archive. This is passed to the workers, so it must stay picklable.
+    """
+    path: Path
+    member: Optional[str] = None
+
+    @property
+    def name(self):
+        if self.member is not None:
+            return Path(self.member).name
+        return self.path.name
+
+    def open(self):
+        """
+        Open a binary stream over the uncompressed XML, without extracting anything to disk
+        """
+        if self.member is not None:
+            # Each worker opens its own handle on the archive, zip members can be read independently.
+            # The member stream keeps the underlying file open after the archive is closed.
+            with zipfile.ZipFile(self.path) as archive:
+                return archive.open(self.member)
+
+        if self.path.suffix == '.gz':
+            return gzip.open(self.path, 'rb')
+
+        if self.path.suffix == '.zst':
+            # Only needed for zstd archives
+            import zstandard
+            return zstandard.ZstdDecompressor().stream_reader(open(self.path, 'rb'), closefd=True)
+
+        return open(self.path, 'rb')
+
+    def __str__(self):
+        if self.member is not None:
+            return f'{self.path}:{self.member}'
+        return str(self.path)
+
+
+def list_xml_sources(input_path: Path):
+    """
+    Find all the roll XMLs under the input path and their uncompressed size in bytes.
+    The input can be a folder of XMLs (optionally compressed individually), 
+    the original zip archive, or a single compressed XML.
+    """
+    if input_path.is_dir():
+        files = sorted(input_path.iterdir())
+    else:
+        files = [input_path]
+
+    size_per_source = {}
+    for file in files:
+        if zipfile.is_zipfile(file):
+            with zipfile.ZipFile(file) as archive:
+                for info in archive.infolist():
+                    if info.is_dir() or not info.filename.lower().endswith('.xml'):
+                        continue
+                    # file_size is the uncompressed size from the central directory
+                    size_per_source[XmlSource(file, info.filename)] = info.file_size
+        else:
+            size_per_source[XmlSource(file)] = get_uncompressed_size(file)
+
+    return size_per_source
+
+
+def get_uncompressed_size(file: Path):
+    """
+    Get the size of the XML once decompressed, to schedule the work on the real amount of data.
+    Falls back to the size on disk if the archive doesn't record it.
+    """
+    if file.suffix == '.gz':
+        # The gzip trailer holds the uncompressed size modulo 2^32
+        with open(file, 'rb') as f:
+            f.seek(-4, os.SEEK_END)
+            return struct.unpack('<I', f.read(4))[0]
+
+    if file.suffix == '.zst':
+        import zstandard
+        with open(file, 'rb') as f:
+            content_size = zstandard.frame_content_size(f.read(18))
+        if content_size >= 0:
+            return content_size
+
+    return file.stat().st_size
+
+
+def launch_jobs(input_path: Path, num_workers: int, test: bool = False, shp_file: Path = None, 
+                index_dir: Path = None, drop_missing_coords: bool = False, aggregate_murbs: bool = False):
 
     # Split the XMLs evenly between the workers
-    splits = split_xmls_between_workers(input_folder, num_workers, test=test)
+    splits = split_xmls_between_workers(input_path, num_workers, test=test)
 
-    arr = Array('i', range(10))
-    num_units_per_process = []
+    # Build the coordinate index once, the workers get it read-only.
+    # When persisted, it's memory-mapped and the workers share its pages.
+    coord_index = load_coordinate_index(shp_file, index_dir)
+
+    # Tells the municipalities written by this run apart from the others
+    load_id = new_load_id()
 
     # launch a process pool mapping the parsing function and the XMLs
-    with Pool(processes=num_workers) as pool:
-        num_units_per_process.append(pool.map(count_units_in_xml, splits))
-        # for _ in pool.imap_unordered(parse_xmls, splits):
-        #     pass
+    with Pool(processes=num_workers, initializer=init_worker, initargs=(coord_index, drop_missing_coords, load_id, aggregate_murbs)) as pool:
+        num_units_per_process = pool.map(parse_xmls, splits)
 
-    num_units_per_process = num_units_per_process[0]
     print(num_units_per_process)
     print(f'Total units: {sum(num_units_per_process)}')
 
 
-def split_xmls_between_workers(input_folder: Path, num_workers: int, test=False):
+def load_coordinate_index(shp_file: Path = None, index_dir: Path = None):
+    """
+    The coordinate index of the persisted index directory and/or the shapefile, None if neither is given
+    """
+    if not (shp_file or index_dir):
+        return None
+
+    t0 = datetime.now()
+    if shp_file and index_dir:
+        coord_index = CoordinateIndex.load_or_build(shp_file, index_dir)
+    elif index_dir:
+        coord_index = CoordinateIndex.load(index_dir)
+    else:
+        coord_index = CoordinateIndex.from_shapefile(shp_file)
+    print(f'Indexed the coordinates of {len(coord_index)} units in {datetime.now() - t0}')
+    return coord_index
+
+
+def new_load_id():
+    return datetime.now().strftime('%Y%m%d%H%M%S%f')
+
+
+def init_worker(coord_index, drop_missing_coords, load_id, aggregate_murbs):
+    global COORD_INDEX, DROP_MISSING_COORDS, LOAD_ID, AGGREGATE_MURBS
+    COORD_INDEX = coord_index
+    DROP_MISSING_COORDS = drop_missing_coords
+    LOAD_ID = load_id
+    AGGREGATE_MURBS = aggregate_murbs
+
+
+def split_xmls_between_workers(input_path: Path, num_workers: int, test=False):
     """
     Partition the XMLs such that each worker has an approximately equal
     total data size to process. This is because some municipalities (i.e. Montreal)
     have vastly more data than others, and we want to parallelize as best as possible.
+    Sizes are the uncompressed ones, so this works the same when reading from archives.
     """
 
-    size_per_file = {}
-    for xml_file in input_folder.iterdir():
-        size_per_file[xml_file] = xml_file.stat().st_size
+    size_per_file = list_xml_sources(input_path)
         
     # Sort sizes in descending order
     size_per_file = dict(sorted(size_per_file.items(), key=lambda x: x[1], reverse=True))
@@ -94,6 +238,11 @@ def parse_xmls(xml_files):
     conn = psycopg2.connect(user=DB_CONFIG['DB_USER'], password=DB_CONFIG['DB_PASSWORD'], database=DB_CONFIG['DB_NAME'])
     cursor = conn.cursor()
 
+    if AGGREGATE_MURBS:
+        # Kept across the commits of a file, emptied once its MURBs are aggregated
+        cursor.execute(f"""CREATE TEMP TABLE {MURB_CANDIDATES_TABLE_NAME} AS 
+            SELECT * FROM {DB_CONFIG['ROLL_TABLE_NAME']} WITH NO DATA""")
+
     total_units = 0
 
     for xml_file in xml_files:
@@ -102,7 +251,8 @@ def parse_xmls(xml_files):
 
         # We use a streaming XML API for memory efficiency
         # Reading the whole file to build a BeautifulSoup object from it was too much
-        event_stream = parse(str(xml_file))
+        xml_stream = xml_file.open()
+        event_stream = parse(xml_stream)
 
         # Get the municipal code and year entered first
         # Those are applicable to the whole document
@@ -117,46 +267,65 @@ def parse_xmls(xml_files):
                     year_entered = node.childNodes[0].nodeValue
                     break
         
+        # Statistics for this municipality, written out once the whole file is parsed
+        muni_stats = MuniStats(muni_code, year_entered, MUNICIPALITIES.get(f'RL{muni_code}'), str(xml_file), load_id=LOAD_ID)
+
         current_units = []
+        # Units that failed to parse, kept aside so they don't take down the whole worker
+        quarantined_units = []
+        # Position of the current unit within the file, to find it back if it fails
+        unit_index = -1
         
         # Go through all the RLUEx tags - each represents a unit
         for i, (evt, node) in enumerate(event_stream):
 
             if evt == 'START_ELEMENT':
                 if node.tagName == 'RLUEx':
+                    unit_index += 1
                     # Parse until the closing tag
                     event_stream.expandNode(node)
-                    unit_xml = BeautifulSoup(node.toxml(), 'lxml')
-                    # First get the MAT18 to create the provincial ID
-                    mat18 = get_mat18(unit_xml)
-                    id = muni_code + mat18
+                    raw_unit_xml = node.toxml()
+                    try:
+                        unit_xml = BeautifulSoup(raw_unit_xml, 'lxml')
+                        # First get the MAT18 to create the provincial ID
+                        mat18 = get_mat18(unit_xml)
+                    except Exception:
+                        quarantine_unit(quarantined_units, muni_stats, xml_file, unit_index, raw_unit_xml)
+                        continue
 
-                    # Check if the unit already exists before doing any more work
+                    # Check if the unit already exists before doing any more work.
+                    # Outside of the quarantine, a database error aborts the transaction and must stop the 
+                    # worker, instead of quarantining every later unit of the file.
+                    id = muni_code + mat18
                     if unit_exists(cursor, id):
+                        muni_stats.num_skipped += 1
                         continue
-                    
-                    # Start filling the unit values
-                    unit_data = {}
-                    unit_data['id'] = id
-                    unit_data['muni'] = MUNICIPALITIES[f'RL{muni_code}']
-                    unit_data['muni_code'] = muni_code
-                    unit_data['year'] = year_entered
-                    unit_data['mat18'] = mat18
-                    current_units.append(parse_unit_xml(unit_xml, unit_data))
-
-                    # # Extract all the information from the unit XML
-                    unit_data = parse_unit_xml(unit_xml, unit_data)
+
+                    try:
+                        # Extract all the information from the unit XML
+                        unit_data = new_unit_data(id, muni_code, year_entered, mat18)
+                        current_units.append(parse_unit_xml(unit_xml, unit_data))
+                    except Exception:
+                        quarantine_unit(quarantined_units, muni_stats, xml_file, unit_index, raw_unit_xml)
 
             # Print an update and commit latest writes
             if i % 3000 == 0 and i > 0:
-                write_out_current_units(current_units, cursor)
+                write_out_units(current_units, quarantined_units, muni_stats, cursor)
                 current_units = []
+                quarantined_units = []
                 conn.commit()
                 print(f'{pid}:\t\tOn unit {i}\t{xml_file.name}')
                 
         # Flush out the current file's units
-        write_out_current_units(current_units, cursor)
+        write_out_units(current_units, quarantined_units, muni_stats, cursor)
+        if AGGREGATE_MURBS:
+            num_murbs, num_murb_units = write_out_murb_candidates(cursor)
+            print(f'{pid}:\t\tAggregated {num_murbs} MURBs from {num_murb_units} units\t{xml_file.name}')
+        write_out_muni_stats(muni_stats, cursor)
+        if AGGREGATE_MURBS:
+            record_watermarks(cursor, [muni_code])
         conn.commit()
+        xml_stream.close()
 
         print(f'{pid}:\tTotal: {i + 1} units')
 
@@ -164,6 +333,42 @@ def parse_xmls(xml_files):
         total_units += i + 1
         
     print(f'{pid}:\tParsed {total_units} units in total!')
+    conn.close()
+    return total_units
+
+
+def new_unit_data(id, muni_code, year_entered, mat18):
+    """
+    The fields of a unit known before parsing its XML
+    """
+    unit_data = {}
+    unit_data['id'] = id
+    # Filled in from the coordinate index when writing out, if we have one
+    unit_data['lat'] = None
+    unit_data['lng'] = None
+    for column in CELL_COLUMNS:
+        unit_data[column] = None
+    unit_data['muni'] = MUNICIPALITIES[f'RL{muni_code}']
+    unit_data['muni_code'] = muni_code
+    unit_data['year'] = year_entered
+    unit_data['mat18'] = mat18
+    return unit_data
+
+
+def quarantine_unit(quarantined_units, muni_stats, xml_file, unit_index, raw_unit_xml):
+    """
+    Keep aside a unit that failed to parse along with the current traceback, so it doesn't take down the whole worker
+    """
+    muni_stats.num_quarantined += 1
+    print(f'{os.getpid()}:\t\tQuarantined unit {unit_index}\t{xml_file.name}')
+    quarantined_units.append({
+        'source': str(xml_file),
+        'unit_index': unit_index,
+        'muni_code': muni_stats.muni_code,
+        'year': muni_stats.year,
+        'unit_xml': raw_unit_xml,
+        'error': traceback.format_exc(),
+    })
 
 
 def count_units_in_xml(xml_files):
@@ -177,7 +382,8 @@ def count_units_in_xml(xml_files):
 
             # We use a streaming XML API for memory efficiency
             # Reading the whole file to build a BeautifulSoup object from it was too much
-            event_stream = parse(str(xml_file))
+            xml_stream = xml_file.open()
+            event_stream = parse(xml_stream)
 
             # Get the municipal code and year entered first
             # Those are applicable to the whole document
@@ -200,28 +406,262 @@ def count_units_in_xml(xml_files):
                 if evt == 'START_ELEMENT':
                     if node.tagName == 'RLUEx':
                         total_units += 1
+
+            xml_stream.close()
         return total_units
 
     except KeyboardInterrupt:
         return total_units
 
-def write_out_current_units(current_units, cursor):
+def write_out_units(current_units, quarantined_units, muni_stats, cursor):
+    """
+    Write out a batch of parsed and quarantined units. If we have a coordinate index,
+    the units are written with their coordinates, and those not in the index go to
+    the side table (or are dropped) instead of the roll.
+    """
+    if COORD_INDEX is not None:
+        current_units, units_without_coords = attach_coordinates(current_units, COORD_INDEX)
+        muni_stats.num_without_coords += len(units_without_coords)
+        if not DROP_MISSING_COORDS:
+            write_out_current_units(units_without_coords, cursor, table_name=DB_CONFIG['NO_COORDS_TABLE_NAME'])
+
+    for unit_data in current_units:
+        muni_stats.add(unit_data)
+
+    if AGGREGATE_MURBS:
+        # The residential units wait for the end of the file, when we know which ones are part of a MURB
+        write_out_current_units([unit_data for unit_data in current_units if unit_data['cubf'] == 1000], cursor, 
+            table_name=MURB_CANDIDATES_TABLE_NAME)
+        current_units = [unit_data for unit_data in current_units if unit_data['cubf'] != 1000]
+
+    write_out_current_units(current_units, cursor)
+    write_out_quarantined_units(quarantined_units, cursor)
+
+
+def write_out_murb_candidates(cursor):
+    """
+    Group the residential units of the current file like aggregate_murbs.py, by address and coordinates,
+    writing the units of each MURB to the disaggregated table and its aggregated entry to the roll.
+    The other units go to the roll as they are, so the roll never holds units that are deleted later.
+    Returns the number of aggregated MURBs and of units they were made of.
+    """
+    stage_murb_members(cursor, MURB_CANDIDATES_TABLE_NAME)
+    cursor.execute("SELECT count(DISTINCT group_id), count(*) FROM murb_members")
+    num_murbs, num_units = cursor.fetchone()
+
+    copy_murb_members_to_disag_table(cursor, MURB_CANDIDATES_TABLE_NAME)
+    insert_aggregated_murbs(cursor, MURB_CANDIDATES_TABLE_NAME)
+    cursor.execute(f"""
+        INSERT INTO {DB_CONFIG['ROLL_TABLE_NAME']}
+        SELECT * FROM {MURB_CANDIDATES_TABLE_NAME} c
+        WHERE NOT EXISTS (SELECT 1 FROM murb_members m WHERE m.id = c.id)
+        ON CONFLICT DO NOTHING""")
+
+    cursor.execute(f"TRUNCATE {MURB_CANDIDATES_TABLE_NAME}; DROP TABLE murb_members;")
+    return num_murbs, num_units
+
+
+def attach_coordinates(current_units, coord_index):
+    """
+    Fill in the lat/lng of a batch of units from the coordinate index.
+    Returns the units that have coordinates, and those that don't.
+    """
+    if not current_units:
+        return current_units, []
+
+    found, lat, lng = coord_index.lookup([unit_data['id'] for unit_data in current_units])
+    # Compute the geohash cells of the whole batch at once, the cells of units without coordinates aren't used
+    cells = geohash_all_precisions(np.nan_to_num(lat), np.nan_to_num(lng))
+    cells = {column: column_cells.tolist() for column, column_cells in cells.items()}
+
+    units_with_coords = []
+    units_without_coords = []
+    for i, (unit_data, unit_found) in enumerate(zip(current_units, found.tolist())):
+        if unit_found:
+            unit_data['lat'] = lat[i].item()
+            unit_data['lng'] = lng[i].item()
+            for column in CELL_COLUMNS:
+                unit_data[column] = cells[column][i]
+            units_with_coords.append(unit_data)
+        else:
+            units_without_coords.append(unit_data)
+
+    return units_with_coords, units_without_coords
+
 
-    template = """(%(id)s, %(year)s, %(muni)s, %(muni_code)s, %(arrond)s, %(address)s, %(num_adr_inf)s, %(num_adr_inf_2)s, 
+def write_out_current_units(current_units, cursor, table_name=None):
+
+    if table_name is None:
+        table_name = DB_CONFIG['ROLL_TABLE_NAME']
+
+    cell_values = ''.join(f', %({column})s' for column in CELL_COLUMNS)
+    template = f"""(%(id)s, %(lat)s, %(lng)s{cell_values}, %(year)s, %(muni)s, %(muni_code)s, %(arrond)s, %(address)s, %(num_adr_inf)s, %(num_adr_inf_2)s, 
         %(num_adr_sup)s, %(num_adr_sup_2)s, %(street_name)s, %(apt_num)s, %(apt_num_1)s, %(apt_num_2)s, %(mat18)s, %(cubf)s, 
         %(file_num)s, %(nghbr_unit)s, %(owner_date)s, %(owner_type)s, %(owner_status)s, %(lot_lin_dim)s, %(lot_area)s, 
         %(max_floors)s, %(const_yr)s, %(const_yr_real)s, %(floor_area)s, %(phys_link)s, %(const_type)s, %(num_dwelling)s, 
         %(num_rental)s, %(num_non_res)s, %(apprais_date)s, %(lot_value)s, %(building_value)s, %(value)s, %(prev_value)s)"""
     
-    execute_values(cursor, f"""INSERT INTO {DB_CONFIG['ROLL_TABLE_NAME']} 
-        (id, year, muni, muni_code, arrond, address, num_adr_inf, num_adr_inf_2, num_adr_sup, num_adr_sup_2, 
-        street_name, apt_num, apt_num_1, apt_num_2, mat18, cubf, file_num, nghbr_unit, owner_date, owner_type, 
-        owner_status, lot_lin_dim, lot_area, max_floors, const_yr, const_yr_real, floor_area, phys_link, 
-        const_type, num_dwelling, num_rental, num_non_res, apprais_date, lot_value, building_value, value,
+    execute_values(cursor, f"""INSERT INTO {table_name} 
+        (id, lat, lng, {', '.join(CELL_COLUMNS)}, year, muni, muni_code, arrond, address, num_adr_inf, num_adr_inf_2, 
+        num_adr_sup, num_adr_sup_2, street_name, apt_num, apt_num_1, apt_num_2, mat18, cubf, file_num, nghbr_unit, 
+        owner_date, owner_type, owner_status, lot_lin_dim, lot_area, max_floors, const_yr, const_yr_real, floor_area, 
+        phys_link, const_type, num_dwelling, num_rental, num_non_res, apprais_date, lot_value, building_value, value,
         prev_value) VALUES %s ON CONFLICT DO NOTHING""", 
         current_units, template=template)
 
 
+def write_out_quarantined_units(quarantined_units, cursor):
+
+    template = """(%(source)s, %(unit_index)s, %(muni_code)s, %(year)s, %(unit_xml)s, %(error)s)"""
+
+    execute_values(cursor, f"""INSERT INTO {DB_CONFIG['QUARANTINE_TABLE_NAME']}
+        (source, unit_index, muni_code, year, unit_xml, error) VALUES %s 
+        ON CONFLICT (source, unit_index) DO UPDATE SET unit_xml = EXCLUDED.unit_xml, error = EXCLUDED.error""",
+        quarantined_units, template=template)
+
+
+def write_out_muni_stats(muni_stats, cursor):
+    row = muni_stats.to_row()
+    columns = list(row)
+    # Replace the stats from any previous run on the same municipality, unless this run skipped all of
+    # its units because they were already in the roll, e.g. a rerun or resume, which would erase them.
+    # The load ID likewise only moves if this run wrote units, i.e. if the municipality's rows changed.
+    stats_columns = [column for column in columns if column not in ('muni_code', 'year', 'num_skipped')]
+    updates = ',\n        '.join(f'{column} = CASE WHEN EXCLUDED.num_units > 0 THEN EXCLUDED.{column} ELSE s.{column} END'
+                                 for column in stats_columns)
+    cursor.execute(f"""INSERT INTO {DB_CONFIG['MUNI_STATS_TABLE_NAME']} AS s ({', '.join(columns)}, computed_at) 
+        VALUES ({', '.join(f'%({c})s' for c in columns)}, now())
+        ON CONFLICT (muni_code, year) DO UPDATE SET 
+        {updates},
+        num_skipped = EXCLUDED.num_skipped,
+        computed_at = now()""", row)
+
+
+def reprocess_quarantined_units(coord_index=None, drop_missing_coords=False):
+    """
+    Retry parsing the units that were quarantined during a previous run, 
+    e.g. after fixing the mappings in utils/qc_roll_mapping.py.
+    Units that now parse are written out like those of a load, with their coordinates if we have a 
+    coordinate index, and removed from the quarantine. The others have their error updated.
+    """
+    # Reprocessed units get a load ID of their own, so aggregate_murbs.py --incremental picks up their municipalities
+    init_worker(coord_index, drop_missing_coords, new_load_id(), False)
+
+    conn = psycopg2.connect(user=DB_CONFIG['DB_USER'], password=DB_CONFIG['DB_PASSWORD'], database=DB_CONFIG['DB_NAME'])
+    cursor = conn.cursor()
+    warn_about_reprocessed_units(cursor)
+
+    cursor.execute(f"""SELECT id, source, unit_index, muni_code, year, unit_xml 
+        FROM {DB_CONFIG['QUARANTINE_TABLE_NAME']} ORDER BY muni_code, year, id""")
+    quarantined = cursor.fetchall()
+    print(f'{len(quarantined)} quarantined units to reprocess')
+
+    i = 0
+    for (muni_code, year_entered), muni_quarantined in itertools.groupby(quarantined, key=lambda row: (row[3], row[4])):
+        muni_stats = MuniStats(muni_code, year_entered, MUNICIPALITIES.get(f'RL{muni_code}'), None, load_id=LOAD_ID)
+        num_resolved = 0
+
+        current_units = []
+        resolved_ids = []
+        still_failing = []
+
+        for quarantine_id, source, unit_index, muni_code, year_entered, raw_unit_xml in muni_quarantined:
+            if i % 3000 == 0 and i > 0:
+                num_resolved += len(resolved_ids)
+                flush_reprocessed_units(current_units, resolved_ids, still_failing, muni_stats, cursor)
+                current_units, resolved_ids, still_failing = [], [], []
+                conn.commit()
+                print(f'\tOn quarantined unit {i}')
+            i += 1
+
+            try:
+                unit_xml = BeautifulSoup(raw_unit_xml, 'lxml')
+                mat18 = get_mat18(unit_xml)
+                id = muni_code + mat18
+            except Exception:
+                still_failing.append((traceback.format_exc(), quarantine_id))
+                continue
+
+            # Outside of the try, a database error must stop the run rather than mark every later unit as failing
+            if unit_exists(cursor, id):
+                muni_stats.num_skipped += 1
+                resolved_ids.append((quarantine_id,))
+                continue
+
+            try:
+                current_units.append(parse_unit_xml(unit_xml, new_unit_data(id, muni_code, year_entered, mat18)))
+                resolved_ids.append((quarantine_id,))
+            except Exception:
+                still_failing.append((traceback.format_exc(), quarantine_id))
+
+        num_resolved += len(resolved_ids)
+        flush_reprocessed_units(current_units, resolved_ids, still_failing, muni_stats, cursor)
+        add_reprocessed_muni_stats(muni_stats, num_resolved, cursor)
+        conn.commit()
+
+    cursor.execute(f"""SELECT count(*) FROM {DB_CONFIG['QUARANTINE_TABLE_NAME']}""")
+    print(f'{cursor.fetchone()[0]} units remain in quarantine')
+    conn.close()
+
+
+def warn_about_reprocessed_units(cursor):
+    """
+    Point out what the reprocessed units won't have that the roll's other units do
+    """
+    if COORD_INDEX is None:
+        cursor.execute(f"""SELECT EXISTS (SELECT 1 FROM {DB_CONFIG['ROLL_TABLE_NAME']} WHERE lat IS NOT NULL)""")
+        if cursor.fetchone()[0]:
+            print('Warning: the roll has coordinates but the reprocessed units will not, pass the --shapefile or '
+                  '--coord-index of the load, or run parse_shp.py after')
+
+    cursor.execute(f"""SELECT to_regclass(%s) IS NOT NULL""", (DB_CONFIG['MURB_WATERMARK_TABLE_NAME'],))
+    if cursor.fetchone()[0]:
+        cursor.execute(f"""SELECT EXISTS (SELECT 1 FROM {DB_CONFIG['MURB_WATERMARK_TABLE_NAME']})""")
+        if cursor.fetchone()[0]:
+            print('Warning: the roll has aggregated MURBs, run aggregate_murbs.py --incremental after '
+                  'to group the reprocessed units with them')
+
+
+def flush_reprocessed_units(current_units, resolved_ids, still_failing, muni_stats, cursor):
+    write_out_units(current_units, [], muni_stats, cursor)
+    # The parentheses around %s are important here
+    execute_values(cursor, f"""DELETE FROM {DB_CONFIG['QUARANTINE_TABLE_NAME']} WHERE id in (%s)""", resolved_ids)
+    cursor.executemany(f"""UPDATE {DB_CONFIG['QUARANTINE_TABLE_NAME']} SET error = %s WHERE id = %s""", still_failing)
+
+
+def add_reprocessed_muni_stats(muni_stats, num_resolved, cursor):
+    """
+    Add the reprocessed units of a municipality to the stats of its load. The counts, sums and bounds
+    are exact, the quantiles are left as they were since they can't be merged, a handful of units 
+    hardly moves them.
+    """
+    row = muni_stats.to_row()
+    row['num_resolved'] = num_resolved
+    sums = ',\n        '.join(f'sum_{field} = s.sum_{field} + %(sum_{field})s' for field in SUMMED_FIELDS)
+    cursor.execute(f"""UPDATE {DB_CONFIG['MUNI_STATS_TABLE_NAME']} AS s SET 
+        load_id = CASE WHEN %(num_units)s > 0 THEN %(load_id)s ELSE s.load_id END,
+        num_units = s.num_units + %(num_units)s,
+        num_skipped = s.num_skipped + %(num_skipped)s,
+        num_quarantined = s.num_quarantined - %(num_resolved)s,
+        num_without_coords = s.num_without_coords + %(num_without_coords)s,
+        {sums},
+        min_value = LEAST(s.min_value, %(min_value)s),
+        max_value = GREATEST(s.max_value, %(max_value)s),
+        min_const_yr = LEAST(s.min_const_yr, %(min_const_yr)s),
+        max_const_yr = GREATEST(s.max_const_yr, %(max_const_yr)s),
+        null_counts = COALESCE((
+            SELECT jsonb_object_agg(key, total) 
+            FROM (
+                SELECT key, sum(value::int) AS total
+                FROM (SELECT * FROM jsonb_each_text(s.null_counts) 
+                    UNION ALL SELECT * FROM jsonb_each_text(%(null_counts)s::jsonb)) counts
+                GROUP BY key
+            ) totals
+        ), '{{}}'::jsonb),
+        computed_at = now()
+        WHERE s.muni_code = %(muni_code)s AND s.year = %(year)s""", row)
+
+
 def get_mat18(unit):
     # RL0104 - we'll use it to create the MAT18 and ID_PROVINC used in the GIS data
     # Do this first to check if the unit has already been entered and skip work
@@ -303,7 +743,10 @@ def parse_unit_xml(unit_xml, unit_data):
 
 
 def unit_exists(cursor, id):
-    cursor.execute(f"""SELECT EXISTS (SELECT 1 FROM {DB_CONFIG['ROLL_TABLE_NAME']} WHERE id=%s)""", (id,))
+    # Units aggregated while parsing are in the disaggregated table instead of the roll
+    disag_exists = f"""OR EXISTS (SELECT 1 FROM {DB_CONFIG['MURB_DISAG_TABLE_NAME']} WHERE id=%(id)s)""" if AGGREGATE_MURBS else ''
+    cursor.execute(f"""SELECT EXISTS (SELECT 1 FROM {DB_CONFIG['ROLL_TABLE_NAME']} WHERE id=%(id)s) {disag_exists}""", 
+        {'id': id})
     return cursor.fetchone()[0]
 
 
@@ -430,15 +873,28 @@ def generate_mat18(rl0104):
     return mat18
 
 
-def create_tables_if_not_exists():
+def create_tables_if_not_exists(compact=False):
     conn = psycopg2.connect(user=DB_CONFIG['DB_USER'], password=DB_CONFIG['DB_PASSWORD'], database=DB_CONFIG['DB_NAME'])
     cursor = conn.cursor()
+    if compact:
+        cursor.execute("""SELECT to_regclass(%s) IS NOT NULL AND NOT EXISTS 
+            (SELECT 1 FROM pg_views WHERE viewname = %s)""", (DB_CONFIG['ROLL_TABLE_NAME'], DB_CONFIG['ROLL_TABLE_NAME']))
+        if cursor.fetchone()[0]:
+            print(f"Warning: {DB_CONFIG['ROLL_TABLE_NAME']} already exists as a regular table, not using the compact schema")
+        else:
+            # Compact table behind a view with the usual roll columns, see utils/compact_schema.py
+            create_compact_schema_if_not_exists(cursor)
+    # Geohash cells of the coordinates at a few precisions, see utils/geohash.py
+    cell_columns = ',\n'.join(f'{column} BIGINT' for column in CELL_COLUMNS)
     # Apparently you should never use char(n)
     # even for fixed length character fields and use text or varchar instead
     # https://wiki.postgresql.org/wiki/Don%27t_Do_This#Don.27t_use_char.28n.29
     cursor.execute(f"""
         CREATE TABLE IF NOT EXISTS {DB_CONFIG['ROLL_TABLE_NAME']} (
             id TEXT PRIMARY KEY CHECK(length(id)=23),
+            lat NUMERIC(20, 10),
+            lng NUMERIC(20, 10),
+            {cell_columns},
             year SMALLINT NOT NULL,
             muni TEXT NOT NULL,
             muni_code TEXT NOT NULL,
@@ -477,6 +933,16 @@ def create_tables_if_not_exists():
             prev_value INTEGER
         );""")
 
+    # Units we don't have coordinates for, when attaching them at parse time from the shapefile
+    cursor.execute(f"""
+        CREATE TABLE IF NOT EXISTS {DB_CONFIG['NO_COORDS_TABLE_NAME']} 
+            (LIKE {DB_CONFIG['ROLL_TABLE_NAME']} INCLUDING ALL);""")
+
+    # Every unit is written with its coordinates and cells, added here to the tables of older databases
+    # created without them, the same way as parse_shp.py does
+    add_coordinate_columns_if_not_exists(cursor, storage_table_name(cursor))
+    add_coordinate_columns_if_not_exists(cursor, DB_CONFIG['NO_COORDS_TABLE_NAME'])
+
     # Create auxiliary table with human readable values of the owner status field
     cursor.execute(f"""
         CREATE TABLE IF NOT EXISTS {DB_CONFIG['OWNER_STATUS_TABLE_NAME']} (
@@ -498,6 +964,48 @@ def create_tables_if_not_exists():
             value TEXT NOT NULL
         );""")
     
+    # Create the quarantine table for units that fail to parse
+    # They can be retried with --reprocess-quarantine once the cause is fixed
+    cursor.execute(f"""
+        CREATE TABLE IF NOT EXISTS {DB_CONFIG['QUARANTINE_TABLE_NAME']} (
+            id SERIAL PRIMARY KEY,
+            source TEXT NOT NULL,
+            unit_index INTEGER NOT NULL,
+            muni_code TEXT NOT NULL,
+            year SMALLINT NOT NULL,
+            unit_xml TEXT NOT NULL,
+            error TEXT NOT NULL,
+            quarantined_at TIMESTAMP NOT NULL DEFAULT now(),
+            UNIQUE (source, unit_index)
+        );""")
+    
+    # Create the per municipality statistics table, filled in as each XML finishes parsing
+    quantile_columns = ',\n'.join(f'value_p{round(q * 100)} INTEGER, const_yr_p{round(q * 100)} SMALLINT' for q in QUANTILES)
+    sum_columns = ',\n'.join(f'sum_{field} BIGINT' for field in SUMMED_FIELDS)
+    cursor.execute(f"""
+        CREATE TABLE IF NOT EXISTS {DB_CONFIG['MUNI_STATS_TABLE_NAME']} (
+            muni_code TEXT NOT NULL,
+            year SMALLINT NOT NULL,
+            muni TEXT,
+            source TEXT NOT NULL,
+            load_id TEXT,
+            num_units INTEGER NOT NULL,
+            num_skipped INTEGER NOT NULL,
+            num_quarantined INTEGER NOT NULL,
+            num_without_coords INTEGER NOT NULL,
+            {sum_columns},
+            min_value INTEGER,
+            max_value INTEGER,
+            min_const_yr SMALLINT,
+            max_const_yr SMALLINT,
+            {quantile_columns},
+            null_counts JSONB NOT NULL,
+            computed_at TIMESTAMP NOT NULL,
+            PRIMARY KEY (muni_code, year)
+        );""")
+    # Added after the table, for databases created before
+    cursor.execute(f"""ALTER TABLE {DB_CONFIG['MUNI_STATS_TABLE_NAME']} ADD COLUMN IF NOT EXISTS load_id TEXT;""")
+    
     conn.commit()
     
     OWNER_STATUSES = (('1', 'landowner'), ('2', 'lessor'), ('3', 'condo owner'), 
@@ -526,26 +1034,76 @@ def create_tables_if_not_exists():
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
-    parser.add_argument('xml_folder', type=Path, help='Path to folder containing the roll XML files.')
+    parser.add_argument('xml_input', type=Path, nargs='?', 
+                        help='Path to folder containing the roll XML files, or to the .zip/.gz/.zst archive they came in. '
+                             'Not needed with --reprocess-quarantine.')
     parser.add_argument('-n', '--num-workers', type=int, default=os.cpu_count()-1, 
                         help="Number of parallel workers. Defaults to one less than the number of CPUs on the machine.")
     parser.add_argument('-t', '--test', action='store_true', help='Run in testing mode on a few XMLs')
     parser.add_argument('-c', '--create-tables', action='store_true', help='Create the tables and exit')
+    parser.add_argument('-s', '--shapefile', type=Path, 
+                        help='Path to the rol_unite_p.shp file. If given, coordinates are attached while parsing '
+                             'and units without coordinates are kept out of the roll.')
+    parser.add_argument('-i', '--coord-index', type=Path, 
+                        help='Directory of the persisted coordinate index, built from --shapefile if missing or outdated. '
+                             'Can be given without --shapefile once built.')
+    parser.add_argument('--drop-missing-coords', action='store_true', 
+                        help='With --shapefile or --coord-index, drop units without coordinates instead of writing them to the side table')
+    parser.add_argument('--compact-schema', action='store_true', 
+                        help='Create the roll as a view over a compact table with integer codes and dictionary encoded streets. '
+                             'Only applies when creating the tables.')
+    parser.add_argument('-m', '--aggregate-murbs', action='store_true', 
+                        help='Aggregate the individually listed MURB units while parsing, like aggregate_murbs.py, grouping the '
+                             'residential units of each file by address and coordinates. Needs --shapefile or --coord-index.')
+    parser.add_argument('-r', '--reprocess-quarantine', action='store_true', 
+                        help='Retry parsing the quarantined units and exit, attaching their coordinates with the same '
+                             '--shapefile or --coord-index as the load. The XML input is ignored.')
     args = parser.parse_args()
 
-    input_folder = args.xml_folder
+    input_path = args.xml_input
     num_workers = args.num_workers
     test = args.test
     create_tables = args.create_tables
 
     # Parameter validation
-    if not input_folder.exists() or not input_folder.is_dir():
-        print(f'Error: bad XML directory given')
+    if not args.reprocess_quarantine and (input_path is None or not input_path.exists()):
+        print(f'Error: bad XML input given')
         exit(-1)
 
+    if args.shapefile and not args.shapefile.is_file():
+        print(f'Error: bad shapefile given')
+        exit(-1)
+
+    if args.aggregate_murbs and not (args.shapefile or args.coord_index):
+        print(f'Error: --aggregate-murbs needs the coordinates, pass --shapefile or --coord-index')
+        exit(-1)
+
+    if args.coord_index and not args.shapefile and not CoordinateIndex.exists(args.coord_index):
+        print(f'Error: no coordinate index in {args.coord_index}, pass --shapefile to build it')
+        exit(-1)
+
+    if args.reprocess_quarantine:
+        t0 = datetime.now()
+        create_tables_if_not_exists()
+        reprocess_quarantined_units(coord_index=load_coordinate_index(args.shapefile, args.coord_index),
+                                    drop_missing_coords=args.drop_missing_coords)
+        if args.shapefile or args.coord_index:
+            create_cell_indexes()
+        refresh_materialized_views()
+        print(f'Finished reprocessing quarantined units in {datetime.now() - t0}')
+        exit()
+
     t0 = datetime.now()
-    create_tables_if_not_exists()
+    create_tables_if_not_exists(compact=args.compact_schema)
+    if args.aggregate_murbs:
+        create_disaggrregated_MURBs_table_if_not_exists()
+        create_watermark_table_if_not_exists()
     if create_tables:
         exit()
-    launch_jobs(input_folder, num_workers, test=test)
+    launch_jobs(input_path, num_workers, test=test, shp_file=args.shapefile, 
+                index_dir=args.coord_index, drop_missing_coords=args.drop_missing_coords, 
+                aggregate_murbs=args.aggregate_murbs)
+    if args.shapefile or args.coord_index:
+        create_cell_indexes()
+    refresh_materialized_views()
     print(f'Finished parsing XMLs in {datetime.now() - t0}')
@@ -0,0 +1,54 @@
+from collections import Counter
+
+import numpy as np
+import psycopg2
+import pytest
+
+from utils.most_common import group_most_common, sql_most_common, sql_value_counts
+
+# Values of the units of each group, in the order of their IDs
+GROUPS = [
+    # Tied, the value of the lowest ID wins and not the smallest one
+    [2020, 2019, 2019, 2020],
+    # Mostly NULL
+    [None, None, 2019],
+    # Tied with NULL first
+    [None, 2018, 2018, None],
+    # Tied with NULL last
+    [2017, None],
+    [1999],
+]
+
+
+def counter_modes():
+    return [Counter(values).most_common(1)[0][0] for values in GROUPS]
+
+
+def test_group_most_common_matches_counter():
+    values = np.array([value for values in GROUPS for value in values], dtype=object)
+    group_ids = np.repeat(np.arange(len(GROUPS)), [len(values) for values in GROUPS])
+    assert group_most_common(values, group_ids, len(GROUPS)) == counter_modes() == [2020, None, None, 2017, 1999]
+
+
+def test_sql_most_common_matches_counter():
+    # Connects with the PG* environment variables, e.g. PGHOST and PGDATABASE
+    try:
+        conn = psycopg2.connect('')
+    except psycopg2.OperationalError:
+        pytest.skip('No database to connect to')
+
+    cursor = conn.cursor()
+    cursor.execute("CREATE TEMP TABLE units (id TEXT, group_id INTEGER, year SMALLINT)")
+    rows = [(f'{i:02d}', group_id, value) for i, (group_id, value) in
+            enumerate((group_id, value) for group_id, values in enumerate(GROUPS) for value in values)]
+    # Inserted backwards, so the physical order of the rows isn't the order of their IDs
+    cursor.executemany("INSERT INTO units VALUES (%s, %s, %s)", rows[::-1])
+    cursor.execute(f"""
+        SELECT {sql_most_common('year', 'u')}
+        FROM (SELECT r.*, {sql_value_counts('year', 'r.group_id', 'r')} FROM units r) u
+        GROUP BY u.group_id
+        ORDER BY u.group_id""")
+    sql_modes = [mode for mode, in cursor.fetchall()]
+    conn.close()
+
+    assert sql_modes == counter_modes()
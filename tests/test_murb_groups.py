@@ -0,0 +1,24 @@
+import numpy as np
+
+from utils.murb_groups import METRES_PER_DEGREE, group_units_within_tolerance
+
+
+def test_units_a_few_metres_apart_north_south_are_grouped():
+    # Two units of Montréal 9 m apart north-south, and a third 30 m further
+    lat = [45.5, 45.5 + 9 / METRES_PER_DEGREE, 45.5 + 39 / METRES_PER_DEGREE]
+    lng = [-73.57, -73.57, -73.57]
+    group_ids = group_units_within_tolerance(['66023'] * 3, ['10 Rue Saint-Jean'] * 3, lat, lng, tolerance_m=10)
+    assert group_ids[0] == group_ids[1] != -1
+    assert group_ids[2] == -1
+
+
+def test_units_a_few_metres_apart_east_west_are_grouped():
+    metres_per_degree_lng = METRES_PER_DEGREE * np.cos(np.radians(46.8))
+    lat = [46.8, 46.8]
+    lng = [-71.2, -71.2 + 9 / metres_per_degree_lng]
+    group_ids = group_units_within_tolerance(['23027'] * 2, ['10 Rue St-Jean', '10 rue Saint Jean'], lat, lng,
+                                             tolerance_m=10)
+    assert group_ids[0] == group_ids[1] != -1
+
+    group_ids = group_units_within_tolerance(['23027'] * 2, ['10 Rue St-Jean'] * 2, lat, lng, tolerance_m=8)
+    assert list(group_ids) == [-1, -1]
@@ -0,0 +1,21 @@
+import numpy as np
+import pytest
+
+from utils.spatial_index import SpatialIndex
+
+# The KD-tree comes from scipy, an optional dependency
+pytest.importorskip('scipy')
+
+
+def test_knn_on_an_empty_index_finds_no_neighbours():
+    index = SpatialIndex(np.array([], dtype='S23'), np.array([]), np.array([]))
+    ids, distances_m = index.knn([45.5, 46.8], [-73.57, -71.2], k=2)
+    assert ids.tolist() == [[b'', b''], [b'', b'']]
+    assert np.isinf(distances_m).all() and distances_m.shape == (2, 2)
+
+
+def test_knn_pads_the_missing_neighbours():
+    index = SpatialIndex(np.array([b'66023000000000000000001'], dtype='S23'), np.array([45.5]), np.array([-73.57]))
+    ids, distances_m = index.knn(45.5, -73.57, k=2)
+    assert ids.tolist() == [[b'66023000000000000000001', b'']]
+    assert distances_m[0, 0] < 1e-6 and np.isinf(distances_m[0, 1])
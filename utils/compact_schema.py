@@ -0,0 +1,375 @@
+"""
+Optional compact storage schema for the roll.
+
+The units are stored in {roll}_compact, where the municipality is a smallint ID
+into the muni reference table, street names are integer IDs into a
+per municipality dictionary, the categorical fields are smallint codes, the mat18
+is derived from the ID and coordinates are double precision. The {roll} name is
+then a view rebuilding the usual columns, so the README export queries work unchanged.
+INSTEAD OF triggers on the view encode inserted, updated and deleted rows, so the
+other stages of the pipeline work unchanged too. Bulk coordinate updates and indexes
+go straight to the compact table, see storage_table_name().
+
+Compare the size and scan times of an existing (wide) roll with its compact equivalent with
+    python -m utils.compact_schema
+"""
+import argparse
+import psycopg2
+from datetime import datetime
+from dotenv import dotenv_values
+from psycopg2.extras import execute_values
+
+from utils.geohash import CELL_COLUMNS
+from utils.qc_roll_mapping import MUNICIPALITIES
+
+# Read in the database configuration from a .env file
+DB_CONFIG = dotenv_values(".env")
+
+OWNER_TYPES = {'physical': 1, 'moral': 2}
+
+# Queries timed by the comparison, {table} is the roll or its compact view
+BENCHMARK_QUERIES = {
+    'full scan': """SELECT count(*), sum(value), sum(num_dwelling) FROM {table}""",
+    'group by municipality': """SELECT muni, count(*), sum(value), avg(const_yr) FROM {table} GROUP BY muni""",
+    'MURB export': """SELECT r.id, lat, lng, muni_code, address, arrond, muni, cubf, const_yr, const_yr_real, num_dwelling,
+        max_floors, lot_lin_dim, lot_area, floor_area, pl.value, ct.value, num_rental, num_non_res, owner_type, os.value
+        FROM {table} r LEFT JOIN {phys_link} pl ON r.phys_link = pl.id LEFT JOIN {const_type} ct ON r.const_type = ct.id
+        LEFT JOIN {owner_status} os ON r.owner_status = os.id WHERE cubf = 1000 AND num_dwelling >= 3 ORDER BY num_dwelling DESC""",
+}
+
+
+def compact_table_name(roll_table_name):
+    return f'{roll_table_name}_compact'
+
+
+def street_table_name(roll_table_name):
+    return f'{roll_table_name}_street'
+
+
+def is_compact(cursor, roll_table_name=None):
+    """
+    Whether the roll is the compatibility view over a compact table
+    """
+    roll_table_name = roll_table_name or DB_CONFIG['ROLL_TABLE_NAME']
+    cursor.execute("""SELECT c.relkind = 'v' FROM pg_class c WHERE c.oid = to_regclass(%s)""", (roll_table_name,))
+    row = cursor.fetchone()
+    return bool(row and row[0])
+
+
+def storage_table_name(cursor, table_name=None):
+    """
+    The table actually holding the rows of the given table name, i.e. the compact table
+    when the roll is the compatibility view. Use it for bulk updates, indexes and new columns.
+    """
+    table_name = table_name or DB_CONFIG['ROLL_TABLE_NAME']
+    if table_name == DB_CONFIG['ROLL_TABLE_NAME'] and is_compact(cursor, table_name):
+        return compact_table_name(table_name)
+    return table_name
+
+
+def create_compact_schema_if_not_exists(cursor, roll_table_name=None):
+    """
+    Create the muni reference table, the street dictionary, the compact table,
+    the compatibility view named like the roll and its triggers.
+    """
+    roll_table_name = roll_table_name or DB_CONFIG['ROLL_TABLE_NAME']
+    compact_table = compact_table_name(roll_table_name)
+    street_table = street_table_name(roll_table_name)
+    muni_table = DB_CONFIG['MUNI_TABLE_NAME']
+
+    # Municipality reference table, the compact table only keeps its smallint ID
+    cursor.execute(f"""
+        CREATE TABLE IF NOT EXISTS {muni_table} (
+            id SMALLSERIAL PRIMARY KEY,
+            code TEXT NOT NULL UNIQUE,
+            name TEXT NOT NULL
+        );""")
+    # Codes are mostly numeric, but not those of the unorganized territories (e.g. NR020)
+    execute_values(cursor, f"""INSERT INTO {muni_table} (code, name) VALUES %s ON CONFLICT DO NOTHING""",
+        [(code[2:], name) for code, name in MUNICIPALITIES.items()])
+
+    # Street names repeat within a municipality. Keying the dictionary by municipality also
+    # means parallel workers, which each process their own municipalities, never insert the same entry.
+    cursor.execute(f"""
+        CREATE TABLE IF NOT EXISTS {street_table} (
+            id SERIAL PRIMARY KEY,
+            muni_id SMALLINT NOT NULL,
+            name TEXT NOT NULL,
+            UNIQUE (muni_id, name)
+        );""")
+
+    cell_columns = ''.join(f'\n            {column} BIGINT,' for column in CELL_COLUMNS)
+    cursor.execute(f"""
+        CREATE TABLE IF NOT EXISTS {compact_table} (
+            id TEXT PRIMARY KEY CHECK(length(id)=23),
+            lat DOUBLE PRECISION,
+            lng DOUBLE PRECISION,{cell_columns}
+            year SMALLINT NOT NULL,
+            muni_id SMALLINT NOT NULL,
+            cubf SMALLINT NOT NULL,
+            owner_type SMALLINT,
+            owner_status SMALLINT,
+            phys_link SMALLINT,
+            const_type SMALLINT,
+            max_floors SMALLINT,
+            const_yr SMALLINT,
+            num_dwelling SMALLINT,
+            num_rental SMALLINT,
+            num_non_res SMALLINT,
+            const_yr_real "char",
+            street_id INTEGER,
+            lot_value INTEGER,
+            building_value INTEGER,
+            value INTEGER,
+            prev_value INTEGER,
+            owner_date DATE,
+            apprais_date DATE,
+            lot_lin_dim NUMERIC(8, 2),
+            lot_area NUMERIC(15, 2),
+            floor_area NUMERIC(8, 1),
+            arrond TEXT,
+            address TEXT NOT NULL,
+            num_adr_inf TEXT,
+            num_adr_inf_2 TEXT,
+            num_adr_sup TEXT,
+            num_adr_sup_2 TEXT,
+            apt_num TEXT,
+            apt_num_1 TEXT,
+            apt_num_2 TEXT,
+            file_num TEXT,
+            nghbr_unit TEXT
+        );""")
+
+    # The geography column added by parse_shp.py --geography goes last, like in the wide table
+    cursor.execute("""SELECT EXISTS (SELECT 1 FROM pg_attribute WHERE attrelid = to_regclass(%s)
+        AND attname = 'geog' AND NOT attisdropped)""", (compact_table,))
+    geog_select = ',\n            c.geog' if cursor.fetchone()[0] else ''
+
+    # Same columns, in the same order, as the wide roll table created by parse_xmls.py
+    cell_selects = ''.join(f'\n            c.{column},' for column in CELL_COLUMNS)
+    cursor.execute(f"""
+        CREATE OR REPLACE VIEW {roll_table_name} AS
+        SELECT
+            c.id,
+            c.lat,
+            c.lng,{cell_selects}
+            c.year,
+            m.name AS muni,
+            m.code AS muni_code,
+            c.arrond,
+            c.address,
+            c.num_adr_inf,
+            c.num_adr_inf_2,
+            c.num_adr_sup,
+            c.num_adr_sup_2,
+            s.name AS street_name,
+            c.apt_num,
+            c.apt_num_1,
+            c.apt_num_2,
+            substr(c.id, 6) AS mat18,
+            c.cubf,
+            c.file_num,
+            c.nghbr_unit,
+            c.owner_date,
+            CASE c.owner_type WHEN 1 THEN 'physical' WHEN 2 THEN 'moral' END AS owner_type,
+            c.owner_status::text AS owner_status,
+            c.lot_lin_dim,
+            c.lot_area,
+            c.max_floors,
+            c.const_yr,
+            c.const_yr_real::text AS const_yr_real,
+            c.floor_area,
+            c.phys_link::text AS phys_link,
+            c.const_type::text AS const_type,
+            c.num_dwelling,
+            c.num_rental,
+            c.num_non_res,
+            c.apprais_date,
+            c.lot_value,
+            c.building_value,
+            c.value,
+            c.prev_value{geog_select}
+        FROM {compact_table} c
+        LEFT JOIN {muni_table} m ON m.id = c.muni_id
+        LEFT JOIN {street_table} s ON s.id = c.street_id;""")
+
+    # Encoding of a view row into the compact columns, shared by the insert and update triggers
+    encoded = {
+        'id': 'NEW.id',
+        'lat': 'NEW.lat',
+        'lng': 'NEW.lng',
+        **{column: f'NEW.{column}' for column in CELL_COLUMNS},
+        'year': 'NEW.year',
+        'muni_id': f'(SELECT id FROM {muni_table} WHERE code = NEW.muni_code)',
+        'cubf': 'NEW.cubf',
+        'owner_type': "CASE NEW.owner_type " + ' '.join(f"WHEN '{name}' THEN {code}" for name, code in OWNER_TYPES.items()) + " END",
+        'owner_status': 'NEW.owner_status::smallint',
+        'phys_link': 'NEW.phys_link::smallint',
+        'const_type': 'NEW.const_type::smallint',
+        'max_floors': 'NEW.max_floors',
+        'const_yr': 'NEW.const_yr',
+        'num_dwelling': 'NEW.num_dwelling',
+        'num_rental': 'NEW.num_rental',
+        'num_non_res': 'NEW.num_non_res',
+        'const_yr_real': 'NEW.const_yr_real::"char"',
+        'street_id': f'{street_table}_id((SELECT id FROM {muni_table} WHERE code = NEW.muni_code), NEW.street_name)',
+        'lot_value': 'NEW.lot_value',
+        'building_value': 'NEW.building_value',
+        'value': 'NEW.value',
+        'prev_value': 'NEW.prev_value',
+        'owner_date': 'NEW.owner_date',
+        'apprais_date': 'NEW.apprais_date',
+        'lot_lin_dim': 'NEW.lot_lin_dim',
+        'lot_area': 'NEW.lot_area',
+        'floor_area': 'NEW.floor_area',
+        'arrond': 'NEW.arrond',
+        'address': 'NEW.address',
+        'num_adr_inf': 'NEW.num_adr_inf',
+        'num_adr_inf_2': 'NEW.num_adr_inf_2',
+        'num_adr_sup': 'NEW.num_adr_sup',
+        'num_adr_sup_2': 'NEW.num_adr_sup_2',
+        'apt_num': 'NEW.apt_num',
+        'apt_num_1': 'NEW.apt_num_1',
+        'apt_num_2': 'NEW.apt_num_2',
+        'file_num': 'NEW.file_num',
+        'nghbr_unit': 'NEW.nghbr_unit',
+    }
+
+    cursor.execute(f"""
+        CREATE OR REPLACE FUNCTION {street_table}_id(street_muni_id SMALLINT, street_name TEXT) RETURNS INTEGER
+        LANGUAGE plpgsql AS $$
+        DECLARE
+            street_id INTEGER;
+        BEGIN
+            IF street_name IS NULL THEN
+                RETURN NULL;
+            END IF;
+            SELECT id INTO street_id FROM {street_table} WHERE muni_id = street_muni_id AND name = street_name;
+            IF street_id IS NULL THEN
+                INSERT INTO {street_table} (muni_id, name) VALUES (street_muni_id, street_name)
+                    ON CONFLICT DO NOTHING RETURNING id INTO street_id;
+            END IF;
+            IF street_id IS NULL THEN
+                SELECT id INTO street_id FROM {street_table} WHERE muni_id = street_muni_id AND name = street_name;
+            END IF;
+            RETURN street_id;
+        END $$;""")
+
+    cursor.execute(f"""
+        CREATE OR REPLACE FUNCTION {roll_table_name}_insert() RETURNS trigger LANGUAGE plpgsql AS $$
+        BEGIN
+            INSERT INTO {compact_table} ({', '.join(encoded)})
+            VALUES ({', '.join(encoded.values())})
+            ON CONFLICT (id) DO NOTHING;
+            RETURN NEW;
+        END $$;""")
+
+    cursor.execute(f"""
+        CREATE OR REPLACE FUNCTION {roll_table_name}_update() RETURNS trigger LANGUAGE plpgsql AS $$
+        BEGIN
+            UPDATE {compact_table} SET ({', '.join(encoded)}) = ({', '.join(encoded.values())})
+            WHERE id = OLD.id;
+            RETURN NEW;
+        END $$;""")
+
+    cursor.execute(f"""
+        CREATE OR REPLACE FUNCTION {roll_table_name}_delete() RETURNS trigger LANGUAGE plpgsql AS $$
+        BEGIN
+            DELETE FROM {compact_table} WHERE id = OLD.id;
+            RETURN OLD;
+        END $$;""")
+
+    for operation in ('insert', 'update', 'delete'):
+        cursor.execute(f"""DROP TRIGGER IF EXISTS {roll_table_name}_{operation} ON {roll_table_name};""")
+        cursor.execute(f"""
+            CREATE TRIGGER {roll_table_name}_{operation} INSTEAD OF {operation.upper()} ON {roll_table_name}
+            FOR EACH ROW EXECUTE FUNCTION {roll_table_name}_{operation}();""")
+
+
+def compare_with_compact(keep=False):
+    """
+    Build a compact copy of the (wide) roll table with set-based statements,
+    then compare their size on disk and the time of a few typical scans.
+    The copy is dropped afterwards unless keep is set.
+    """
+    conn = psycopg2.connect(user=DB_CONFIG['DB_USER'], password=DB_CONFIG['DB_PASSWORD'], database=DB_CONFIG['DB_NAME'])
+    cursor = conn.cursor()
+
+    roll_table = DB_CONFIG['ROLL_TABLE_NAME']
+    muni_table = DB_CONFIG['MUNI_TABLE_NAME']
+    if is_compact(cursor, roll_table):
+        print(f'Error: {roll_table} already uses the compact schema')
+        return
+
+    copy_name = f'{roll_table}_cmp'
+    create_compact_schema_if_not_exists(cursor, copy_name)
+
+    t0 = datetime.now()
+    cursor.execute(f"""
+        INSERT INTO {street_table_name(copy_name)} (muni_id, name)
+        SELECT DISTINCT m.id, r.street_name FROM {roll_table} r JOIN {muni_table} m ON m.code = r.muni_code
+        WHERE r.street_name IS NOT NULL
+        ON CONFLICT DO NOTHING;""")
+    # Going through the view's insert trigger would also work, but this is a lot faster
+    cursor.execute(f"""
+        INSERT INTO {compact_table_name(copy_name)}
+            (id, lat, lng, {', '.join(CELL_COLUMNS)}, year, muni_id, cubf, owner_type, owner_status, phys_link, const_type,
+            max_floors, const_yr, num_dwelling, num_rental, num_non_res, const_yr_real, street_id, lot_value, building_value,
+            value, prev_value, owner_date, apprais_date, lot_lin_dim, lot_area, floor_area, arrond, address, num_adr_inf,
+            num_adr_inf_2, num_adr_sup, num_adr_sup_2, apt_num, apt_num_1, apt_num_2, file_num, nghbr_unit)
+        SELECT r.id, r.lat, r.lng, {', '.join(f'r.{column}' for column in CELL_COLUMNS)}, r.year, m.id, r.cubf,
+            CASE r.owner_type {' '.join(f"WHEN '{name}' THEN {code}" for name, code in OWNER_TYPES.items())} END,
+            r.owner_status::smallint, r.phys_link::smallint, r.const_type::smallint, r.max_floors, r.const_yr,
+            r.num_dwelling, r.num_rental, r.num_non_res, r.const_yr_real::"char", s.id, r.lot_value, r.building_value,
+            r.value, r.prev_value, r.owner_date, r.apprais_date, r.lot_lin_dim, r.lot_area, r.floor_area, r.arrond,
+            r.address, r.num_adr_inf, r.num_adr_inf_2, r.num_adr_sup, r.num_adr_sup_2, r.apt_num, r.apt_num_1,
+            r.apt_num_2, r.file_num, r.nghbr_unit
+        FROM {roll_table} r
+        JOIN {muni_table} m ON m.code = r.muni_code
+        LEFT JOIN {street_table_name(copy_name)} s ON s.muni_id = m.id AND s.name = r.street_name;""")
+    conn.commit()
+    print(f'Built the compact copy of {cursor.rowcount} units in {datetime.now() - t0}')
+
+    cursor.execute(f"ANALYZE {roll_table}; ANALYZE {compact_table_name(copy_name)}; ANALYZE {street_table_name(copy_name)};")
+    conn.commit()
+
+    cursor.execute("""SELECT pg_total_relation_size(%s), pg_total_relation_size(%s) + pg_total_relation_size(%s)""",
+        (roll_table, compact_table_name(copy_name), street_table_name(copy_name)))
+    wide_size, compact_size = cursor.fetchone()
+    print(f'\n{"":<30}{"wide":>14}{"compact":>14}')
+    print(f'{"size (MB)":<30}{wide_size / 2**20:>14.1f}{compact_size / 2**20:>14.1f}')
+
+    lookup_tables = {
+        'phys_link': DB_CONFIG['PHYS_LINK_TABLE_NAME'],
+        'const_type': DB_CONFIG['CONST_TYPE_TABLE_NAME'],
+        'owner_status': DB_CONFIG['OWNER_STATUS_TABLE_NAME'],
+    }
+    for name, query in BENCHMARK_QUERIES.items():
+        timings = []
+        for table in (roll_table, copy_name):
+            # Run once to warm the cache, time the second run
+            for _ in range(2):
+                t0 = datetime.now()
+                cursor.execute(query.format(table=table, **lookup_tables))
+                cursor.fetchall()
+                elapsed = datetime.now() - t0
+            timings.append(elapsed.total_seconds() * 1000)
+        print(f'{name + " (ms)":<30}{timings[0]:>14.0f}{timings[1]:>14.0f}')
+
+    if not keep:
+        cursor.execute(f"""DROP VIEW {copy_name}; DROP TABLE {compact_table_name(copy_name)};
+            DROP TABLE {street_table_name(copy_name)};""")
+        for function in ('insert', 'update', 'delete'):
+            cursor.execute(f"DROP FUNCTION IF EXISTS {copy_name}_{function}();")
+        cursor.execute(f"DROP FUNCTION IF EXISTS {street_table_name(copy_name)}_id(SMALLINT, TEXT);")
+        conn.commit()
+    conn.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Compare the size and scan times of the roll table with its compact schema equivalent."
+    )
+    parser.add_argument('--keep', action='store_true', help='Keep the compact copy instead of dropping it after the comparison')
+    args = parser.parse_args()
+    compare_with_compact(keep=args.keep)
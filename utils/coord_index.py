@@ -0,0 +1,103 @@
+import numpy as np
+from pathlib import Path
+
+from utils.shp_points import read_point_shapefile
+
+# Files making up a persisted index
+IDS_FILE_NAME = 'coord_ids.npy'
+COORDS_FILE_NAME = 'coord_latlng.npy'
+
+
+class CoordinateIndex:
+    """
+    Lookup of evaluation unit ID to (lat, lng), backed by a sorted array of
+    fixed width IDs and a parallel (N, 2) array of lat/lng coordinates.
+    Lookups are a vectorized binary search, so a whole batch of units is resolved at once.
+
+    The index can be saved to .npy files and loaded memory-mapped, in which case
+    every process using it shares the same pages instead of holding its own copy.
+    The arrays are never modified after construction.
+    """
+
+    def __init__(self, ids, coords):
+        # ids must already be sorted, use from_arrays() otherwise
+        self.ids = ids
+        self.coords = coords
+
+    @property
+    def lat(self):
+        return self.coords[:, 0]
+
+    @property
+    def lng(self):
+        return self.coords[:, 1]
+
+    @classmethod
+    def from_arrays(cls, ids, lat, lng):
+        order = np.argsort(ids, kind='stable')
+        coords = np.column_stack((lat[order], lng[order])).astype(np.float64)
+        return cls(ids[order], coords)
+
+    @classmethod
+    def from_shapefile(cls, shp_file):
+        ids, lng, lat = read_point_shapefile(shp_file)
+        return cls.from_arrays(ids, lat, lng)
+
+    def save(self, index_dir):
+        index_dir = Path(index_dir)
+        index_dir.mkdir(parents=True, exist_ok=True)
+        np.save(index_dir / IDS_FILE_NAME, self.ids)
+        np.save(index_dir / COORDS_FILE_NAME, self.coords)
+
+    @classmethod
+    def load(cls, index_dir):
+        index_dir = Path(index_dir)
+        ids = np.load(index_dir / IDS_FILE_NAME, mmap_mode='r')
+        coords = np.load(index_dir / COORDS_FILE_NAME, mmap_mode='r')
+        return cls(ids, coords)
+
+    @classmethod
+    def exists(cls, index_dir):
+        index_dir = Path(index_dir)
+        return (index_dir / IDS_FILE_NAME).is_file() and (index_dir / COORDS_FILE_NAME).is_file()
+
+    @classmethod
+    def build(cls, shp_file, index_dir):
+        """
+        Build the index from the shapefile, save it, and load it back memory-mapped
+        """
+        cls.from_shapefile(shp_file).save(index_dir)
+        return cls.load(index_dir)
+
+    @classmethod
+    def load_or_build(cls, shp_file, index_dir):
+        """
+        Load the persisted index, (re)building it first if it's missing or older than the shapefile
+        """
+        index_dir = Path(index_dir)
+        if cls.exists(index_dir) and (index_dir / IDS_FILE_NAME).stat().st_mtime >= Path(shp_file).stat().st_mtime:
+            return cls.load(index_dir)
+        print(f'Building the coordinate index in {index_dir}')
+        return cls.build(shp_file, index_dir)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def lookup(self, ids):
+        """
+        Find the coordinates of a batch of IDs (str or bytes).
+        Returns a boolean array of which IDs were found, and the lat and lng arrays, NaN where not found.
+        """
+        ids = np.asarray(ids, dtype=self.ids.dtype)
+        found = np.zeros(len(ids), dtype=bool)
+        lat = np.full(len(ids), np.nan)
+        lng = np.full(len(ids), np.nan)
+
+        if len(self.ids):
+            # IDs greater than all indexed IDs land past the end, clamp them to the last one
+            positions = np.minimum(np.searchsorted(self.ids, ids), len(self.ids) - 1)
+            found = self.ids[positions] == ids
+            lat[found] = self.lat[positions[found]]
+            lng[found] = self.lng[positions[found]]
+
+        return found, lat, lng
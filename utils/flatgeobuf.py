@@ -0,0 +1,309 @@
+"""
+Writes point features to FlatGeobuf, a binary format with a spatial index that web maps
+can query a bounding box of over HTTP range requests, without loading the whole file.
+
+https://github.com/flatgeobuf/flatgeobuf/blob/master/src/fbs/header.fbs
+https://github.com/flatgeobuf/flatgeobuf/blob/master/src/fbs/feature.fbs
+
+A file is made of:
+  - 8 magic bytes
+  - the Header flatbuffer prefixed by its size, with the columns and the number of features
+  - a packed R-tree of the bounding boxes of the features, root first and leaves last
+  - the Feature flatbuffers prefixed by their size, in the order of the leaves
+
+The index comes before the features but is built from all of them, so its space is reserved
+from the number of features. Each batch of features is written along with its leaves, and the
+upper levels of the tree are built from the leaves on disk once all of them are written, so
+memory use doesn't grow with the number of features.
+
+    with FlatGeobufWriter(path, 'roll', columns, num_features) as writer:
+        writer.write_batch(*encode_point_features(column_types, rows))
+"""
+import struct
+import numpy as np
+from pathlib import Path
+
+MAGIC_BYTES = b'fgb\x03fgb\x01'
+
+# GeometryType of the Header and Geometry tables
+POINT = 1
+
+# ColumnType of the Column table
+COLUMN_TYPES = {
+    'Byte': 0, 'UByte': 1, 'Bool': 2, 'Short': 3, 'UShort': 4, 'Int': 5, 'UInt': 6, 'Long': 7, 'ULong': 8,
+    'Float': 9, 'Double': 10, 'String': 11, 'Json': 12, 'DateTime': 13, 'Binary': 14,
+}
+
+# Little endian layout of the fixed size property values, the others are a uint32 length and UTF-8 bytes
+PROPERTY_FORMATS = {
+    'Byte': 'b', 'UByte': 'B', 'Bool': '?', 'Short': 'h', 'UShort': 'H', 'Int': 'i', 'UInt': 'I',
+    'Long': 'q', 'ULong': 'Q', 'Float': 'f', 'Double': 'd',
+}
+
+# Number of children of each node of the R-tree
+NODE_SIZE = 16
+
+NODE_ITEM = np.dtype([
+    ('min_x', '<f8'),
+    ('min_y', '<f8'),
+    ('max_x', '<f8'),
+    ('max_y', '<f8'),
+    # Byte offset of the feature from the start of the features for the leaves, index of the first child otherwise
+    ('offset', '<u8'),
+])
+
+# Nodes read at once while building the upper levels of the R-tree, a multiple of NODE_SIZE
+NODES_PER_CHUNK = NODE_SIZE * 65536
+
+# Inline layout of the scalars of the flatbuffer tables
+SCALAR_FORMATS = {'bool': '<?', 'u8': '<B', 'u16': '<H', 'i32': '<i', 'u64': '<Q'}
+
+
+class FlatGeobufWriter:
+    """
+    Writes a FlatGeobuf file of num_features points, in batches encoded with encode_point_features(),
+    e.g. by parallel workers. The columns are (name, column type) pairs, the types being keys of COLUMN_TYPES.
+    """
+
+    def __init__(self, path: Path, name, columns, num_features, envelope=None):
+        self.num_features = num_features
+        self.num_written = 0
+        self.features_size = 0
+
+        self.file = open(path, 'w+b')
+        self.file.write(MAGIC_BYTES)
+        header = encode_table({
+            0: ('str', name),
+            1: ('f64s', envelope),
+            2: ('u8', POINT),
+            7: ('tables', [{0: ('str', column_name), 1: ('u8', COLUMN_TYPES[column_type])}
+                           for column_name, column_type in columns]),
+            8: ('u64', num_features),
+            # Written even when it's the default, an empty file has no index
+            9: ('u16', NODE_SIZE if num_features else 0),
+            10: ('table', {0: ('str', 'EPSG'), 1: ('i32', 4326)}),
+        })
+        self.file.write(struct.pack('<I', len(header)))
+        self.file.write(header)
+
+        self.index_start = self.file.tell()
+        self.level_bounds = packed_rtree_level_bounds(num_features) if num_features else []
+        num_nodes = self.level_bounds[0][1] if self.level_bounds else 0
+        self.features_start = self.index_start + num_nodes * NODE_ITEM.itemsize
+
+    def write_batch(self, data, leaves):
+        """
+        Append the encoded features and their leaves, whose offsets are relative to the start of the batch
+        """
+        if not len(leaves):
+            return
+        if self.num_written + len(leaves) > self.num_features:
+            raise ValueError(f'More than the {self.num_features} features announced in the header')
+        leaves['offset'] += self.features_size
+        self.file.seek(self.index_start + (self.level_bounds[0][0] + self.num_written) * NODE_ITEM.itemsize)
+        self.file.write(leaves.tobytes())
+        self.file.seek(self.features_start + self.features_size)
+        self.file.write(data)
+        self.num_written += len(leaves)
+        self.features_size += len(data)
+
+    def close(self):
+        if self.num_written != self.num_features:
+            self.file.close()
+            raise ValueError(f'Wrote {self.num_written} features, {self.num_features} were announced in the header')
+        self._build_upper_levels()
+        self.file.close()
+
+    def _build_upper_levels(self):
+        """
+        Fill in the parents of each level of the R-tree from the level below, a chunk at a time
+        """
+        for (start, end), (parent_start, _) in zip(self.level_bounds, self.level_bounds[1:]):
+            for chunk_start in range(start, end, NODES_PER_CHUNK):
+                num_items = min(NODES_PER_CHUNK, end - chunk_start)
+                self.file.seek(self.index_start + chunk_start * NODE_ITEM.itemsize)
+                items = np.frombuffer(self.file.read(num_items * NODE_ITEM.itemsize), dtype=NODE_ITEM)
+
+                first_children = np.arange(0, num_items, NODE_SIZE)
+                parents = np.empty(len(first_children), dtype=NODE_ITEM)
+                parents['min_x'] = np.minimum.reduceat(items['min_x'], first_children)
+                parents['min_y'] = np.minimum.reduceat(items['min_y'], first_children)
+                parents['max_x'] = np.maximum.reduceat(items['max_x'], first_children)
+                parents['max_y'] = np.maximum.reduceat(items['max_y'], first_children)
+                parents['offset'] = chunk_start + first_children
+
+                self.file.seek(self.index_start + (parent_start + (chunk_start - start) // NODE_SIZE) * NODE_ITEM.itemsize)
+                self.file.write(parents.tobytes())
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.file.close()
+
+
+def packed_rtree_level_bounds(num_items):
+    """
+    The [start, end) node positions of each level of the packed R-tree, leaves first.
+    The root is at position 0 and the leaves are last, as in the reference implementation.
+    """
+    level_num_nodes = [num_items]
+    n = num_items
+    while True:
+        n = (n + NODE_SIZE - 1) // NODE_SIZE
+        level_num_nodes.append(n)
+        if n == 1:
+            break
+    num_nodes = sum(level_num_nodes)
+
+    level_bounds = []
+    for level_size in level_num_nodes:
+        level_bounds.append((num_nodes - level_size, num_nodes))
+        num_nodes -= level_size
+    return level_bounds
+
+
+def encode_point_features(column_types, rows):
+    """
+    Encode (x, y, *values) rows as size prefixed Feature flatbuffers, with NULL values left out.
+    Returns the bytes of the features, and their leaves in the R-tree with offsets from the start of the bytes.
+    """
+    property_encoders = [_property_encoder(i, column_type) for i, column_type in enumerate(column_types)]
+
+    # Every point feature is the same up to its coordinates, followed by the length and bytes of its properties
+    template = encode_table({
+        0: ('table', {1: ('f64s', (0.0, 0.0)), 6: ('u8', POINT)}),
+        1: ('bytes', b''),
+    })
+    head = template[:-20]
+    pack_feature = struct.Struct(f'<I{len(head)}sddI').pack
+
+    chunks = []
+    offsets = []
+    offset = 0
+    for x, y, *values in rows:
+        properties = b''.join(encode(value) for encode, value in zip(property_encoders, values) if value is not None)
+        chunks.append(pack_feature(len(template) + len(properties), head, x, y, len(properties)))
+        chunks.append(properties)
+        offsets.append(offset)
+        offset += 4 + len(template) + len(properties)
+
+    leaves = np.empty(len(rows), dtype=NODE_ITEM)
+    leaves['min_x'] = leaves['max_x'] = [row[0] for row in rows]
+    leaves['min_y'] = leaves['max_y'] = [row[1] for row in rows]
+    leaves['offset'] = offsets
+    return b''.join(chunks), leaves
+
+
+def _property_encoder(column_index, column_type):
+    """
+    Function encoding a value of the column, prefixed by the column index
+    """
+    if column_type in PROPERTY_FORMATS:
+        pack = struct.Struct('<H' + PROPERTY_FORMATS[column_type]).pack
+        return lambda value: pack(column_index, value)
+
+    pack_length = struct.Struct('<HI').pack
+
+    def encode_string(value):
+        value = str(value).encode()
+        return pack_length(column_index, len(value)) + value
+    return encode_string
+
+
+def encode_table(fields):
+    """
+    Encode a flatbuffer with the given root table, front to back.
+    Tables are dicts of their field slots to (kind, value) pairs, where the kind is one of SCALAR_FORMATS,
+    'str', 'bytes' (a ubyte vector), 'f64s' (a double vector), 'table' or 'tables' (a vector of tables).
+    """
+    buffer = bytearray(4)
+    struct.pack_into('<I', buffer, 0, _write_table(buffer, fields))
+    return bytes(buffer)
+
+
+def _pad(buffer, alignment, offset=0):
+    """
+    Pad the buffer so that something written offset bytes after its end is aligned
+    """
+    buffer.extend(bytes(-(len(buffer) + offset) % alignment))
+
+
+def _write_table(buffer, fields):
+    """
+    Append the vtable, the table and then everything it refers to, since offsets can only point forward.
+    Returns the position of the table.
+    """
+    fields = {slot: field for slot, field in fields.items() if field[1] is not None}
+    num_slots = max(fields) + 1 if fields else 0
+    # Widest fields first, so each field is aligned if the first one is
+    inline_fields = sorted(fields.items(),
+                           key=lambda field: -struct.calcsize(SCALAR_FORMATS.get(field[1][0], '<I')))
+
+    _pad(buffer, 2)
+    vtable_start = len(buffer)
+    vtable_size = 4 + 2 * num_slots
+    buffer.extend(bytes(vtable_size))
+
+    # The table starts with the int32 offset back to its vtable, directly followed by its widest field
+    widest = struct.calcsize(SCALAR_FORMATS.get(inline_fields[0][1][0], '<I')) if inline_fields else 4
+    _pad(buffer, max(widest, 4), offset=4)
+    table_start = len(buffer)
+    buffer.extend(struct.pack('<i', table_start - vtable_start))
+
+    field_offsets = [0] * num_slots
+    references = []
+    for slot, (kind, value) in inline_fields:
+        field_offsets[slot] = len(buffer) - table_start
+        if kind in SCALAR_FORMATS:
+            buffer.extend(struct.pack(SCALAR_FORMATS[kind], value))
+        else:
+            references.append((len(buffer), kind, value))
+            buffer.extend(bytes(4))
+    struct.pack_into(f'<{2 + num_slots}H', buffer, vtable_start, vtable_size, len(buffer) - table_start, *field_offsets)
+
+    for field_position, kind, value in references:
+        struct.pack_into('<I', buffer, field_position, _write_reference(buffer, kind, value) - field_position)
+    return table_start
+
+
+def _write_reference(buffer, kind, value):
+    """
+    Append a string, vector or table referred to by an offset, returns its position
+    """
+    if kind == 'table':
+        return _write_table(buffer, value)
+
+    if kind == 'str':
+        value = value.encode()
+        _pad(buffer, 4)
+        start = len(buffer)
+        buffer.extend(struct.pack('<I', len(value)) + value + b'\0')
+        return start
+
+    if kind == 'bytes':
+        _pad(buffer, 4)
+        start = len(buffer)
+        buffer.extend(struct.pack('<I', len(value)) + value)
+        return start
+
+    if kind == 'f64s':
+        # The doubles right after the length are 8 byte aligned
+        _pad(buffer, 8, offset=4)
+        start = len(buffer)
+        buffer.extend(struct.pack(f'<I{len(value)}d', len(value), *value))
+        return start
+
+    if kind == 'tables':
+        _pad(buffer, 4)
+        start = len(buffer)
+        buffer.extend(struct.pack('<I', len(value)) + bytes(4 * len(value)))
+        for i, table in enumerate(value):
+            element_position = start + 4 + 4 * i
+            struct.pack_into('<I', buffer, element_position, _write_table(buffer, table) - element_position)
+        return start
+
+    raise ValueError(f'Unknown flatbuffer field kind {kind}')
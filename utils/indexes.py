@@ -0,0 +1,103 @@
+"""
+The secondary indexes of the roll, and which stage of the pipeline needs each of them.
+
+The roll is bulk loaded without them, since maintaining indexes row by row is much slower than
+building them once after the load. finalize.py builds those of every stage (or of the given ones)
+in parallel, and a stage run on its own builds the ones it needs with create_stage_indexes().
+
+    create_stage_indexes('aggregate_murbs')
+"""
+import psycopg2
+from typing import NamedTuple, Optional
+from dotenv import dotenv_values
+
+from utils.compact_schema import is_compact, storage_table_name
+from utils.geohash import CELL_COLUMNS
+
+# Read in the database configuration from a .env file
+DB_CONFIG = dotenv_values(".env")
+
+
+class IndexSpec(NamedTuple):
+    # In terms of the columns of the roll
+    columns: tuple
+    # Partial index condition
+    where: Optional[str] = None
+    method: str = 'btree'
+
+
+INDEXES = {
+    # Municipalities of the residential units, for splitting and filtering the MURB aggregation by municipality
+    'residential_muni': IndexSpec(('muni_code',), where='cubf = 1000'),
+    # Lookup of the units of a MURB in the loop, and order of the streaming aggregation
+    'murb_key': IndexSpec(('muni', 'address', 'lat', 'lng', 'id'), where='cubf = 1000'),
+    # Units left without coordinates, see cleanup_entries_without_coords()
+    'missing_coords': IndexSpec(('id',), where='lat IS NULL OR lng IS NULL'),
+    # The MURBs export of the README, cubf = 1000 and num_dwelling >= 3 ordered by num_dwelling
+    'murb_export': IndexSpec(('num_dwelling',), where='cubf = 1000'),
+    # Spatial group-bys and neighbourhood joins on the geohash cells
+    **{column: IndexSpec((column,)) for column in CELL_COLUMNS},
+    # Order the roll is rewritten in by finalize.py --cluster, only kept while clustering
+    'cluster_order': IndexSpec(('muni_code', 'geohash_7')),
+    # Block ranges, tiny and only useful once the roll is clustered
+    'muni_brin': IndexSpec(('muni_code',), method='brin'),
+    'cell_brin': IndexSpec(('geohash_7',), method='brin'),
+    'coords_brin': IndexSpec(('lat', 'lng'), method='brin'),
+}
+
+# Built along with those of the stages when the roll is clustered
+CLUSTERED_INDEXES = ('muni_brin', 'cell_brin', 'coords_brin')
+
+# Indexes needed by each stage
+STAGE_INDEXES = {
+    'aggregate_murbs': ('residential_muni', 'murb_key'),
+    'cleanup': ('missing_coords',),
+    'export': ('murb_export',),
+    'spatial': CELL_COLUMNS,
+}
+
+# Columns of the compact table standing in for those of the roll, see utils/compact_schema.py
+COMPACT_COLUMNS = {
+    'muni': 'muni_id',
+    'muni_code': 'muni_id',
+}
+
+
+def index_name(name):
+    return f"{DB_CONFIG['ROLL_TABLE_NAME']}_{name}_idx"
+
+
+def create_index_statement(cursor, name):
+    """
+    The CREATE INDEX statement of one of the INDEXES, on the table the roll is stored in
+    """
+    spec = INDEXES[name]
+    columns = spec.columns
+    if is_compact(cursor):
+        columns = tuple(dict.fromkeys(COMPACT_COLUMNS.get(column, column) for column in columns))
+    where = f' WHERE {spec.where}' if spec.where else ''
+    return f"""CREATE INDEX IF NOT EXISTS {index_name(name)}
+        ON {storage_table_name(cursor)} USING {spec.method} ({', '.join(columns)}){where}"""
+
+
+def create_indexes(names):
+    """
+    Create the given indexes if they don't exist yet, one after the other
+    """
+    conn = psycopg2.connect(user=DB_CONFIG['DB_USER'], password=DB_CONFIG['DB_PASSWORD'], database=DB_CONFIG['DB_NAME'])
+    cursor = conn.cursor()
+    for name in names:
+        cursor.execute(create_index_statement(cursor, name))
+    conn.commit()
+    conn.close()
+
+
+def create_stage_indexes(*stages):
+    """
+    Create the indexes the given stages need, if they don't exist yet
+    """
+    create_indexes(stage_index_names(stages))
+
+
+def stage_index_names(stages):
+    return list(dict.fromkeys(name for stage in stages for name in STAGE_INDEXES[stage]))
@@ -0,0 +1,134 @@
+"""
+Materialized views of the roll, for the read queries that would otherwise redo the same joins and
+filters over the whole roll every time: the MURBs of the README export and summaries per municipality.
+
+finalize.py creates them with their indexes. The stages loading or changing the roll then refresh those
+that exist once they are done, with REFRESH MATERIALIZED VIEW CONCURRENTLY: the new contents are computed
+next to the old ones and only the changed rows are swapped in, so reads keep going against the previous
+contents instead of waiting for the refresh. It needs a unique index on plain columns covering every row.
+
+    refresh_materialized_views()
+"""
+import psycopg2
+from datetime import datetime
+from typing import NamedTuple
+from dotenv import dotenv_values
+
+# Read in the database configuration from a .env file
+DB_CONFIG = dotenv_values(".env")
+
+
+class MaterializedView(NamedTuple):
+    # Over the roll {roll} and the lookup tables {phys_link}, {const_type} and {owner_status}
+    query: str
+    # Of the unique index REFRESH ... CONCURRENTLY needs
+    unique_columns: tuple
+    # Other indexes, one per tuple of columns
+    indexes: tuple = ()
+
+
+MATERIALIZED_VIEWS = {
+    # The MURBs export of the README, with the labels of the lookup columns
+    'murbs': MaterializedView(
+        """SELECT r.id, r.lat, r.lng, r.geohash_7, r.muni_code, r.muni, r.arrond, r.address, r.cubf, r.const_yr,
+            r.const_yr_real, r.num_dwelling, r.max_floors, r.lot_lin_dim, r.lot_area, r.floor_area,
+            pl.value AS phys_link, ct.value AS const_type, r.num_rental, r.num_non_res, r.owner_type,
+            os.value AS owner_status, r.value
+        FROM {roll} r
+        LEFT JOIN {phys_link} pl ON r.phys_link = pl.id
+        LEFT JOIN {const_type} ct ON r.const_type = ct.id
+        LEFT JOIN {owner_status} os ON r.owner_status = os.id
+        WHERE r.cubf = 1000 AND r.num_dwelling >= 3""",
+        unique_columns=('id',),
+        indexes=(('num_dwelling',), ('muni_code',)),
+    ),
+    # Units, dwellings and values of each municipality
+    'muni_summary': MaterializedView(
+        """SELECT muni_code, min(muni) AS muni,
+            count(*) AS num_units,
+            count(*) FILTER (WHERE cubf = 1000) AS num_residential,
+            count(*) FILTER (WHERE cubf = 1000 AND num_dwelling >= 3) AS num_murbs,
+            sum(num_dwelling) AS num_dwellings,
+            sum(num_dwelling) FILTER (WHERE cubf = 1000 AND num_dwelling >= 3) AS num_murb_dwellings,
+            sum(value) AS total_value,
+            percentile_disc(0.5) WITHIN GROUP (ORDER BY value) AS median_value,
+            percentile_disc(0.5) WITHIN GROUP (ORDER BY const_yr) AS median_const_yr
+        FROM {roll}
+        GROUP BY muni_code""",
+        unique_columns=('muni_code',),
+    ),
+}
+
+
+def materialized_view_name(name):
+    return f"{DB_CONFIG['ROLL_TABLE_NAME']}_{name}"
+
+
+def materialized_view_indexes(name):
+    """
+    The (index name, columns, unique) of the indexes of one of the MATERIALIZED_VIEWS
+    """
+    view = MATERIALIZED_VIEWS[name]
+    view_name = materialized_view_name(name)
+    return [(f"{view_name}_{'_'.join(columns)}_idx", columns, unique)
+            for columns, unique in [(view.unique_columns, True), *((columns, False) for columns in view.indexes)]]
+
+
+def create_materialized_views():
+    """
+    Create the materialized views that don't exist yet with their indexes, and refresh the others.
+    Each view is created along with its indexes in one transaction, so it can always be refreshed concurrently.
+    """
+    conn = psycopg2.connect(user=DB_CONFIG['DB_USER'], password=DB_CONFIG['DB_PASSWORD'], database=DB_CONFIG['DB_NAME'])
+    cursor = conn.cursor()
+    existing_views = get_existing_views(cursor)
+    for name, view in MATERIALIZED_VIEWS.items():
+        view_name = materialized_view_name(name)
+        t0 = datetime.now()
+        if view_name not in existing_views:
+            cursor.execute(f"""CREATE MATERIALIZED VIEW {view_name} AS {view.query.format(
+                roll=DB_CONFIG['ROLL_TABLE_NAME'],
+                phys_link=DB_CONFIG['PHYS_LINK_TABLE_NAME'],
+                const_type=DB_CONFIG['CONST_TYPE_TABLE_NAME'],
+                owner_status=DB_CONFIG['OWNER_STATUS_TABLE_NAME'],
+            )}""")
+        for index_name, columns, unique in materialized_view_indexes(name):
+            cursor.execute(f"""CREATE {'UNIQUE ' if unique else ''}INDEX IF NOT EXISTS {index_name}
+                ON {view_name} ({', '.join(columns)})""")
+        if view_name in existing_views:
+            refresh_materialized_view(cursor, view_name)
+        else:
+            cursor.execute(f"ANALYZE {view_name}")
+            print(f'Created {view_name} in {datetime.now() - t0}')
+        conn.commit()
+    conn.close()
+
+
+def refresh_materialized_views():
+    """
+    Refresh the materialized views created by finalize.py, if any, without blocking the reads on them
+    """
+    conn = psycopg2.connect(user=DB_CONFIG['DB_USER'], password=DB_CONFIG['DB_PASSWORD'], database=DB_CONFIG['DB_NAME'])
+    conn.autocommit = True
+    cursor = conn.cursor()
+    for view_name in get_existing_views(cursor):
+        refresh_materialized_view(cursor, view_name)
+    conn.close()
+
+
+def refresh_materialized_view(cursor, view_name):
+    t0 = datetime.now()
+    cursor.execute(f"REFRESH MATERIALIZED VIEW CONCURRENTLY {view_name}")
+    cursor.execute(f"ANALYZE {view_name}")
+    print(f'Refreshed {view_name} in {datetime.now() - t0}')
+
+
+def get_existing_views(cursor):
+    """
+    Names of the MATERIALIZED_VIEWS that exist
+    """
+    view_names = [materialized_view_name(name) for name in MATERIALIZED_VIEWS]
+    cursor.execute("SELECT matviewname FROM pg_matviews WHERE matviewname = ANY(%s) AND schemaname = current_schema()",
+                   (view_names,))
+    existing_views = {row[0] for row in cursor.fetchall()}
+    return [view_name for view_name in view_names if view_name in existing_views]
@@ -0,0 +1,45 @@
+"""
+Most common value of each group of units, for the fields of an aggregated MURB taken from the most
+common value of its units. The loop of aggregate_murbs() uses Counter.most_common(), the streaming
+aggregation group_most_common() and the set-based one sql_most_common(), which all count NULLs as a
+value and break ties on the value seen first, the units being in the order of their IDs.
+
+    SELECT {sql_most_common('year', 'u')}
+    FROM (SELECT r.*, {sql_value_counts('year', 'r.group_id', 'r')} FROM units r) u
+    GROUP BY u.group_id
+"""
+import numpy as np
+
+
+def group_most_common(values, group_ids, num_groups):
+    """
+    Most common value of each group, ties going to the value seen first like Counter.most_common()
+    """
+    codes_by_value = {}
+    codes = np.fromiter((codes_by_value.setdefault(value, len(codes_by_value)) for value in values),
+        dtype=np.int64, count=len(values))
+    keys = group_ids * len(codes_by_value) + codes
+    unique_keys, first_seen, counts = np.unique(keys, return_index=True, return_counts=True)
+    key_groups = unique_keys // len(codes_by_value)
+
+    # Sort by group, then most frequent, then first seen, and take the first of each group
+    order = np.lexsort((first_seen, -counts, key_groups))
+    best = order[np.searchsorted(key_groups[order], np.arange(num_groups))]
+    return values[first_seen[best]].tolist()
+
+
+def sql_value_counts(column, group_by, alias):
+    """
+    Window columns with the number of units of the group having the same value of the column, NULLs
+    included, and the lowest ID among them, for sql_most_common()
+    """
+    return (f'count(*) OVER (PARTITION BY {group_by}, {alias}.{column}) AS {column}_count, '
+            f'min({alias}.id) OVER (PARTITION BY {group_by}, {alias}.{column}) AS {column}_first_id')
+
+
+def sql_most_common(column, alias):
+    """
+    Aggregate of the most common value of the column in each group, from the columns of sql_value_counts().
+    Unlike mode() WITHIN GROUP, NULLs count as a value and ties go to the value of the lowest ID.
+    """
+    return f'(array_agg({alias}.{column} ORDER BY {alias}.{column}_count DESC, {alias}.{column}_first_id))[1]'
@@ -0,0 +1,121 @@
+import json
+import random
+from collections import Counter
+
+# Quantiles we keep for the value and construction year distributions
+QUANTILES = (0.1, 0.25, 0.5, 0.75, 0.9)
+
+# Fields that are summed per municipality
+SUMMED_FIELDS = ('value', 'lot_value', 'building_value', 'prev_value', 'num_dwelling', 'num_rental', 'num_non_res')
+
+
+class MuniStats:
+    """
+    Streaming accumulator for the statistics of a single municipality file.
+    Units are added one at a time while parsing, so we never need to hold
+    the whole municipality in memory or scan the roll table afterwards.
+
+    Quantiles of the construction year are exact since there are only a few hundred
+    distinct years. Quantiles of the value are approximated from a fixed size
+    reservoir sample, which is exact for municipalities smaller than the sample.
+    """
+
+    def __init__(self, muni_code, year, muni, source, load_id=None, sample_size=10_000):
+        self.muni_code = muni_code
+        self.year = year
+        self.muni = muni
+        self.source = source
+        # Identifies the run that loaded the units, so later stages can tell which municipalities changed
+        self.load_id = load_id
+
+        self.num_units = 0
+        self.num_skipped = 0
+        self.num_quarantined = 0
+        self.num_without_coords = 0
+
+        self.sums = {field: 0 for field in SUMMED_FIELDS}
+        self.null_counts = Counter()
+
+        self.min_value = None
+        self.max_value = None
+        self.const_years = Counter()
+
+        # Reservoir sample of the values, seeded so reruns give the same numbers
+        self.sample_size = sample_size
+        self.value_sample = []
+        self.num_values = 0
+        self._rng = random.Random(0)
+
+    def add(self, unit_data):
+        self.num_units += 1
+
+        for field, field_value in unit_data.items():
+            if field_value is None:
+                self.null_counts[field] += 1
+
+        for field in SUMMED_FIELDS:
+            if unit_data.get(field) is not None:
+                self.sums[field] += unit_data[field]
+
+        if (const_yr := unit_data.get('const_yr')) is not None:
+            self.const_years[const_yr] += 1
+
+        if (value := unit_data.get('value')) is not None:
+            self._add_value(value)
+
+    def _add_value(self, value):
+        if self.min_value is None or value < self.min_value:
+            self.min_value = value
+        if self.max_value is None or value > self.max_value:
+            self.max_value = value
+
+        # Algorithm R: every value seen so far has the same chance of being in the sample
+        self.num_values += 1
+        if len(self.value_sample) < self.sample_size:
+            self.value_sample.append(value)
+        else:
+            slot = self._rng.randrange(self.num_values)
+            if slot < self.sample_size:
+                self.value_sample[slot] = value
+
+    def to_row(self):
+        """
+        Get the statistics as a dict matching the columns of the muni stats table
+        """
+        row = {
+            'muni_code': self.muni_code,
+            'year': self.year,
+            'muni': self.muni,
+            'source': self.source,
+            'load_id': self.load_id,
+            'num_units': self.num_units,
+            'num_skipped': self.num_skipped,
+            'num_quarantined': self.num_quarantined,
+            'num_without_coords': self.num_without_coords,
+            'min_value': self.min_value,
+            'max_value': self.max_value,
+            'min_const_yr': min(self.const_years) if self.const_years else None,
+            'max_const_yr': max(self.const_years) if self.const_years else None,
+            'null_counts': json.dumps(dict(self.null_counts)),
+        }
+
+        for field, total in self.sums.items():
+            row[f'sum_{field}'] = total
+
+        value_quantiles = _quantiles(sorted(self.value_sample))
+        const_yr_quantiles = _quantiles(sorted(self.const_years.elements()))
+        for q, value_q, const_yr_q in zip(QUANTILES, value_quantiles, const_yr_quantiles):
+            row[f'value_p{round(q * 100)}'] = value_q
+            row[f'const_yr_p{round(q * 100)}'] = const_yr_q
+
+        return row
+
+
+def _quantiles(sorted_values):
+    """
+    Nearest-rank quantiles of an already sorted list, None if it's empty
+    """
+    if not sorted_values:
+        return [None] * len(QUANTILES)
+    last = len(sorted_values) - 1
+    return [sorted_values[round(q * last)] for q in QUANTILES]
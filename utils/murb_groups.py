@@ -0,0 +1,131 @@
+"""
+Groups the units of a MURB that don't share the exact same coordinates or address spelling,
+e.g. units whose shapefile points are a few metres apart, or '10 Rue St-Jean' and '10 Rue Saint-Jean'.
+
+Units are bucketed by municipality, normalized address and a square grid cell as wide as the
+tolerance, so two units within the tolerance of each other are always in the same or in adjacent
+cells, and only those are compared. Units at the exact same point are compared once.
+Groups are transitive: A and C end up together if both are within the tolerance of B.
+
+    group_ids = group_units_within_tolerance(muni_codes, addresses, lat, lng, tolerance_m=10)
+"""
+import re
+import unicodedata
+import numpy as np
+
+# Metres per degree of latitude, and of longitude at the equator
+METRES_PER_DEGREE = 111_320.0
+
+# Words left out of the normalized addresses, mostly the way links of the roll (see WAY_LINKS)
+ADDRESS_STOP_WORDS = {'a', 'l', 'la', 'au', 'aux', 'chez', 'd', 'de', 'des', 'du', 'en', 'le', 'les', 'sur'}
+
+# Common abbreviations, spelled out in the normalized addresses
+ADDRESS_ABBREVIATIONS = {
+    'st': 'saint',
+    'ste': 'sainte',
+    'av': 'avenue',
+    'ave': 'avenue',
+    'boul': 'boulevard',
+    'bd': 'boulevard',
+    'blvd': 'boulevard',
+    'ch': 'chemin',
+    'mtee': 'montee',
+    'rte': 'route',
+}
+
+# The cell itself and half of its neighbours, the other half compare with it from their side
+NEIGHBOUR_OFFSETS = ((0, 0), (1, -1), (1, 0), (1, 1), (0, 1))
+
+
+def normalize_address(address):
+    """
+    Lowercase address without accents, punctuation, way links or abbreviations,
+    e.g. 'St-Jean-De-La-Croix' and 'Saint Jean Croix' are both 'saint jean croix'
+    """
+    if address is None:
+        return None
+    address = unicodedata.normalize('NFKD', address)
+    address = ''.join(c for c in address if not unicodedata.combining(c)).lower()
+    words = re.findall(r'[a-z0-9]+', address)
+    return ' '.join(ADDRESS_ABBREVIATIONS.get(word, word) for word in words if word not in ADDRESS_STOP_WORDS)
+
+
+def group_units_within_tolerance(muni_codes, addresses, lat, lng, tolerance_m):
+    """
+    The group of each unit as an int64 array, -1 for units without another unit of the same
+    municipality and normalized address within tolerance_m metres
+    """
+    lat = np.asarray(lat, dtype=np.float64)
+    lng = np.asarray(lng, dtype=np.float64)
+
+    # Each distinct (muni, normalized address, point) is compared once, however many units are there
+    normalized = {}
+    points = {}
+    unit_points = np.empty(len(lat), dtype=np.int64)
+    for i, (muni_code, address, unit_lat, unit_lng) in enumerate(zip(muni_codes, addresses, lat.tolist(), lng.tolist())):
+        if address not in normalized:
+            normalized[address] = normalize_address(address)
+        key = (muni_code, normalized[address], unit_lat, unit_lng)
+        unit_points[i] = points.setdefault(key, len(points))
+
+    point_keys = list(points)
+    point_lat = np.array([key[2] for key in point_keys], dtype=np.float64)
+    point_lng = np.array([key[3] for key in point_keys], dtype=np.float64)
+
+    # Equirectangular projection around the mean point of each municipality. Scaling the longitudes by a
+    # single latitude keeps the east-west distances between nearby points right, scaling each by its own
+    # latitude would turn a north-south offset into a large east-west one.
+    point_munis = np.unique([key[0] for key in point_keys], return_inverse=True)[1].reshape(-1)
+    num_points_per_muni = np.bincount(point_munis)
+    lat0 = (np.bincount(point_munis, weights=point_lat) / num_points_per_muni)[point_munis]
+    lng0 = (np.bincount(point_munis, weights=point_lng) / num_points_per_muni)[point_munis]
+    y = (point_lat - lat0) * METRES_PER_DEGREE
+    x = (point_lng - lng0) * METRES_PER_DEGREE * np.cos(np.radians(lat0))
+    # Cells at least a metre wide, a tolerance of 0 only groups the units at the same point
+    cell_size = max(tolerance_m, 1.0)
+    cell_x = np.floor(x / cell_size).astype(np.int64)
+    cell_y = np.floor(y / cell_size).astype(np.int64)
+
+    cells = {}
+    for p, (muni_code, address, _, _), cx, cy in zip(range(len(point_keys)), point_keys, cell_x.tolist(), cell_y.tolist()):
+        cells.setdefault((muni_code, address, cx, cy), []).append(p)
+
+    # Plain lists, much faster than NumPy arrays for element by element access
+    x, y = x.tolist(), y.tolist()
+    parents = list(range(len(point_keys)))
+    max_squared_distance = tolerance_m * tolerance_m
+    for (muni_code, address, cx, cy), cell_points in cells.items():
+        for dx, dy in NEIGHBOUR_OFFSETS:
+            if dx == 0 and dy == 0:
+                pairs = ((a, b) for i, a in enumerate(cell_points) for b in cell_points[i + 1:])
+            else:
+                neighbour_points = cells.get((muni_code, address, cx + dx, cy + dy))
+                if not neighbour_points:
+                    continue
+                pairs = ((a, b) for a in cell_points for b in neighbour_points)
+            for a, b in pairs:
+                if (x[a] - x[b]) ** 2 + (y[a] - y[b]) ** 2 <= max_squared_distance:
+                    _union(parents, a, b)
+
+    roots = np.array([_find(parents, p) for p in range(len(point_keys))], dtype=np.int64)
+    group_ids = roots[unit_points]
+    _, inverse, counts = np.unique(group_ids, return_inverse=True, return_counts=True)
+    group_ids[counts[inverse] < 2] = -1
+    return group_ids
+
+
+def _find(parents, p):
+    root = p
+    while parents[root] != root:
+        root = parents[root]
+    # Path compression
+    while parents[p] != root:
+        parents[p], p = root, parents[p]
+    return root
+
+
+def _union(parents, a, b):
+    root_a = _find(parents, a)
+    root_b = _find(parents, b)
+    if root_a != root_b:
+        parents[max(root_a, root_b)] = min(root_a, root_b)
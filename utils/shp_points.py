@@ -0,0 +1,158 @@
+import itertools
+import numpy as np
+import shapefile
+from pathlib import Path
+
+# https://www.esri.com/content/dam/esrisites/sitecore-archive/Files/Pdfs/library/whitepapers/pdfs/shapefile.pdf
+SHP_HEADER_SIZE = 100
+SHP_FILE_CODE = 9994
+SHP_POINT_TYPE = 1
+
+# Every point record has the same layout: an 8 byte big endian record header
+# followed by the little endian shape type and x, y coordinates
+SHP_POINT_RECORD = np.dtype([
+    ('record_number', '>i4'),
+    ('content_length', '>i4'),
+    ('shape_type', '<i4'),
+    ('x', '<f8'),
+    ('y', '<f8'),
+])
+
+
+def read_point_shapefile(shp_file, id_field=None, start=0, stop=None):
+    """
+    Read the ID and coordinates of every unit of the rol_unite_p shapefile into NumPy arrays.
+    Returns (ids, lng, lat), where ids are fixed width byte strings.
+    Only the records in [start, stop) are read if given, e.g. to split the file between workers.
+
+    The point records of the .shp and the records of the .dbf have a fixed size,
+    so both files are memory-mapped and read in one vectorized pass, instead of
+    building Python objects for every record through pyshp.
+    Falls back to pyshp if the geometry isn't a plain point or a record is deleted or empty.
+    The ID is the first attribute unless id_field is given.
+    """
+    shp_file = Path(shp_file)
+
+    try:
+        lng, lat = _read_shp_points(shp_file.with_suffix('.shp'), start, stop)
+        ids = _read_dbf_column(shp_file.with_suffix('.dbf'), id_field, start, stop)
+    except _NotFixedLayout as e:
+        print(f'Falling back to pyshp to read {shp_file.name}: {e}')
+        return _read_with_pyshp(shp_file, id_field, start, stop)
+
+    if len(ids) != len(lng):
+        print(f'Falling back to pyshp to read {shp_file.name}: {len(ids)} records but {len(lng)} shapes')
+        return _read_with_pyshp(shp_file, id_field, start, stop)
+
+    return ids, lng, lat
+
+
+class _NotFixedLayout(Exception):
+    pass
+
+
+def count_records(shp_file):
+    """
+    Number of records in the shapefile, without reading them
+    """
+    with shapefile.Reader(str(shp_file)) as shp:
+        return len(shp)
+
+
+def _read_shp_points(shp_path, start=0, stop=None):
+    with open(shp_path, 'rb') as f:
+        header = f.read(SHP_HEADER_SIZE)
+
+    file_code = int.from_bytes(header[0:4], 'big')
+    # The file length is in 16 bit words
+    file_length = int.from_bytes(header[24:28], 'big') * 2
+    shape_type = int.from_bytes(header[32:36], 'little')
+
+    if file_code != SHP_FILE_CODE:
+        raise _NotFixedLayout(f'not a shapefile (file code {file_code})')
+    if shape_type != SHP_POINT_TYPE:
+        raise _NotFixedLayout(f'shape type {shape_type} is not Point')
+
+    num_records, remainder = divmod(file_length - SHP_HEADER_SIZE, SHP_POINT_RECORD.itemsize)
+    if remainder:
+        # Null shapes are shorter than points, we can't use the fixed record size
+        raise _NotFixedLayout('records have varying sizes')
+
+    records = np.memmap(shp_path, dtype=SHP_POINT_RECORD, mode='r', offset=SHP_HEADER_SIZE, shape=(num_records,))
+    records = records[start:stop]
+    if not (records['shape_type'] == SHP_POINT_TYPE).all():
+        raise _NotFixedLayout('some records are not points')
+
+    # Copy out of the memory map so the file can be closed
+    return np.array(records['x']), np.array(records['y'])
+
+
+def _read_dbf_column(dbf_path, field_name=None, start=0, stop=None):
+    """
+    Read a single character field of the .dbf as an array of byte strings
+    """
+    with open(dbf_path, 'rb') as f:
+        header = f.read(32)
+        num_records = int.from_bytes(header[4:8], 'little')
+        header_length = int.from_bytes(header[8:10], 'little')
+        record_length = int.from_bytes(header[10:12], 'little')
+        field_descriptors = f.read(header_length - 32)
+
+    # Field descriptors are 32 bytes each, terminated by 0x0D.
+    # Record data starts with the 1 byte deletion flag.
+    offset = 1
+    field = None
+    for i in range(0, len(field_descriptors), 32):
+        descriptor = field_descriptors[i:i + 32]
+        if descriptor[0] == 0x0D:
+            break
+        name = descriptor[:11].split(b'\x00')[0].decode('ascii')
+        field_type = chr(descriptor[11])
+        length = descriptor[16]
+        if field_name is None or name == field_name:
+            field = (name, field_type, offset, length)
+            break
+        offset += length
+
+    if field is None:
+        raise _NotFixedLayout(f'no field {field_name} in the .dbf')
+
+    name, field_type, field_offset, length = field
+    if field_type != 'C':
+        raise _NotFixedLayout(f'field {name} is of type {field_type}, not character')
+
+    record_dtype = np.dtype({
+        'names': ['deleted', 'id'],
+        'formats': ['S1', f'S{length}'],
+        'offsets': [0, field_offset],
+        'itemsize': record_length,
+    })
+    records = np.memmap(dbf_path, dtype=record_dtype, mode='r', offset=header_length, shape=(num_records,))
+    records = records[start:stop]
+
+    if (records['deleted'] == b'*').any():
+        raise _NotFixedLayout('the .dbf has deleted records')
+
+    # Character fields are padded with spaces
+    return np.char.strip(records['id'])
+
+
+def _read_with_pyshp(shp_file, id_field=None, start=0, stop=None):
+    with shapefile.Reader(str(shp_file)) as shp:
+        if id_field is None:
+            field_index = 0
+        else:
+            # Skip the DeletionFlag field pyshp puts first
+            field_names = [field[0] for field in shp.fields[1:]]
+            field_index = field_names.index(id_field)
+
+        ids, lng, lat = [], [], []
+        for shape_record in itertools.islice(shp.iterShapeRecords(), start, stop):
+            if not shape_record.shape.points:
+                continue
+            ids.append(str(shape_record.record[field_index]).strip().encode())
+            x, y = shape_record.shape.points[0]
+            lng.append(x)
+            lat.append(y)
+
+    return np.array(ids), np.array(lng, dtype=np.float64), np.array(lat, dtype=np.float64)
@@ -0,0 +1,157 @@
+"""
+In-process nearest neighbour index over the roll coordinates, for batch jobs
+matching external points (building footprints, sensors, ...) to evaluation units
+without a database round trip per query.
+
+Requires scipy (pip install scipy) for its KD-tree.
+
+    index = SpatialIndex.from_roll()
+    index.save('spatial_index')
+    ...
+    index = SpatialIndex.load('spatial_index')
+    ids, distances_m = index.knn(lats, lngs, k=3)
+"""
+import pickle
+import numpy as np
+import psycopg2
+from pathlib import Path
+from dotenv import dotenv_values
+
+from utils.shp_points import read_point_shapefile
+
+# Read in the database configuration from a .env file
+DB_CONFIG = dotenv_values(".env")
+
+# Mean earth radius in metres
+EARTH_RADIUS_M = 6_371_008.8
+
+# Files making up a persisted index
+IDS_FILE_NAME = 'spatial_ids.npy'
+COORDS_FILE_NAME = 'spatial_latlng.npy'
+TREE_FILE_NAME = 'spatial_tree.pickle'
+
+# Rows fetched at a time when loading from the roll
+FETCH_SIZE = 100_000
+
+
+class SpatialIndex:
+    """
+    KD-tree over the units' positions on the sphere. Points are converted to 3D
+    cartesian coordinates, where the straight line (chord) distance grows with the
+    great circle distance, so the tree's euclidean queries give exact results
+    anywhere in the province without projecting the coordinates.
+    Distances are returned in metres along the earth's surface.
+    """
+
+    def __init__(self, ids, lat, lng, tree=None):
+        from scipy.spatial import cKDTree
+
+        self.ids = ids
+        self.lat = lat
+        self.lng = lng
+        self.tree = tree if tree is not None else cKDTree(_to_cartesian(lat, lng))
+
+    @classmethod
+    def from_roll(cls, table_name=None, where=None):
+        """
+        Load the coordinates of the units from the database, optionally filtered with an SQL condition
+        """
+        table_name = table_name or DB_CONFIG['ROLL_TABLE_NAME']
+        conn = psycopg2.connect(user=DB_CONFIG['DB_USER'], password=DB_CONFIG['DB_PASSWORD'], database=DB_CONFIG['DB_NAME'])
+
+        # Server-side cursor so we only hold a chunk of Python rows at a time
+        cursor = conn.cursor(name='spatial_index_load')
+        cursor.itersize = FETCH_SIZE
+        cursor.execute(f"""SELECT id, lat::float8, lng::float8 FROM {table_name}
+            WHERE lat IS NOT NULL AND lng IS NOT NULL {f'AND ({where})' if where else ''}""")
+
+        ids, lat, lng = [], [], []
+        while rows := cursor.fetchmany(FETCH_SIZE):
+            chunk_ids, chunk_lat, chunk_lng = zip(*rows)
+            ids.append(np.array(chunk_ids, dtype='S23'))
+            lat.append(np.array(chunk_lat, dtype=np.float64))
+            lng.append(np.array(chunk_lng, dtype=np.float64))
+        conn.close()
+
+        if not ids:
+            return cls(np.array([], dtype='S23'), np.array([]), np.array([]))
+        return cls(np.concatenate(ids), np.concatenate(lat), np.concatenate(lng))
+
+    @classmethod
+    def from_shapefile(cls, shp_file):
+        ids, lng, lat = read_point_shapefile(shp_file)
+        return cls(ids, lat, lng)
+
+    @classmethod
+    def from_coord_index(cls, coord_index):
+        return cls(np.asarray(coord_index.ids), np.asarray(coord_index.lat), np.asarray(coord_index.lng))
+
+    def save(self, index_dir):
+        index_dir = Path(index_dir)
+        index_dir.mkdir(parents=True, exist_ok=True)
+        np.save(index_dir / IDS_FILE_NAME, self.ids)
+        np.save(index_dir / COORDS_FILE_NAME, np.column_stack((self.lat, self.lng)))
+        # The tree pickles with its node structure, so loading doesn't rebuild it
+        with open(index_dir / TREE_FILE_NAME, 'wb') as f:
+            pickle.dump(self.tree, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+    @classmethod
+    def load(cls, index_dir):
+        index_dir = Path(index_dir)
+        ids = np.load(index_dir / IDS_FILE_NAME, mmap_mode='r')
+        coords = np.load(index_dir / COORDS_FILE_NAME, mmap_mode='r')
+        with open(index_dir / TREE_FILE_NAME, 'rb') as f:
+            tree = pickle.load(f)
+        return cls(ids, coords[:, 0], coords[:, 1], tree=tree)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def knn(self, lat, lng, k=1):
+        """
+        The k nearest units of each query point. lat and lng are scalars or arrays.
+        Returns (ids, distances_m) of shape (n, k), sorted by distance.
+        If there are fewer than k units, the missing neighbours have an empty ID and an infinite distance.
+        """
+        points = _to_cartesian(np.atleast_1d(lat), np.atleast_1d(lng))
+        if len(self) == 0:
+            # Every neighbour is missing, e.g. from_roll() with a condition no unit matches
+            return np.zeros((len(points), k), dtype=np.asarray(self.ids).dtype), np.full((len(points), k), np.inf)
+
+        chords, positions = self.tree.query(points, k=k)
+        chords = chords.reshape(len(points), k)
+        positions = positions.reshape(len(points), k)
+
+        # Missing neighbours come back with position len(self)
+        found = positions < len(self)
+        ids = np.where(found, np.asarray(self.ids)[np.minimum(positions, len(self) - 1)], b'')
+        distances_m = np.where(found, _chord_to_distance(chords), np.inf)
+        return ids, distances_m
+
+    def within_radius(self, lat, lng, radius_m):
+        """
+        The units within radius_m metres of each query point. lat and lng are scalars or arrays.
+        Returns one (ids, distances_m) pair of arrays per query point, nearest first.
+        """
+        lat, lng = np.atleast_1d(lat), np.atleast_1d(lng)
+        points = _to_cartesian(lat, lng)
+        chord_radius = 2 * EARTH_RADIUS_M * np.sin(min(radius_m / (2 * EARTH_RADIUS_M), np.pi / 2))
+
+        results = []
+        for point, positions in zip(points, self.tree.query_ball_point(points, chord_radius)):
+            positions = np.asarray(positions, dtype=np.intp)
+            chords = np.linalg.norm(self.tree.data[positions] - point, axis=1)
+            order = np.argsort(chords)
+            results.append((np.asarray(self.ids)[positions[order]], _chord_to_distance(chords[order])))
+        return results
+
+
+def _to_cartesian(lat, lng):
+    lat = np.radians(np.asarray(lat, dtype=np.float64))
+    lng = np.radians(np.asarray(lng, dtype=np.float64))
+    cos_lat = np.cos(lat)
+    return EARTH_RADIUS_M * np.column_stack((cos_lat * np.cos(lng), cos_lat * np.sin(lng), np.sin(lat)))
+
+
+def _chord_to_distance(chords):
+    return 2 * EARTH_RADIUS_M * np.arcsin(np.clip(chords / (2 * EARTH_RADIUS_M), 0, 1))
@@ -0,0 +1,73 @@
+"""
+Spatial queries over the roll using the geography column and its GiST index,
+filled in by parse_shp.py --geography. Every query takes an open cursor and returns
+a list of dicts, with the distance to the reference point in metres where applicable.
+
+    conn = psycopg2.connect(...)
+    cursor = conn.cursor()
+    within_radius(cursor, 45.5017, -73.5673, 250)
+"""
+import json
+from dotenv import dotenv_values
+
+# Read in the database configuration from a .env file
+DB_CONFIG = dotenv_values(".env")
+
+# Columns returned by the queries unless others are asked for
+DEFAULT_COLUMNS = ('id', 'lat', 'lng', 'address', 'muni', 'cubf', 'num_dwelling')
+
+# The reference point of a query, as a geography to compare with the geog column
+SQL_POINT = "ST_SetSRID(ST_MakePoint(%(lng)s, %(lat)s), 4326)::geography"
+
+
+def within_radius(cursor, lat, lng, radius_m, columns=DEFAULT_COLUMNS, table_name=None):
+    """
+    Units within radius_m metres of the point, nearest first
+    """
+    table_name = table_name or DB_CONFIG['ROLL_TABLE_NAME']
+    return _fetch(cursor, f"""
+        SELECT {', '.join(columns)}, ST_Distance(geog, {SQL_POINT}) AS distance_m
+        FROM {table_name}
+        WHERE ST_DWithin(geog, {SQL_POINT}, %(radius_m)s)
+        ORDER BY distance_m""", {'lat': lat, 'lng': lng, 'radius_m': radius_m})
+
+
+def within_polygon(cursor, polygon, columns=DEFAULT_COLUMNS, table_name=None):
+    """
+    Units inside a polygon, e.g. a borough boundary, given as WKT
+    or as a GeoJSON geometry (dict or string), in WGS84 lng/lat
+    """
+    table_name = table_name or DB_CONFIG['ROLL_TABLE_NAME']
+
+    if isinstance(polygon, dict):
+        polygon = json.dumps(polygon)
+
+    if polygon.lstrip().startswith('{'):
+        sql_polygon = "ST_SetSRID(ST_GeomFromGeoJSON(%(polygon)s), 4326)::geography"
+    else:
+        sql_polygon = "ST_GeogFromText(%(polygon)s)"
+
+    return _fetch(cursor, f"""
+        SELECT {', '.join(columns)}
+        FROM {table_name}
+        WHERE ST_Covers({sql_polygon}, geog)""", {'polygon': polygon})
+
+
+def knn(cursor, lat, lng, k=10, columns=DEFAULT_COLUMNS, table_name=None):
+    """
+    The k units nearest to the point. The <-> operator in the ORDER BY
+    lets Postgres walk the GiST index instead of sorting the whole table.
+    """
+    table_name = table_name or DB_CONFIG['ROLL_TABLE_NAME']
+    return _fetch(cursor, f"""
+        SELECT {', '.join(columns)}, geog <-> {SQL_POINT} AS distance_m
+        FROM {table_name}
+        WHERE geog IS NOT NULL
+        ORDER BY geog <-> {SQL_POINT}
+        LIMIT %(k)s""", {'lat': lat, 'lng': lng, 'k': k})
+
+
+def _fetch(cursor, query, params):
+    cursor.execute(query, params)
+    column_names = [column.name for column in cursor.description]
+    return [dict(zip(column_names, row)) for row in cursor.fetchall()]